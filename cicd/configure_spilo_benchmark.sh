@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Fails if generating the Patroni configuration got slow: runs `configure_spilo.py patroni` a number of
+# times in a scratch PGHOME, and compares the median wall-clock time (including the start of the
+# interpreter) against a threshold. The configuration cache is not used, so every run is a cold start.
+#
+#   CONFIGURE_SPILO_RUNS            number of runs (default: 10)
+#   CONFIGURE_SPILO_MAX_MS          the maximum median, in milliseconds (default: 1000)
+#
+# The script to benchmark defaults to /scripts/configure_spilo.py, another one can be passed as argument.
+
+set -e -o pipefail
+
+SCRIPT="${1:-/scripts/configure_spilo.py}"
+RUNS="${CONFIGURE_SPILO_RUNS:-10}"
+MAX_MS="${CONFIGURE_SPILO_MAX_MS:-1000}"
+
+SCRATCH="$(mktemp -d)"
+trap 'rm -rf "$SCRATCH"' EXIT
+
+# The provider is fixed, so the metadata services (and their deadline) do not count, and with a DCS
+# configured we do not write the supervisor configuration of a local etcd
+export PGHOME="$SCRATCH" PGROOT="$SCRATCH/pgdata" PGDATA="$SCRATCH/pgdata/pgroot/data" SPILO_PROVIDER=local
+export ETCD_HOST="${ETCD_HOST:-127.0.0.1:2379}"
+export SPILO_PROVIDER_CACHE="$SCRATCH/provider" SPILO_CONFIG_CACHE=""
+
+durations=()
+for ((run = 0; run < RUNS; run++)); do
+	rm -f "$PGHOME/postgres.yml"
+	start="$(date +%s%N)"
+	# The exit code only tells whether WAL-E is used, so we check the output instead
+	python3 "$SCRIPT" patroni >"$SCRATCH/output.log" 2>&1 || true
+	durations+=($((($(date +%s%N) - start) / 1000000)))
+	if [ ! -s "$PGHOME/postgres.yml" ] || grep -q '^Traceback' "$SCRATCH/output.log"; then
+		cat "$SCRATCH/output.log" >&2
+		echo "ERROR: $SCRIPT patroni did not write $PGHOME/postgres.yml" >&2
+		exit 1
+	fi
+done
+
+mapfile -t sorted < <(printf '%s\n' "${durations[@]}" | sort -n)
+median="${sorted[$((RUNS / 2))]}"
+
+echo "configure_spilo.py patroni: median ${median}ms over $RUNS runs (min ${sorted[0]}ms, max ${sorted[$((RUNS - 1))]}ms)"
+if [ "$median" -gt "$MAX_MS" ]; then
+	echo "ERROR: the median of ${median}ms exceeds the threshold of ${MAX_MS}ms" >&2
+	exit 1
+fi
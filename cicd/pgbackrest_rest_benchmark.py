@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the pgBackRest api (scripts/pgbackrest-rest.py)
+
+The sidecar is started against a fake pgbackrest, which is put in front of the PATH, so these
+benchmarks neither need a database nor a repository. Every benchmark prints its measurements and
+fails if one of them exceeds its threshold; the thresholds are generous, they are there to catch
+regressions of an order of magnitude, not to measure the differences between runners.
+
+  load        the latency of GET /backups, idle and while --max-requests - 2 POSTs are in flight
+  history     the cost of the BackupHistory operations, for histories of 10k and 100k backups
+  memory      the memory used to parse a large info document, streaming and using json.load
+  latency     the time from POST /backups until pgbackrest runs, and from SIGTERM until the sidecar exits
+"""
+
+import argparse
+import datetime
+import http.client
+import importlib.util
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import tracemalloc
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'pgbackrest-rest.py')
+
+# info outputs the document in PGBACKREST_BENCHMARK_INFO, backup records the time it started
+# in PGBACKREST_BENCHMARK_STARTED and takes PGBACKREST_BENCHMARK_SECONDS. It is a shell script,
+# so the time it takes to start hardly counts when measuring the time it takes to start a backup.
+FAKE_PGBACKREST = textwrap.dedent('''\
+    #!/bin/bash
+    case " $* " in
+    *" info "*)
+    \tcat "$PGBACKREST_BENCHMARK_INFO"
+    \t;;
+    *" backup "*)
+    \tdate +%s.%N >>"$PGBACKREST_BENCHMARK_STARTED"
+    \techo "INFO: backup command begin"
+    \tsleep "$PGBACKREST_BENCHMARK_SECONDS"
+    \techo "INFO: backup command end: completed successfully"
+    \t;;
+    esac
+''')
+
+
+def write_info(f, backups):
+    """Writes a pgBackRest info document of a stanza with the given number of backups, a full every 7 backups"""
+    f.write('[{"name": "bench", "status": {"code": 0, "message": "ok"}, "backup": [')
+    for i in range(backups):
+        full = i - i % 7
+        backup = {'label': '{0}F'.format(full) if i == full else '{0}F_{1}I'.format(full, i),
+                  'type': 'full' if i == full else 'incr', 'reference': None if i == full else ['{0}F'.format(full)],
+                  'timestamp': {'start': 1600000000 + i * 3600, 'stop': 1600000000 + i * 3600 + 60},
+                  'info': {'size': 1 << 30, 'delta': 1 << 28, 'repository': {'size': 1 << 27, 'delta': 1 << 26}},
+                  'archive': {'start': '00000001{0:016X}'.format(2 * i), 'stop': '00000001{0:016X}'.format(2 * i + 1)},
+                  'database': {'id': 1, 'repo-key': 1}, 'error': False, 'lsn': {'start': '0/1', 'stop': '0/2'}}
+        f.write((', ' if i else '') + json.dumps(backup))
+    f.write(']}]')
+
+
+def load_script(script):
+    """Imports the sidecar, it is a script with a dash in its name, so it can not be imported the usual way"""
+    spec = importlib.util.spec_from_file_location('pgbackrest_rest', script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(function, repeat):
+    """Returns the median duration of the function, in microseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1000000
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Sidecar ():
+    """Runs the sidecar against the fake pgbackrest in a scratch directory"""
+
+    def __init__(self, script, args=(), backups=0, backup_seconds=0):
+        self.scratch = tempfile.mkdtemp()
+        self.started_file = os.path.join(self.scratch, 'started')
+        fake = os.path.join(self.scratch, 'pgbackrest')
+        with open(fake, 'w') as f:
+            f.write(FAKE_PGBACKREST)
+        os.chmod(fake, 0o755)
+        info = os.path.join(self.scratch, 'info.json')
+        with open(info, 'w') as f:
+            write_info(f, backups)
+
+        self.port = free_port()
+        env = dict(os.environ, PATH=self.scratch + os.pathsep + os.environ.get('PATH', ''),
+                   PGBACKREST_BENCHMARK_INFO=info, PGBACKREST_BENCHMARK_SECONDS=str(backup_seconds),
+                   PGBACKREST_BENCHMARK_STARTED=self.started_file)
+        env.pop('PGBACKREST_CONFIG', None)
+        self.log = open(os.path.join(self.scratch, 'sidecar.log'), 'w+')
+        self.process = subprocess.Popen([sys.executable, script, '--stanza=bench', '--port={0}'.format(self.port),
+                                         '--loglevel=warning', '--progress-interval=0'] + list(args),
+                                        stdout=self.log, stderr=subprocess.STDOUT, env=env)
+
+        deadline = time.monotonic() + 10
+        while self.request('GET', '/status')[0] != 200:
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.close()
+                raise RuntimeError('The sidecar did not start')
+            time.sleep(0.05)
+
+    def request(self, method, path, body=None):
+        """Returns the status and the body of the response, status is None if the connection failed"""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            connection.request(method, path, body=json.dumps(body) if body is not None else None)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except OSError:
+            return None, None
+        finally:
+            connection.close()
+
+    def timed_request(self, method, path, body=None):
+        start = time.monotonic()
+        status, _ = self.request(method, path, body)
+        if status != 200:
+            raise RuntimeError('{0} {1} answered {2}'.format(method, path, status))
+        return time.monotonic() - start
+
+    def wait_for_history(self, backups):
+        deadline = time.monotonic() + 60
+        while len(json.loads(self.request('GET', '/backups')[1] or '[]')) < backups:
+            if time.monotonic() > deadline:
+                raise RuntimeError('The history was not refreshed')
+            time.sleep(0.1)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.log.seek(0)
+        output = self.log.read()
+        self.log.close()
+        shutil.rmtree(self.scratch)
+        return output
+
+
+def slow_post(port, seconds, stop):
+    """Keeps a POST /backups in flight, by sending its body over the given number of seconds"""
+    body = json.dumps({'type': 'incr'}).encode('utf-8')
+    while not stop.is_set():
+        with socket.create_connection(('127.0.0.1', port), timeout=30) as s:
+            s.sendall('POST /backups HTTP/1.1\r\nHost: bench\r\nContent-Length: {0}\r\n\r\n'.format(len(body)).encode('ascii'))
+            for i in range(len(body)):
+                s.sendall(body[i:i + 1])
+                time.sleep(seconds / len(body))
+            while s.recv(65536):
+                pass
+
+
+def benchmark_load(args):
+    sidecar = Sidecar(args.script, ['--max-requests={0}'.format(args.max_requests)], backups=args.backups,
+                      backup_seconds=3600)
+    try:
+        sidecar.wait_for_history(args.backups)
+        idle = [sidecar.timed_request('GET', '/backups?limit=100') for _ in range(args.requests)]
+
+        stop = threading.Event()
+        posts = [threading.Thread(target=slow_post, args=(sidecar.port, 1, stop), daemon=True)
+                 for _ in range(args.max_requests - 2)]
+        for t in posts:
+            t.start()
+        # Give all clients the time to connect
+        time.sleep(0.5)
+        loaded = [sidecar.timed_request('GET', '/backups?limit=100') for _ in range(args.requests)]
+        stop.set()
+    finally:
+        sidecar.close()
+
+    idle_p99, loaded_p99 = percentile(idle, 0.99) * 1000, percentile(loaded, 0.99) * 1000
+    print('load: GET /backups?limit=100 of {0} backups, {1} requests: idle median {2:.1f}ms p99 {3:.1f}ms, '
+          'with {4} POSTs in flight median {5:.1f}ms p99 {6:.1f}ms'.format(
+              args.backups, args.requests, statistics.median(idle) * 1000, idle_p99, len(posts),
+              statistics.median(loaded) * 1000, loaded_p99))
+
+    return loaded_p99 <= args.max_ms
+
+
+def benchmark_history(args):
+    rest = load_script(args.script)
+    epoch = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    statuses = ('FINISHED', 'FINISHED', 'FINISHED', 'ERROR')
+
+    results = {}
+    for size in args.sizes:
+        history = rest.BackupHistory()
+        infos = []
+        start = time.perf_counter()
+        for i in range(size):
+            backup = rest.PostgreSQLBackup(stanza='bench', status=statuses[i % len(statuses)],
+                                           started=epoch + datetime.timedelta(hours=i))
+            backup.pgbackrest_info = {'label': '{0}F'.format(i), 'timestamp': {'start': 0, 'stop': 0}}
+            infos.append(dict(backup.pgbackrest_info))
+            history.add(backup)
+        add = (time.perf_counter() - start) / size * 1000000
+
+        middle = history.labels()[size // 2]
+        running = history.get(middle)
+        results[size] = {
+            'add': add,
+            'labels(limit=100)': timed(lambda: history.labels(limit=100), args.repeat),
+            'labels(after, limit=100)': timed(lambda: history.labels(after=middle, limit=100), args.repeat),
+            'labels(statuses, since, limit=100)': timed(lambda: history.labels(statuses=['FINISHED', 'ERROR'], since=middle,
+                                                                             limit=100), args.repeat),
+            'latest(statuses)': timed(lambda: history.latest(['ERROR']), args.repeat),
+            'get(pgBackRest label)': timed(lambda: history.get('{0}F'.format(size // 2)), args.repeat),
+            'update(status)': timed(lambda: running.update(status='RUNNING' if running.status == 'FINISHED' else 'FINISHED'),
+                                    args.repeat),
+            'reconcile(unchanged)': timed(lambda: history.reconcile('bench', infos), 3),
+        }
+
+    print('history: median microseconds per call, {0} history'.format(' / '.join(str(s) for s in args.sizes)))
+    for operation in results[args.sizes[0]]:
+        print('  {0:<36} {1}'.format(operation, ' / '.join('{0:.1f}'.format(results[s][operation]) for s in args.sizes)))
+
+    # Apart from reconcile, which compares every backup pgBackRest reports, none of the operations
+    # should depend on the size of the history; we allow for noise and the log n of bisect
+    smallest, largest = results[min(args.sizes)], results[max(args.sizes)]
+    return all(largest[op] <= max(smallest[op] * args.max_ratio, 50) for op in largest if op != 'reconcile(unchanged)')
+
+
+def peak_memory(function):
+    """Returns the peak memory allocated while running the function, in MB"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_memory(args):
+    rest = load_script(args.script)
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as f:
+        write_info(f, args.backups)
+        size = f.tell() / 1024 / 1024
+
+        def stream():
+            f.seek(0)
+            for key, value in rest.JSONStreamParser(f):
+                pass
+
+        def load():
+            f.seek(0)
+            json.load(f)
+
+        streaming, loading = peak_memory(stream), peak_memory(load)
+
+    print('memory: peak while parsing a {0:.1f}MB info document of {1} backups: streaming {2:.1f}MB, json.load {3:.1f}MB'.format(
+        size, args.backups, streaming, loading))
+
+    return streaming <= args.max_mb
+
+
+def benchmark_latency(args):
+    sidecar = Sidecar(args.script)
+    try:
+        triggers = []
+        for run in range(args.runs):
+            start = time.time()
+            status, body = sidecar.request('POST', '/backups', {'type': 'full'})
+            backup = json.loads(body)
+            while backup['status'] not in ('FINISHED', 'ERROR'):
+                status, body = sidecar.request('GET', '/backups/backup/{0}?wait=10'.format(backup['label']))
+                backup = json.loads(body)
+            with open(sidecar.started_file) as f:
+                triggers.append(float(f.read().split()[run]) - start)
+    finally:
+        sidecar.close()
+
+    shutdowns = []
+    for _ in range(args.shutdowns):
+        sidecar = Sidecar(args.script)
+        try:
+            start = time.monotonic()
+            sidecar.process.send_signal(signal.SIGTERM)
+            sidecar.process.wait(timeout=30)
+            shutdowns.append(time.monotonic() - start)
+        finally:
+            sidecar.close()
+
+    trigger, shutdown = statistics.median(triggers) * 1000, statistics.median(shutdowns) * 1000
+    print('latency: POST /backups to pgbackrest backup median {0:.1f}ms (max {1:.1f}ms) over {2} backups, '
+          'SIGTERM to exit median {3:.1f}ms (max {4:.1f}ms) over {5} runs'.format(
+              trigger, max(triggers) * 1000, len(triggers), shutdown, max(shutdowns) * 1000, len(shutdowns)))
+
+    return trigger <= args.max_trigger_ms and shutdown <= args.max_shutdown_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the pgBackRest api')
+    parser.add_argument('--script', help='the pgbackrest-rest.py to benchmark', default=SCRIPT)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    load = subparsers.add_parser('load', help='GET latency while POSTs are in flight')
+    load.add_argument('--backups', type=int, default=1000)
+    load.add_argument('--requests', type=int, default=200)
+    load.add_argument('--max-requests', type=int, default=16)
+    load.add_argument('--max-ms', type=float, default=250, help='the maximum p99 of the GETs while POSTs are in flight')
+    load.set_defaults(function=benchmark_load)
+
+    history = subparsers.add_parser('history', help='the cost of the BackupHistory operations')
+    history.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    history.add_argument('--repeat', type=int, default=1000)
+    history.add_argument('--max-ratio', type=float, default=3, help='the maximum slowdown of the largest history')
+    history.set_defaults(function=benchmark_history)
+
+    memory = subparsers.add_parser('memory', help='the memory used to parse a large info document')
+    memory.add_argument('--backups', type=int, default=100000)
+    memory.add_argument('--max-mb', type=float, default=4, help='the maximum peak of the streaming parser')
+    memory.set_defaults(function=benchmark_memory)
+
+    latency = subparsers.add_parser('latency', help='the time it takes to start a backup and to shut down')
+    latency.add_argument('--runs', type=int, default=20)
+    latency.add_argument('--shutdowns', type=int, default=5)
+    latency.add_argument('--max-trigger-ms', type=float, default=100, help='the maximum median from POST to pgbackrest')
+    latency.add_argument('--max-shutdown-ms', type=float, default=500, help='the maximum median from SIGTERM to exit')
+    latency.set_defaults(function=benchmark_latency)
+
+    args = parser.parse_args()
+    if not args.function(args):
+        print('ERROR: the {0} benchmark exceeds its threshold'.format(args.benchmark), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
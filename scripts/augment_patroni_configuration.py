@@ -5,6 +5,9 @@ This is a hack to get around Issue: https://github.com/zalando/postgres-operator
 
 This script will be deprecated as soon as we configure Patroni fully from k8s. Until that time
 the configure_spilo.py script is used, with its valuable output and its quirks.
+
+configure_spilo.py applies augment() itself when it writes the Patroni configuration, running this
+script on its output is still supported, but no longer needed.
 """
 import yaml
 import os
@@ -48,33 +51,45 @@ def merge(source, destination):
     return destination
 
 
+def augment(spilo_generated_configuration, operator_generated_configuration):
+    """Augments the configuration generated by configure_spilo.py
+
+    Not all postgresql parameters that are set in the SPILO_CONFIGURATION environment variables
+    are overridden by the configure_spilo.py script.
+
+    Therefore, what we do is:
+
+    1. We run configure_spilo.py to generate a sane configuration
+    2. We override that configuration with our sane TSDB_DEFAULTS
+    3. We override that configuration with our explicitly passed on settings
+
+    configure_spilo.py calls this function itself before writing the configuration"""
+    tsdb_defaults = yaml.safe_load(TSDB_DEFAULTS) or {}
+
+    final_configuration = merge(operator_generated_configuration, merge(tsdb_defaults, spilo_generated_configuration))
+
+    # This namespace used in etcd/consul
+    # Other provisions are also available, but this ensures no naming collisions
+    # for deployments in separate Kubernetes Namespaces will occur
+    # https://github.com/zalando/patroni/blob/master/docs/ENVIRONMENT.rst#globaluniversal
+    if 'etcd' in final_configuration and os.getenv('POD_NAMESPACE'):
+        final_configuration['namespace'] = os.getenv('POD_NAMESPACE')
+
+    return final_configuration
+
+
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print("Usage: {0} <patroni.yaml>".format(sys.argv[0]))
         sys.exit(2)
-    with open(sys.argv[1], 'r+') as f:
-        # Not all postgresql parameters that are set in the SPILO_CONFIGURATION environment variables
-        # are overridden by the configure_spilo.py script.
-        #
-        # Therefore, what we do is:
-        #
-        # 1. We run configure_spilo.py to generate a sane configuration
-        # 2. We override that configuration with our sane TSDB_DEFAULTS
-        # 3. We override that configuration with our explicitly passed on settings
-
-        tsdb_defaults = yaml.safe_load(TSDB_DEFAULTS) or {}
+    with open(sys.argv[1]) as f:
         spilo_generated_configuration = yaml.safe_load(f) or {}
-        operator_generated_configuration = yaml.safe_load(os.environ.get('SPILO_CONFIGURATION', '{}')) or {}
-
-        final_configuration = merge(operator_generated_configuration, merge(tsdb_defaults, spilo_generated_configuration))
+    operator_generated_configuration = yaml.safe_load(os.environ.get('SPILO_CONFIGURATION', '{}')) or {}
 
-        # This namespace used in etcd/consul
-        # Other provisions are also available, but this ensures no naming collisions
-        # for deployments in separate Kubernetes Namespaces will occur
-        # https://github.com/zalando/patroni/blob/master/docs/ENVIRONMENT.rst#globaluniversal
-        if 'etcd' in final_configuration and os.getenv('POD_NAMESPACE'):
-            final_configuration['namespace'] = os.getenv('POD_NAMESPACE')
+    final_configuration = augment(spilo_generated_configuration, operator_generated_configuration)
 
-        f.seek(0)
+    # We write a temporary file and rename it, so Patroni never reads a partially written configuration
+    tmp = '{0}.{1}'.format(sys.argv[1], os.getpid())
+    with open(tmp, 'w') as f:
         yaml.dump(final_configuration, f, default_flow_style=False)
-        f.truncate()
+    os.rename(tmp, sys.argv[1])
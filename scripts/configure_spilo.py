@@ -15,27 +15,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-# This file was copied, without modifications from:
+# This file was originally copied from:
 #
 # https://github.com/zalando/spilo/blob/1.6-p1/postgres-appliance/scripts/configure_spilo.py
 
 import argparse
+import hashlib
+import importlib
 import json
 import logging
 import re
 import os
-import psutil
 import socket
 import subprocess
 import sys
+import threading
+import time
 
+from contextlib import contextmanager
 from copy import deepcopy
-from six.moves.urllib_parse import urlparse
 from collections import defaultdict
 
-import yaml
-import pystache
-import requests
+import pg_sizing
+
+# The third party modules (requests, yaml, six) are imported by the functions that need
+# them using lazy_import, as many sections never need them, and this script is on the critical
+# path of every container start
 
 
 PROVIDER_AWS = "aws"
@@ -45,7 +50,16 @@ PROVIDER_LOCAL = "local"
 PROVIDER_UNSUPPORTED = "unsupported"
 USE_KUBERNETES = os.environ.get('KUBERNETES_SERVICE_HOST') is not None
 KUBERNETES_DEFAULT_LABELS = '{"application": "spilo"}'
-MEMORY_LIMIT_IN_BYTES_PATH = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+METADATA_URL = 'http://169.254.169.254'
+# The total time we allow the metadata services to answer, before assuming a local setup
+PROVIDER_PROBE_DEADLINE = float(os.environ.get('SPILO_PROVIDER_DEADLINE', 1))
+# The provider is cached on the data volume, so it survives restarts of the container
+PROVIDER_CACHE_FILE = os.environ.get('SPILO_PROVIDER_CACHE', os.path.join(os.path.dirname(os.environ['PGDATA']), '.spilo_provider')
+                                     if os.environ.get('PGDATA') else '')
+PROVIDER_CACHE_TTL = int(os.environ.get('SPILO_PROVIDER_CACHE_TTL', 86400))
+# If set, the placeholders and the Patroni configuration are cached in this file, and reused as long as the
+# fingerprint of everything they depend on does not change. The file contains secrets, it is only readable by us.
+CONFIG_CACHE_FILE = os.environ.get('SPILO_CONFIG_CACHE', '')
 
 
 # (min_version, max_version, shared_preload_libraries, extwlist.extensions)
@@ -60,6 +74,44 @@ extensions = {
 
 AUTO_ENABLE_WALG_RESTORE = ('WAL_S3_BUCKET', 'WALE_S3_PREFIX', 'WALG_S3_PREFIX')
 
+# The time it took to import the lazily imported modules, reported by --profile-startup
+import_times = {}
+
+
+def lazy_import(name):
+    """Imports a module the first time it is needed"""
+    if name not in sys.modules:
+        start = time.time()
+        importlib.import_module(name)
+        import_times[name] = time.time() - start
+    return sys.modules[name]
+
+
+class StartupProfile(object):
+    """Measures the time spent in every step of the configuration, reported by --profile-startup"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.time()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.time() - start))
+
+    def report(self):
+        if not self.enabled:
+            return
+        for name, duration in sorted(import_times.items()):
+            logging.info('Startup profile: import %-23s %7.3fs', name, duration)
+        for name, duration in self.steps:
+            logging.info('Startup profile: %-30s %7.3fs', name, duration)
+        logging.info('Startup profile: %-30s %7.3fs', 'total', time.time() - self.started)
+
 
 def parse_args():
     sections = ['all', 'patroni', 'patronictl', 'certificate', 'wal-e', 'crontab',
@@ -72,6 +124,9 @@ def parse_args():
                       help='Which section to (re)configure')
     argp.add_argument('-l', '--loglevel', type=str, help='Explicitly set loglevel')
     argp.add_argument('-f', '--force', help='Overwrite files if they exist', default=False, action='store_true')
+    argp.add_argument('--invalidate-cache', help='Regenerate the configuration cached in $SPILO_CONFIG_CACHE',
+                      default=False, action='store_true')
+    argp.add_argument('--profile-startup', help='Report the time spent in every step', default=False, action='store_true')
 
     args = vars(argp.parse_args())
 
@@ -83,11 +138,109 @@ def parse_args():
     return args
 
 
+OPENSSL = '/usr/bin/openssl'
+# Arguments passed to `openssl req` to generate the private key of the dummy certificate. Elliptic curve keys
+# take a few milliseconds to generate, whereas a 2048 bit RSA key takes a sizeable part of a second
+DUMMY_KEY_TYPES = {
+    'ec': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+    'rsa': ['-newkey', 'rsa:2048'],
+}
+# Dummy certificates expiring within this many seconds are regenerated
+CERTIFICATE_MIN_VALIDITY = 86400
+# The subject of the dummy certificates, only these are ever replaced without --force
+DUMMY_CERTIFICATE_CN = 'spilo.dummy.org'
+
+
+def certificate_is_valid(certificate, min_validity=CERTIFICATE_MIN_VALIDITY):
+    """Checks that the PEM encoded certificate does not expire within min_validity seconds"""
+    p = subprocess.Popen([OPENSSL, 'x509', '-noout', '-checkend', str(min_validity)], shell=False,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = p.communicate(certificate.encode('utf-8'))
+    logging.debug(output)
+    return p.returncode == 0
+
+
+def is_dummy_certificate(certificate):
+    """Checks whether the PEM encoded certificate is one we generated ourselves"""
+    p = subprocess.Popen([OPENSSL, 'x509', '-noout', '-subject'], shell=False,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = p.communicate(certificate.encode('utf-8'))
+    # Depending on the version, openssl prints the subject as CN = spilo.dummy.org or /CN=spilo.dummy.org
+    return p.returncode == 0 and re.search(r'CN\s*=\s*' + re.escape(DUMMY_CERTIFICATE_CN) + r'\s*$',
+                                           output.decode('utf-8', 'replace'), re.M) is not None
+
+
+def write_private_key(private_key, filename):
+    """Writes the private key to a file that is only ever readable by us, and renames it into place"""
+    tmp = '{0}.{1}'.format(filename, os.getpid())
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        logging.info('Writing to file %s', filename)
+        f.write(private_key)
+    os.rename(tmp, filename)
+
+
+def certificate_fingerprint(certificate, private_key):
+    return hashlib.sha256((certificate + private_key).encode('utf-8')).hexdigest()
+
+
+def read_certificate_cache(filename):
+    """Returns the (certificate, private_key) stored in the cache, if it is intact and still valid"""
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        certificate, private_key = cache['certificate'], cache['private_key']
+        if cache['sha256'] != certificate_fingerprint(certificate, private_key):
+            logging.warning('Fingerprint of the cached certificate in %s does not match, ignoring it', filename)
+        elif not certificate_is_valid(certificate):
+            logging.info('Cached certificate in %s is about to expire, ignoring it', filename)
+        else:
+            return certificate, private_key
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return None
+
+
+def write_certificate_cache(filename, certificate, private_key):
+    try:
+        tmp = '{0}.{1}'.format(filename, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'certificate': certificate, 'private_key': private_key,
+                       'sha256': certificate_fingerprint(certificate, private_key)}, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logging.warning('Could not cache the certificate in %s: %s', filename, e)
+
+
+def generate_dummy_certificate(environment):
+    key_type = environment.get('SSL_DUMMY_KEY_TYPE', 'ec')
+    if key_type not in DUMMY_KEY_TYPES:
+        logging.warning('Unknown SSL_DUMMY_KEY_TYPE %s, using ec', key_type)
+        key_type = 'ec'
+    openssl_cmd = [OPENSSL, 'req', '-nodes', '-new', '-x509'] + DUMMY_KEY_TYPES[key_type] + [
+        '-days',
+        str(environment.get('SSL_DUMMY_CERTIFICATE_DAYS', 3650)),
+        '-subj',
+        '/CN=' + DUMMY_CERTIFICATE_CN,
+        '-keyout',
+        environment['SSL_PRIVATE_KEY_FILE'],
+        '-out',
+        environment['SSL_CERTIFICATE_FILE'],
+    ]
+    logging.info('Generating ssl certificate')
+    p = subprocess.Popen(openssl_cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = p.communicate()
+    logging.debug(output)
+
+
 def write_certificates(environment, overwrite):
     """Write SSL certificate to files
 
     If certificates are specified, they are written, otherwise
-    dummy certificates are generated and written"""
+    dummy certificates are generated and written. An existing private key is
+    never overwritten, unless its certificate is a dummy one we generated that is
+    missing or about to expire. If SSL_DUMMY_CERTIFICATE_CACHE
+    points to a file on a shared volume, the dummy certificate is taken from
+    (or stored into) that file, so all containers share one certificate"""
 
     ssl_keys = ['SSL_CERTIFICATE', 'SSL_PRIVATE_KEY']
     if set(ssl_keys) <= set(environment):
@@ -95,25 +248,28 @@ def write_certificates(environment, overwrite):
             write_file(environment[k], environment[k + '_FILE'], overwrite)
     else:
         if os.path.exists(environment['SSL_PRIVATE_KEY_FILE']) and not overwrite:
-            logging.warning('Private key already exists, not overwriting. (Use option --force if necessary)')
-            return
-        openssl_cmd = [
-            '/usr/bin/openssl',
-            'req',
-            '-nodes',
-            '-new',
-            '-x509',
-            '-subj',
-            '/CN=spilo.dummy.org',
-            '-keyout',
-            environment['SSL_PRIVATE_KEY_FILE'],
-            '-out',
-            environment['SSL_CERTIFICATE_FILE'],
-        ]
-        logging.info('Generating ssl certificate')
-        p = subprocess.Popen(openssl_cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        output, _ = p.communicate()
-        logging.debug(output)
+            try:
+                with open(environment['SSL_CERTIFICATE_FILE']) as f:
+                    certificate = f.read()
+            except (IOError, OSError):
+                certificate = None
+            # A certificate that was mounted by an operator is never touched
+            if not certificate or not is_dummy_certificate(certificate) or certificate_is_valid(certificate):
+                logging.warning('Private key already exists, not overwriting. (Use option --force if necessary)')
+                return
+            logging.info('Dummy certificate %s is about to expire', environment['SSL_CERTIFICATE_FILE'])
+
+        cache_file = environment.get('SSL_DUMMY_CERTIFICATE_CACHE')
+        cached = cache_file and read_certificate_cache(cache_file)
+        if cached:
+            logging.info('Using the cached ssl certificate from %s', cache_file)
+            write_file(cached[0], environment['SSL_CERTIFICATE_FILE'], True, atomic=True)
+            write_private_key(cached[1], environment['SSL_PRIVATE_KEY_FILE'])
+        else:
+            generate_dummy_certificate(environment)
+            if cache_file:
+                with open(environment['SSL_CERTIFICATE_FILE']) as c, open(environment['SSL_PRIVATE_KEY_FILE']) as k:
+                    write_certificate_cache(cache_file, c.read(), k.read())
 
     uid = os.stat(environment['PGHOME']).st_uid
     os.chmod(environment['SSL_PRIVATE_KEY_FILE'], 0o600)
@@ -140,186 +296,307 @@ def deep_update(a, b):
     return a if a is not None else b
 
 
-TEMPLATE = \
-    '''
-bootstrap:
-  post_init: /scripts/post_init.sh "{{HUMAN_ROLE}}"
-  dcs:
-    {{#STANDBY_CLUSTER}}
-    standby_cluster:
-      create_replica_methods:
-      {{#STANDBY_WITH_WALE}}
-      - bootstrap_standby_with_wale
-      {{/STANDBY_WITH_WALE}}
-      - basebackup_fast_xlog
-      {{#STANDBY_WITH_WALE}}
-      restore_command: envdir "{{STANDBY_WALE_ENV_DIR}}" /scripts/restore_command.sh "%f" "%p"
-      {{/STANDBY_WITH_WALE}}
-      {{#STANDBY_HOST}}
-      host: {{STANDBY_HOST}}
-      {{/STANDBY_HOST}}
-      {{#STANDBY_PORT}}
-      port: {{STANDBY_PORT}}
-      {{/STANDBY_PORT}}
-    {{/STANDBY_CLUSTER}}
-    ttl: 30
-    loop_wait: &loop_wait 10
-    retry_timeout: 10
-    maximum_lag_on_failover: 33554432
-    postgresql:
-      use_pg_rewind: true
-      use_slots: true
-      parameters:
-        archive_mode: "on"
-        archive_timeout: 1800s
-        wal_level: hot_standby
-        wal_keep_segments: 8
-        wal_log_hints: 'on'
-        max_wal_senders: 5
-        max_connections: {{postgresql.parameters.max_connections}}
-        max_replication_slots: 5
-        hot_standby: 'on'
-        tcp_keepalives_idle: 900
-        tcp_keepalives_interval: 100
-        log_line_prefix: '%t [%p]: [%l-1] %c %x %d %u %a %h '
-        log_checkpoints: 'on'
-        log_lock_waits: 'on'
-        log_min_duration_statement: 500
-        log_autovacuum_min_duration: 0
-        log_connections: 'on'
-        log_disconnections: 'on'
-        log_statement: 'ddl'
-        log_temp_files: 0
-        track_functions: all
-        checkpoint_completion_target: 0.9
-        autovacuum_max_workers: 5
-        autovacuum_vacuum_scale_factor: 0.05
-        autovacuum_analyze_scale_factor: 0.02
-  {{#CLONE_WITH_WALE}}
-  method: clone_with_wale
-  clone_with_wale:
-    command: envdir "{{CLONE_WALE_ENV_DIR}}" python3 /scripts/clone_with_wale.py --recovery-target-time="{{CLONE_TARGET_TIME}}"
-    recovery_conf:
-        restore_command: envdir "{{CLONE_WALE_ENV_DIR}}" /scripts/restore_command.sh "%f" "%p"
-        recovery_target_timeline: latest
-        {{#USE_PAUSE_AT_RECOVERY_TARGET}}
-        recovery_target_action: pause
-        {{/USE_PAUSE_AT_RECOVERY_TARGET}}
-        {{^USE_PAUSE_AT_RECOVERY_TARGET}}
-        recovery_target_action: promote
-        {{/USE_PAUSE_AT_RECOVERY_TARGET}}
-        {{#CLONE_TARGET_TIME}}
-        recovery_target_time: "{{CLONE_TARGET_TIME}}"
-        {{/CLONE_TARGET_TIME}}
-        {{^CLONE_TARGET_INCLUSIVE}}
-        recovery_target_inclusive: false
-        {{/CLONE_TARGET_INCLUSIVE}}
-  {{/CLONE_WITH_WALE}}
-  {{#CLONE_WITH_BASEBACKUP}}
-  method: clone_with_basebackup
-  clone_with_basebackup:
-    command: python3 /scripts/clone_with_basebackup.py --pgpass={{CLONE_PGPASS}} --host={{CLONE_HOST}} --port={{CLONE_PORT}} --user="{{CLONE_USER}}"
-  {{/CLONE_WITH_BASEBACKUP}}
-  initdb:
-    - encoding: UTF8
-    - locale: en_US.UTF-8
-    - data-checksums
-  {{#USE_ADMIN}}
-  users:
-    {{PGUSER_ADMIN}}:
-      password: {{PGPASSWORD_ADMIN}}
-      options:
-        - createrole
-        - createdb
-  {{/USE_ADMIN}}
-scope: &scope '{{SCOPE}}'
-restapi:
-  listen: 0.0.0.0:{{APIPORT}}
-  connect_address: {{instance_data.ip}}:{{APIPORT}}
-postgresql:
-  use_unix_socket: true
-  name: '{{instance_data.id}}'
-  listen: 0.0.0.0:{{PGPORT}}
-  connect_address: {{instance_data.ip}}:{{PGPORT}}
-  data_dir: {{PGDATA}}
-  parameters:
-    archive_command: {{{postgresql.parameters.archive_command}}}
-    shared_buffers: {{postgresql.parameters.shared_buffers}}
-    logging_collector: 'on'
-    log_destination: csvlog
-    log_directory: ../pg_log
-    log_filename: 'postgresql-%u.log'
-    log_file_mode: '0644'
-    log_rotation_age: '1d'
-    log_truncate_on_rotation: 'on'
-    ssl: 'on'
-    ssl_cert_file: {{SSL_CERTIFICATE_FILE}}
-    ssl_key_file: {{SSL_PRIVATE_KEY_FILE}}
-    shared_preload_libraries: 'bg_mon,pg_stat_statements,pgextwlist,pg_auth_mon'
-    bg_mon.listen_address: '0.0.0.0'
-    pg_stat_statements.track_utility: 'off'
-    extwlist.extensions: 'btree_gin,btree_gist,citext,hstore,intarray,ltree,pgcrypto,pgq,pg_trgm,postgres_fdw,uuid-ossp,hypopg'
-    extwlist.custom_path: /scripts
-  pg_hba:
-    - local   all             all                                   trust
-    {{#PAM_OAUTH2}}
-    - hostssl all             +{{HUMAN_ROLE}}    127.0.0.1/32       pam
-    {{/PAM_OAUTH2}}
-    - host    all             all                127.0.0.1/32       md5
-    {{#PAM_OAUTH2}}
-    - hostssl all             +{{HUMAN_ROLE}}    ::1/128            pam
-    {{/PAM_OAUTH2}}
-    - host    all             all                ::1/128            md5
-    - hostssl replication     {{PGUSER_STANDBY}} all                md5
-    - hostnossl all           all                all                reject
-    {{#PAM_OAUTH2}}
-    - hostssl all             +{{HUMAN_ROLE}}    all                pam
-    {{/PAM_OAUTH2}}
-    - hostssl all             all                all                md5
-
-  {{#USE_WALE}}
-  recovery_conf:
-    restore_command: envdir "{{WALE_ENV_DIR}}" /scripts/restore_command.sh "%f" "%p"
-  {{/USE_WALE}}
-  authentication:
-    superuser:
-      username: {{PGUSER_SUPERUSER}}
-      password: '{{PGPASSWORD_SUPERUSER}}'
-    replication:
-      username: {{PGUSER_STANDBY}}
-      password: '{{PGPASSWORD_STANDBY}}'
-  callbacks:
-  {{#CALLBACK_SCRIPT}}
-    on_start: {{CALLBACK_SCRIPT}}
-    on_stop: {{CALLBACK_SCRIPT}}
-    on_role_change: '/scripts/on_role_change.sh {{HUMAN_ROLE}} {{CALLBACK_SCRIPT}}'
- {{/CALLBACK_SCRIPT}}
- {{^CALLBACK_SCRIPT}}
-    on_role_change: '/scripts/on_role_change.sh {{HUMAN_ROLE}} true'
- {{/CALLBACK_SCRIPT}}
-{{#USE_WALE}}
-  create_replica_method:
-    - wal_e
-    - basebackup_fast_xlog
-  wal_e:
-    command: envdir {{WALE_ENV_DIR}} bash /scripts/wale_restore.sh
-    threshold_megabytes: {{WALE_BACKUP_THRESHOLD_MEGABYTES}}
-    threshold_backup_size_percentage: {{WALE_BACKUP_THRESHOLD_PERCENTAGE}}
-    retries: 2
-    no_master: 1
-  basebackup_fast_xlog:
-    command: /scripts/basebackup.sh
-    retries: 2
-{{/USE_WALE}}
-{{#STANDBY_WITH_WALE}}
-  bootstrap_standby_with_wale:
-    command: envdir "{{STANDBY_WALE_ENV_DIR}}" bash /scripts/wale_restore.sh
-    threshold_megabytes: {{WALE_BACKUP_THRESHOLD_MEGABYTES}}
-    threshold_backup_size_percentage: {{WALE_BACKUP_THRESHOLD_PERCENTAGE}}
-    retries: 2
-    no_master: 1
-{{/STANDBY_WITH_WALE}}
-'''
+def yaml_int(value):
+    """Numbers coming from the environment are strings, the Patroni configuration needs them as numbers"""
+    return int(value) if str(value).isdigit() else value
+
+
+def build_patroni_config(placeholders):
+    """Builds the Patroni configuration from the placeholders
+
+    The values are used as is, so they never need escaping"""
+    p = placeholders
+    dcs_parameters = {
+        'archive_mode': 'on',
+        'archive_timeout': '1800s',
+        'wal_level': 'hot_standby',
+        'wal_keep_segments': 8,
+        'wal_log_hints': 'on',
+        'max_wal_senders': 5,
+        'max_replication_slots': 5,
+        'hot_standby': 'on',
+        'tcp_keepalives_idle': 900,
+        'tcp_keepalives_interval': 100,
+        'log_line_prefix': '%t [%p]: [%l-1] %c %x %d %u %a %h ',
+        'log_checkpoints': 'on',
+        'log_lock_waits': 'on',
+        'log_min_duration_statement': 500,
+        'log_autovacuum_min_duration': 0,
+        'log_connections': 'on',
+        'log_disconnections': 'on',
+        'log_statement': 'ddl',
+        'log_temp_files': 0,
+        'track_functions': 'all',
+        'checkpoint_completion_target': 0.9,
+        'autovacuum_max_workers': 5,
+        'autovacuum_vacuum_scale_factor': 0.05,
+        'autovacuum_analyze_scale_factor': 0.02,
+    }
+    bootstrap = {
+        'post_init': '/scripts/post_init.sh "{HUMAN_ROLE}"'.format(**p),
+        'dcs': {
+            'ttl': 30,
+            'loop_wait': 10,
+            'retry_timeout': 10,
+            'maximum_lag_on_failover': 33554432,
+            'postgresql': {'use_pg_rewind': True, 'use_slots': True, 'parameters': dcs_parameters},
+        },
+        'initdb': [{'encoding': 'UTF8'}, {'locale': 'en_US.UTF-8'}, 'data-checksums'],
+    }
+
+    if p.get('STANDBY_CLUSTER'):
+        standby_cluster = {'create_replica_methods': (['bootstrap_standby_with_wale'] if p.get('STANDBY_WITH_WALE')
+                                                      else []) + ['basebackup_fast_xlog']}
+        if p.get('STANDBY_WITH_WALE'):
+            standby_cluster['restore_command'] = \
+                'envdir "{STANDBY_WALE_ENV_DIR}" /scripts/restore_command.sh "%f" "%p"'.format(**p)
+        if p.get('STANDBY_HOST'):
+            standby_cluster['host'] = p['STANDBY_HOST']
+        if p.get('STANDBY_PORT'):
+            standby_cluster['port'] = yaml_int(p['STANDBY_PORT'])
+        bootstrap['dcs']['standby_cluster'] = standby_cluster
+
+    if p.get('CLONE_WITH_WALE'):
+        recovery_conf = {
+            'restore_command': 'envdir "{CLONE_WALE_ENV_DIR}" /scripts/restore_command.sh "%f" "%p"'.format(**p),
+            'recovery_target_timeline': 'latest',
+            'recovery_target_action': 'pause' if p.get('USE_PAUSE_AT_RECOVERY_TARGET') else 'promote',
+        }
+        if p.get('CLONE_TARGET_TIME'):
+            recovery_conf['recovery_target_time'] = p['CLONE_TARGET_TIME']
+        if not p.get('CLONE_TARGET_INCLUSIVE'):
+            recovery_conf['recovery_target_inclusive'] = False
+        bootstrap['method'] = 'clone_with_wale'
+        bootstrap['clone_with_wale'] = {
+            'command': ('envdir "{CLONE_WALE_ENV_DIR}" python3 /scripts/clone_with_wale.py '
+                        '--recovery-target-time="{CLONE_TARGET_TIME}"').format(**p),
+            'recovery_conf': recovery_conf,
+        }
+    if p.get('CLONE_WITH_BASEBACKUP'):
+        bootstrap['method'] = 'clone_with_basebackup'
+        bootstrap['clone_with_basebackup'] = {
+            'command': ('python3 /scripts/clone_with_basebackup.py --pgpass={CLONE_PGPASS} --host={CLONE_HOST} '
+                        '--port={CLONE_PORT} --user="{CLONE_USER}"').format(**p),
+        }
+
+    if p.get('USE_ADMIN'):
+        bootstrap['users'] = {p['PGUSER_ADMIN']: {'password': p['PGPASSWORD_ADMIN'],
+                                                  'options': ['createrole', 'createdb']}}
+
+    pam = bool(p.get('PAM_OAUTH2'))
+    pg_hba = ['local   all             all                                   trust'] + \
+        (['hostssl all             +{HUMAN_ROLE}    127.0.0.1/32       pam'.format(**p)] if pam else []) + \
+        ['host    all             all                127.0.0.1/32       md5'] + \
+        (['hostssl all             +{HUMAN_ROLE}    ::1/128            pam'.format(**p)] if pam else []) + \
+        ['host    all             all                ::1/128            md5',
+         'hostssl replication     {PGUSER_STANDBY} all                md5'.format(**p),
+         'hostnossl all           all                all                reject'] + \
+        (['hostssl all             +{HUMAN_ROLE}    all                pam'.format(**p)] if pam else []) + \
+        ['hostssl all             all                all                md5']
+
+    postgresql = {
+        'use_unix_socket': True,
+        'name': p['instance_data']['id'],
+        'listen': '0.0.0.0:{PGPORT}'.format(**p),
+        'connect_address': '{0}:{1}'.format(p['instance_data']['ip'], p['PGPORT']),
+        'data_dir': p['PGDATA'],
+        'parameters': {
+            'archive_command': p['postgresql']['parameters']['archive_command'],
+            'logging_collector': 'on',
+            'log_destination': 'csvlog',
+            'log_directory': '../pg_log',
+            'log_filename': 'postgresql-%u.log',
+            'log_file_mode': '0644',
+            'log_rotation_age': '1d',
+            'log_truncate_on_rotation': 'on',
+            'ssl': 'on',
+            'ssl_cert_file': p['SSL_CERTIFICATE_FILE'],
+            'ssl_key_file': p['SSL_PRIVATE_KEY_FILE'],
+            'shared_preload_libraries': 'bg_mon,pg_stat_statements,pgextwlist,pg_auth_mon',
+            'bg_mon.listen_address': '0.0.0.0',
+            'pg_stat_statements.track_utility': 'off',
+            'extwlist.extensions': 'btree_gin,btree_gist,citext,hstore,intarray,ltree,pgcrypto,pgq,pg_trgm,'
+                                   'postgres_fdw,uuid-ossp,hypopg',
+            'extwlist.custom_path': '/scripts',
+        },
+        'pg_hba': pg_hba,
+        'authentication': {
+            'superuser': {'username': p['PGUSER_SUPERUSER'], 'password': p['PGPASSWORD_SUPERUSER']},
+            'replication': {'username': p['PGUSER_STANDBY'], 'password': p['PGPASSWORD_STANDBY']},
+        },
+    }
+
+    if p.get('CALLBACK_SCRIPT'):
+        postgresql['callbacks'] = {
+            'on_start': p['CALLBACK_SCRIPT'],
+            'on_stop': p['CALLBACK_SCRIPT'],
+            'on_role_change': '/scripts/on_role_change.sh {HUMAN_ROLE} {CALLBACK_SCRIPT}'.format(**p),
+        }
+    else:
+        postgresql['callbacks'] = {'on_role_change': '/scripts/on_role_change.sh {HUMAN_ROLE} true'.format(**p)}
+
+    if p.get('USE_WALE'):
+        postgresql['recovery_conf'] = {
+            'restore_command': 'envdir "{WALE_ENV_DIR}" /scripts/restore_command.sh "%f" "%p"'.format(**p),
+        }
+        postgresql['create_replica_method'] = ['wal_e', 'basebackup_fast_xlog']
+        postgresql['wal_e'] = {
+            'command': 'envdir {WALE_ENV_DIR} bash /scripts/wale_restore.sh'.format(**p),
+            'threshold_megabytes': yaml_int(p['WALE_BACKUP_THRESHOLD_MEGABYTES']),
+            'threshold_backup_size_percentage': yaml_int(p['WALE_BACKUP_THRESHOLD_PERCENTAGE']),
+            'retries': 2,
+            'no_master': 1,
+        }
+        postgresql['basebackup_fast_xlog'] = {'command': '/scripts/basebackup.sh', 'retries': 2}
+    if p.get('STANDBY_WITH_WALE'):
+        postgresql['bootstrap_standby_with_wale'] = {
+            'command': 'envdir "{STANDBY_WALE_ENV_DIR}" bash /scripts/wale_restore.sh'.format(**p),
+            'threshold_megabytes': yaml_int(p['WALE_BACKUP_THRESHOLD_MEGABYTES']),
+            'threshold_backup_size_percentage': yaml_int(p['WALE_BACKUP_THRESHOLD_PERCENTAGE']),
+            'retries': 2,
+            'no_master': 1,
+        }
+
+    return {
+        'bootstrap': bootstrap,
+        'scope': p['SCOPE'],
+        'restapi': {
+            'listen': '0.0.0.0:{APIPORT}'.format(**p),
+            'connect_address': '{0}:{1}'.format(p['instance_data']['ip'], p['APIPORT']),
+        },
+        'postgresql': postgresql,
+    }
+
+
+def probe_provider(deadline):
+    """Probes the metadata services of all the providers concurrently
+
+    The first conclusive answer wins. Google and Openstack are identified by a single answer,
+    the AWS metadata is accessible on Openstack as well, so AWS only wins once Openstack has
+    been ruled out. If nothing answers within the deadline, we assume a local setup.
+
+    Returns the provider and whether that is conclusive: it is not if we ran out of time before
+    all the probes that could still change the outcome had answered."""
+    requests = lazy_import('requests')
+    queue = lazy_import('six.moves.queue')
+    probes = {
+        PROVIDER_GOOGLE: lambda: requests.get(METADATA_URL, timeout=deadline).headers.get('Metadata-Flavor', '') == 'Google',
+        PROVIDER_OPENSTACK: lambda: requests.get(METADATA_URL + '/openstack/latest/meta_data.json', timeout=deadline).ok,
+        PROVIDER_AWS: lambda: requests.get(METADATA_URL + '/latest/meta-data/ami-id', timeout=deadline).ok
+    }
+    answers = queue.Queue()
+
+    def probe(provider, check):
+        try:
+            answers.put((provider, check()))
+        except requests.exceptions.Timeout:
+            pass  # no answer at all, just like a probe that is still waiting when the deadline passes
+        except requests.exceptions.RequestException:
+            answers.put((provider, None))
+
+    # The threads are daemons, so a probe that is still waiting never delays our exit
+    for provider, check in probes.items():
+        threading.Thread(target=probe, args=(provider, check), daemon=True).start()
+
+    results = {}
+    end = time.time() + deadline
+    while len(results) < len(probes):
+        try:
+            provider, result = answers.get(timeout=max(end - time.time(), 0))
+        except queue.Empty:
+            break
+        results[provider] = result
+
+        if results.get(PROVIDER_GOOGLE):
+            return PROVIDER_GOOGLE, True
+        if results.get(PROVIDER_OPENSTACK):
+            return PROVIDER_OPENSTACK, True
+        if results.get(PROVIDER_AWS) and PROVIDER_OPENSTACK in results:
+            return PROVIDER_AWS, True
+
+    conclusive = len(results) == len(probes)
+    if results.get(PROVIDER_AWS):
+        return PROVIDER_AWS, conclusive
+    if any(result is not None for result in results.values()):
+        return PROVIDER_UNSUPPORTED, conclusive
+
+    logging.info("Could not connect to %s, assuming local Docker setup", METADATA_URL)
+    return PROVIDER_LOCAL, conclusive
+
+
+def read_provider_cache(filename, ttl):
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        if cache['provider'] in {PROVIDER_AWS, PROVIDER_GOOGLE, PROVIDER_OPENSTACK, PROVIDER_LOCAL} \
+                and 0 <= time.time() - cache['time'] < ttl:
+            return cache['provider']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_provider_cache(filename, provider):
+    try:
+        tmp = '{0}.{1}'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'provider': provider, 'time': time.time()}, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logging.warning('Could not cache the provider in %s: %s', filename, e)
+
+
+def config_fingerprint():
+    """Returns a hash of everything the generated configuration depends on: the environment, the scripts that
+    generate it, the version of the postgres binary, the resources of the container, the host name and its address"""
+    fingerprint = hashlib.sha256()
+    for name, value in sorted(os.environ.items()):
+        if name != 'SPILO_CONFIG_CACHE':
+            fingerprint.update('{0}={1}\0'.format(name, value).encode('utf-8', 'surrogateescape'))
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in ('configure_spilo.py', 'pg_sizing.py', 'augment_patroni_configuration.py'):
+        with open(os.path.join(script_dir, name), 'rb') as f:
+            fingerprint.update(f.read())
+
+    bin_dir = os.path.join('/usr/lib/postgresql', os.environ.get('PGVERSION', ''), 'bin')
+    try:
+        fingerprint.update(subprocess.check_output([os.path.join(bin_dir if os.path.isdir(bin_dir) else '',
+                                                                 'postgres'), '--version']))
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    fingerprint.update(json.dumps(pg_sizing.detect_resources(), sort_keys=True).encode('utf-8'))
+    fingerprint.update(socket.gethostname().encode('utf-8'))
+    # The address the host name resolves to ends up in the configuration (instance_data['ip']), and a
+    # restarted container may keep its host name while getting a different address
+    try:
+        fingerprint.update(socket.gethostbyname(socket.gethostname()).encode('utf-8'))
+    except (OSError, UnicodeError):
+        pass
+    return fingerprint.hexdigest()
+
+
+def read_config_cache(filename, fingerprint):
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        if cache['fingerprint'] == fingerprint:
+            return cache
+        logging.info('The environment changed since the configuration was cached in %s', filename)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_config_cache(filename, cache):
+    try:
+        tmp = '{0}.{1}'.format(filename, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logging.warning('Could not cache the configuration in %s: %s', filename, e)
 
 
 def get_provider():
@@ -334,23 +611,20 @@ def get_provider():
     if os.environ.get('DEVELOP', '').lower() in ['1', 'true', 'on']:
         return PROVIDER_LOCAL
 
-    try:
-        logging.info("Figuring out my environment (Google? AWS? Openstack? Local?)")
-        r = requests.get('http://169.254.169.254', timeout=2)
-        if r.headers.get('Metadata-Flavor', '') == 'Google':
-            return PROVIDER_GOOGLE
-        else:
-            # accessible on Openstack, will fail on AWS
-            r = requests.get('http://169.254.169.254/openstack/latest/meta_data.json')
-            if r.ok:
-                return PROVIDER_OPENSTACK
-
-            # is accessible from both AWS and Openstack, Possiblity of misidentification if previous try fails
-            r = requests.get('http://169.254.169.254/latest/meta-data/ami-id')
-            return PROVIDER_AWS if r.ok else PROVIDER_UNSUPPORTED
-    except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
-        logging.info("Could not connect to 169.254.169.254, assuming local Docker setup")
-        return PROVIDER_LOCAL
+    if PROVIDER_CACHE_FILE:
+        provider = read_provider_cache(PROVIDER_CACHE_FILE, PROVIDER_CACHE_TTL)
+        if provider:
+            logging.info('Using the cached provider from %s', PROVIDER_CACHE_FILE)
+            return provider
+
+    logging.info("Figuring out my environment (Google? AWS? Openstack? Local?)")
+    provider, conclusive = probe_provider(PROVIDER_PROBE_DEADLINE)
+    # We do not cache an unsupported provider, as that may be caused by a metadata service having a bad day,
+    # nor a guess made because a metadata service was too slow to answer: only a refused connection is final
+    if PROVIDER_CACHE_FILE and provider != PROVIDER_UNSUPPORTED and conclusive:
+        write_provider_cache(PROVIDER_CACHE_FILE, provider)
+
+    return provider
 
 
 def get_instance_metadata(provider):
@@ -369,7 +643,7 @@ def get_instance_metadata(provider):
         if not USE_KUBERNETES:
             mapping.update({'id': 'id'})
     elif provider == PROVIDER_AWS or provider == PROVIDER_OPENSTACK:
-        url = 'http://169.254.169.254/latest/meta-data'
+        url = METADATA_URL + '/latest/meta-data'
         mapping = {'zone': 'placement/availability-zone'}
         if not USE_KUBERNETES:
             mapping.update({'ip': 'local-ipv4', 'id': 'instance-id'})
@@ -377,8 +651,26 @@ def get_instance_metadata(provider):
         logging.info("No meta-data available for this provider")
         return metadata
 
-    for k, v in mapping.items():
-        metadata[k] = requests.get('{}/{}'.format(url, v or k), timeout=2, headers=headers).text
+    # We fetch all the keys concurrently, a failure to fetch any of them is still fatal
+    requests = lazy_import('requests')
+    responses = {}
+
+    def fetch(k, v):
+        try:
+            responses[k] = requests.get('{}/{}'.format(url, v or k), timeout=2, headers=headers).text
+        except requests.exceptions.RequestException as e:
+            responses[k] = e
+
+    threads = [threading.Thread(target=fetch, args=item) for item in mapping.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for k in mapping:
+        if isinstance(responses[k], Exception):
+            raise responses[k]
+        metadata[k] = responses[k]
 
     return metadata
 
@@ -446,7 +738,7 @@ def get_placeholders(provider):
     placeholders.setdefault('WAL_BUCKET_SCOPE_SUFFIX', '')
     placeholders.setdefault('WALE_ENV_DIR', os.path.join(placeholders['PGHOME'], 'etc', 'wal-e.d', 'env'))
     placeholders.setdefault('USE_WALE', False)
-    cpu_count = str(min(psutil.cpu_count(), 10))
+    cpu_count = str(min(os.cpu_count(), 10))
     placeholders.setdefault('WALG_DOWNLOAD_CONCURRENCY', cpu_count)
     placeholders.setdefault('WALG_UPLOAD_CONCURRENCY', cpu_count)
     placeholders.setdefault('PAM_OAUTH2', '')
@@ -532,35 +824,33 @@ def get_placeholders(provider):
         'envdir "{WALE_ENV_DIR}" {WALE_BINARY} wal-push "%p"'.format(**placeholders) \
         if placeholders['USE_WALE'] else '/bin/true'
 
-    if os.path.exists(MEMORY_LIMIT_IN_BYTES_PATH):
-        with open(MEMORY_LIMIT_IN_BYTES_PATH) as f:
-            os_memory_mb = int(f.read()) / 1048576
-    else:
-        os_memory_mb = sys.maxsize
-    os_memory_mb = min(os_memory_mb, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1048576)
-
-    # Depending on environment we take 1/4 or 1/5 of the memory, expressed in full MB's
-    sb_ratio = 5 if USE_KUBERNETES else 4
-    placeholders['postgresql']['parameters']['shared_buffers'] = '{}MB'.format(int(os_memory_mb/sb_ratio))
-    # # 1 connection per 30 MB, at least 100, at most 1000
-    placeholders['postgresql']['parameters']['max_connections'] = min(max(100, int(os_memory_mb/30)), 1000)
+    if placeholders.get('WORKLOAD_PROFILE') and placeholders['WORKLOAD_PROFILE'] not in pg_sizing.WORKLOAD_PROFILES:
+        logging.warning('Unknown WORKLOAD_PROFILE %s, choose from %s', placeholders['WORKLOAD_PROFILE'],
+                        ', '.join(sorted(pg_sizing.WORKLOAD_PROFILES)))
+        placeholders['WORKLOAD_PROFILE'] = ''
+    resources = pg_sizing.detect_resources()
+    logging.info('Sizing PostgreSQL for %.0fMB of memory (%s) and %s cpus (%s), workload profile %s',
+                 resources['memory_mb'], resources['memory_source'], resources['cpus'], resources['cpus_source'],
+                 placeholders.get('WORKLOAD_PROFILE') or 'none')
+    placeholders['postgresql']['parameters'].update(pg_sizing.size_parameters(
+        resources['memory_mb'], resources['cpus'], USE_KUBERNETES, placeholders.get('WORKLOAD_PROFILE')))
 
     placeholders['instance_data'] = get_instance_metadata(provider)
     return placeholders
 
 
-def write_file(config, filename, overwrite):
+def write_file(config, filename, overwrite, atomic=False):
+    """Writes config to filename, if atomic the file is written to a temporary file that is renamed,
+    so nobody ever reads a partially written file"""
     if not overwrite and os.path.exists(filename):
         logging.warning('File %s already exists, not overwriting. (Use option --force if necessary)', filename)
     else:
-        with open(filename, 'w') as f:
+        tmp = '{0}.{1}'.format(filename, os.getpid()) if atomic else filename
+        with open(tmp, 'w') as f:
             logging.info('Writing to file %s', filename)
             f.write(config)
-
-
-def pystache_render(*args, **kwargs):
-    render = pystache.Renderer(missing_tags='strict')
-    return render.render(*args, **kwargs)
+        if atomic:
+            os.rename(tmp, filename)
 
 
 def get_dcs_config(config, placeholders):
@@ -579,9 +869,9 @@ def get_dcs_config(config, placeholders):
             config['kubernetes'].update({'use_endpoints': True, 'pod_ip': placeholders['instance_data']['ip'],
                                          'ports': [{'port': 5432, 'name': 'postgresql'}]})
     elif 'ZOOKEEPER_HOSTS' in placeholders:
-        config = {'zookeeper': {'hosts': yaml.load(placeholders['ZOOKEEPER_HOSTS'])}}
+        config = {'zookeeper': {'hosts': lazy_import('yaml').load(placeholders['ZOOKEEPER_HOSTS'])}}
     elif 'EXHIBITOR_HOSTS' in placeholders and 'EXHIBITOR_PORT' in placeholders:
-        config = {'exhibitor': {'hosts': yaml.load(placeholders['EXHIBITOR_HOSTS']),
+        config = {'exhibitor': {'hosts': lazy_import('yaml').load(placeholders['EXHIBITOR_HOSTS']),
                                 'port': placeholders['EXHIBITOR_PORT']}}
     elif 'ETCD_HOST' in placeholders:
         config = {'etcd': {'host': placeholders['ETCD_HOST']}}
@@ -759,7 +1049,7 @@ def write_crontab(placeholders, overwrite):
         lines += [('{LOG_SHIP_SCHEDULE} nice -n 5 envdir "{LOG_ENV_DIR}"' +
                    ' /scripts/upload_pg_log_to_s3.py').format(**placeholders)]
 
-    lines += yaml.load(placeholders['CRONTAB'])
+    lines += lazy_import('yaml').load(placeholders['CRONTAB'])
 
     setup_crontab('postgres', lines)
 
@@ -800,7 +1090,7 @@ def write_pam_oauth2_configuration(placeholders, overwrite):
     if len(t) < 2:
         return logging.info("No PAM_OAUTH2 configuration was specified, skipping")
 
-    r = urlparse(t[0])
+    r = lazy_import('six.moves.urllib_parse').urlparse(t[0])
     if not r.scheme or r.scheme != 'https':
         return logging.error('First argument of PAM_OAUTH2 must be a valid https url: %s', r)
 
@@ -842,30 +1132,38 @@ def get_binary_version(bin_dir):
     return '.'.join(version.groups()) if int(version.group(1)) < 10 else version.group(1)
 
 
-def main():
-    debug = os.environ.get('DEBUG', '') in ['1', 'true', 'on', 'ON']
-    args = parse_args()
+def sized_section(config, name):
+    """Returns the parameters section of the Patroni configuration a sized parameter belongs in"""
+    if name in pg_sizing.DCS_PARAMETERS:
+        return config['bootstrap']['dcs']['postgresql']['parameters']
+    return config['postgresql']['parameters']
 
-    logging.basicConfig(format='%(asctime)s - bootstrapping - %(levelname)s - %(message)s', level=('DEBUG'
-                        if debug else (args.get('loglevel') or 'INFO').upper()))
 
-    provider = get_provider()
-    placeholders = get_placeholders(provider)
-    logging.info('Looks like your running %s', provider)
+def get_user_config():
+    """Parses the configuration passed on by the user, or the operator, in SPILO_CONFIGURATION"""
+    user_config = lazy_import('yaml').load(os.environ.get('SPILO_CONFIGURATION',
+                                                          os.environ.get('PATRONI_CONFIGURATION', ''))) or {}
+    if not isinstance(user_config, dict):
+        config_var_name = 'SPILO_CONFIGURATION' if 'SPILO_CONFIGURATION' in os.environ else 'PATRONI_CONFIGURATION'
+        raise ValueError('{0} should contain a dict, yet it is a {1}'.format(config_var_name, type(user_config)))
+    return user_config
 
-    if (provider == PROVIDER_LOCAL and
-            not USE_KUBERNETES and
-            'ETCD_HOST' not in placeholders and
-            'ETCD_DISCOVERY_DOMAIN' not in placeholders):
-        write_etcd_configuration(placeholders)
 
-    config = yaml.load(pystache_render(TEMPLATE, placeholders))
+def get_patroni_config(placeholders, user_config):
+    """Builds the Patroni configuration from the template, the placeholders and the user configuration"""
+    config = build_patroni_config(placeholders)
     config.update(get_dcs_config(config, placeholders))
 
-    user_config = yaml.load(os.environ.get('SPILO_CONFIGURATION', os.environ.get('PATRONI_CONFIGURATION', ''))) or {}
-    if not isinstance(user_config, dict):
-        config_var_name = 'SPILO_CONFIGURATION' if 'SPILO_CONFIGURATION' in os.environ else 'PATRONI_CONFIGURATION'
-        raise ValueError('{0} should contain a dict, yet it is a {1}'.format(config_var_name, type(user_config)))
+    # The parameters sized after the resources of the container and the workload profile, unless the user
+    # configured them. Those that have to be equal on all members of the cluster are kept in the DCS, the others
+    # are set locally, where they would take precedence over the value the user configured in the DCS.
+    user_local = set(user_config.get('postgresql', {}).get('parameters', {}))
+    user_dcs = set(user_config.get('bootstrap', {}).get('dcs', {}).get('postgresql', {}).get('parameters', {}))
+    sized_parameters = {n: v for n, v in placeholders['postgresql']['parameters'].items()
+                        if n in pg_sizing.PARAMETERS and n not in user_dcs
+                        and (n in pg_sizing.DCS_PARAMETERS or n not in user_local)}
+    for name, value in sized_parameters.items():
+        sized_section(config, name)[name] = value
 
     user_config_copy = deepcopy(user_config)
     config = deep_update(user_config_copy, config)
@@ -878,6 +1176,13 @@ def main():
             config['postgresql']['bin_dir'] = bin_dir
 
     version = float(get_binary_version(config['postgresql'].get('bin_dir')))
+
+    described = pg_sizing.describe_config(config['postgresql'].get('bin_dir'))
+    if described:
+        for name, reason in pg_sizing.invalid_parameters(sized_parameters, described).items():
+            logging.warning('Not setting %s to %s: %s', name, sized_parameters[name], reason)
+            del sized_section(config, name)[name]
+
     if 'shared_preload_libraries' not in user_config.get('postgresql', {}).get('parameters', {}):
         libraries = [',' + n for n, v in extensions.items() if version >= v[0] and version <= v[1] and v[2]]
         config['postgresql']['parameters']['shared_preload_libraries'] += ''.join(libraries)
@@ -891,56 +1196,119 @@ def main():
             format(config['postgresql']['authentication']['replication']['username'])
         config['bootstrap']['pg_hba'].insert(0, rep_hba)
 
+    return config
+
+
+def main():
+    debug = os.environ.get('DEBUG', '') in ['1', 'true', 'on', 'ON']
+    args = parse_args()
+
+    logging.basicConfig(format='%(asctime)s - bootstrapping - %(levelname)s - %(message)s', level=('DEBUG'
+                        if debug else (args.get('loglevel') or 'INFO').upper()))
+    profile = StartupProfile(args['profile_startup'])
+
+    cache = None
+    if CONFIG_CACHE_FILE:
+        with profile.step('fingerprint'):
+            fingerprint = config_fingerprint()
+        if args['invalidate_cache']:
+            logging.info('Invalidating the configuration cached in %s', CONFIG_CACHE_FILE)
+        else:
+            cache = read_config_cache(CONFIG_CACHE_FILE, fingerprint)
+
+    if cache:
+        logging.info('Using the configuration cached in %s', CONFIG_CACHE_FILE)
+        provider, placeholders = cache['provider'], cache['placeholders']
+    else:
+        with profile.step('provider'):
+            provider = get_provider()
+        with profile.step('placeholders'):
+            placeholders = get_placeholders(provider)
+        # Some sections modify the placeholders, so we keep the pristine version for the cache
+        cache = {'fingerprint': fingerprint, 'provider': provider, 'placeholders': deepcopy(placeholders)} \
+            if CONFIG_CACHE_FILE else None
+    logging.info('Looks like your running %s', provider)
+
+    if (provider == PROVIDER_LOCAL and
+            not USE_KUBERNETES and
+            'ETCD_HOST' not in placeholders and
+            'ETCD_DISCOVERY_DOMAIN' not in placeholders):
+        write_etcd_configuration(placeholders)
+
     patroni_configfile = os.path.join(placeholders['PGHOME'], 'postgres.yml')
 
+    outputs = dict(cache.get('outputs', {})) if cache else {}
     for section in args['sections']:
-        logging.info('Configuring {}'.format(section))
-        if section == 'patroni':
-            write_file(yaml.dump(config, default_flow_style=False, width=120), patroni_configfile, args['force'])
-        elif section == 'patronictl':
-            configdir = os.path.join(placeholders['PGHOME'], '.config', 'patroni')
-            patronictl_configfile = os.path.join(configdir, 'patronictl.yaml')
-            if not os.path.exists(configdir):
-                os.makedirs(configdir)
-            if os.path.exists(patronictl_configfile):
-                if not args['force']:
-                    logging.warning('File %s already exists, not overriding. (Use option --force if necessary)',
-                                    patronictl_configfile)
-                    continue
-                os.unlink(patronictl_configfile)
-            os.symlink(patroni_configfile, patronictl_configfile)
-        elif section == 'log':
-            if bool(placeholders.get('LOG_S3_BUCKET')):
-                write_log_environment(placeholders)
-        elif section == 'wal-e':
-            if placeholders['USE_WALE']:
-                write_wale_environment(placeholders, '', args['force'])
-        elif section == 'certificate':
-            write_certificates(placeholders, args['force'])
-        elif section == 'crontab':
-            if placeholders['CRONTAB'] or placeholders['USE_WALE'] or bool(placeholders.get('LOG_S3_BUCKET')):
-                write_crontab(placeholders, args['force'])
-        elif section == 'pam-oauth2':
-            write_pam_oauth2_configuration(placeholders, args['force'])
-        elif section == 'pgbouncer':
-            write_pgbouncer_configuration(placeholders, args['force'])
-        elif section == 'bootstrap':
-            if placeholders['CLONE_WITH_WALE']:
-                update_and_write_wale_configuration(placeholders, 'CLONE_', args['force'])
-            if placeholders['CLONE_WITH_BASEBACKUP']:
-                write_clone_pgpass(placeholders, args['force'])
-        elif section == 'standby-cluster':
-            if placeholders['STANDBY_WITH_WALE']:
-                update_and_write_wale_configuration(placeholders, 'STANDBY_', args['force'])
-        elif section == 'renice':
-            configure_renice(args['force'])
-        else:
-            raise Exception('Unknown section: {}'.format(section))
+        with profile.step('section ' + section):
+            configure_section(section, args, placeholders, patroni_configfile, outputs)
+
+    if cache and cache.get('outputs') != outputs:
+        cache['outputs'] = outputs
+        write_config_cache(CONFIG_CACHE_FILE, cache)
+
+    profile.report()
 
     # We will abuse non zero exit code as an indicator for the launch.sh that it should not even try to create a backup
     sys.exit(int(not placeholders['USE_WALE']))
 
 
+def configure_section(section, args, placeholders, patroni_configfile, outputs):
+    """Configures a single section, only the patroni section needs the full Patroni configuration
+
+    The generated Patroni configuration is kept in outputs, if it is there already it is used as is"""
+    logging.info('Configuring {}'.format(section))
+    if section == 'patroni':
+        if 'patroni' not in outputs:
+            user_config = get_user_config()
+            config = get_patroni_config(placeholders, user_config)
+            # The TSDB defaults and the operator configuration are applied in the same pass, so the file is written
+            # once. Like augment_patroni_configuration.py did, only SPILO_CONFIGURATION is considered to come from
+            # the operator.
+            augment = lazy_import('augment_patroni_configuration').augment
+            config = augment(config, user_config if 'SPILO_CONFIGURATION' in os.environ else {})
+            outputs['patroni'] = lazy_import('yaml').dump(config, default_flow_style=False, width=120)
+        write_file(outputs['patroni'], patroni_configfile, args['force'], atomic=True)
+    elif section == 'patronictl':
+        configdir = os.path.join(placeholders['PGHOME'], '.config', 'patroni')
+        patronictl_configfile = os.path.join(configdir, 'patronictl.yaml')
+        if not os.path.exists(configdir):
+            os.makedirs(configdir)
+        if os.path.exists(patronictl_configfile):
+            if not args['force']:
+                logging.warning('File %s already exists, not overriding. (Use option --force if necessary)',
+                                patronictl_configfile)
+                return
+            os.unlink(patronictl_configfile)
+        os.symlink(patroni_configfile, patronictl_configfile)
+    elif section == 'log':
+        if bool(placeholders.get('LOG_S3_BUCKET')):
+            write_log_environment(placeholders)
+    elif section == 'wal-e':
+        if placeholders['USE_WALE']:
+            write_wale_environment(placeholders, '', args['force'])
+    elif section == 'certificate':
+        write_certificates(placeholders, args['force'])
+    elif section == 'crontab':
+        if placeholders['CRONTAB'] or placeholders['USE_WALE'] or bool(placeholders.get('LOG_S3_BUCKET')):
+            write_crontab(placeholders, args['force'])
+    elif section == 'pam-oauth2':
+        write_pam_oauth2_configuration(placeholders, args['force'])
+    elif section == 'pgbouncer':
+        write_pgbouncer_configuration(placeholders, args['force'])
+    elif section == 'bootstrap':
+        if placeholders['CLONE_WITH_WALE']:
+            update_and_write_wale_configuration(placeholders, 'CLONE_', args['force'])
+        if placeholders['CLONE_WITH_BASEBACKUP']:
+            write_clone_pgpass(placeholders, args['force'])
+    elif section == 'standby-cluster':
+        if placeholders['STANDBY_WITH_WALE']:
+            update_and_write_wale_configuration(placeholders, 'STANDBY_', args['force'])
+    elif section == 'renice':
+        configure_renice(args['force'])
+    else:
+        raise Exception('Unknown section: {}'.format(section))
+
+
 def escape_pgpass_value(val):
     output = []
     for c in val:
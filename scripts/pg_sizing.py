@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Sizes the PostgreSQL parameters that depend on the memory and cpus available to the container.
+
+The limits are read from cgroup v2 (memory.max, cpu.max) or from cgroup v1 (memory.limit_in_bytes,
+cpu.cfs_quota_us), and are capped by the resources of the host. configure_spilo.py uses this module
+to generate the Patroni configuration. WORKLOAD_PROFILE selects a preset for the WAL, checkpoint,
+parallel query and autovacuum parameters: ingest-heavy, analytics or mixed.
+
+Run this script directly for a dry-run report of the detected limits and the resulting parameters,
+validated against `postgres --describe-config`, optionally for other limits or another profile:
+
+    python3 /scripts/pg_sizing.py --memory 4GB --cpus 2 --profile ingest-heavy --bin-dir /usr/lib/postgresql/16/bin
+"""
+import argparse
+import math
+import os
+import re
+import subprocess
+
+from collections import OrderedDict
+
+CGROUP_V2_MEMORY_MAX = '/sys/fs/cgroup/memory.max'
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_MEMORY_LIMIT = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+# The parameters computed by size_parameters, the last ones only for a WORKLOAD_PROFILE
+PARAMETERS = ('shared_buffers', 'max_connections', 'effective_cache_size', 'maintenance_work_mem',
+              'max_parallel_workers_per_gather', 'max_parallel_workers', 'max_parallel_maintenance_workers',
+              'timescaledb.max_background_workers', 'max_worker_processes', 'work_mem',
+              'max_wal_size', 'min_wal_size', 'wal_buffers', 'wal_compression', 'checkpoint_timeout',
+              'parallel_setup_cost', 'autovacuum_max_workers', 'autovacuum_vacuum_cost_limit',
+              'autovacuum_vacuum_cost_delay')
+# These parameters have to be equal on all members of a cluster, Patroni manages them through the DCS
+DCS_PARAMETERS = {'max_connections', 'max_worker_processes'}
+
+# The presets for WORKLOAD_PROFILE, which size_parameters scales to the memory and cpus. Without a profile
+# the parallel query, background worker and work_mem settings of 'mixed' are used.
+WORKLOAD_PROFILES = {
+    # High rate inserts into hypertables: checkpoints far apart, cpu spent on compressing WAL and on the
+    # compression and retention jobs, little parallel query, and an autovacuum that keeps up with the churn
+    'ingest-heavy': {
+        'parallel_divisor': 4, 'parallel_max': 2, 'background_workers_per_cpu': 2, 'sorts_per_connection': 4,
+        'wal_size_per_memory': 1.0, 'wal_buffers_mb': 64, 'wal_compression_min_cpus': 4,
+        'checkpoint_timeout': '15min', 'parallel_setup_cost': None,
+        'autovacuum_workers_per_cpu': 1.0, 'autovacuum_cost_limit_per_cpu': 500,
+    },
+    # Large scans and aggregates: many parallel workers and more memory for every sort or hash
+    'analytics': {
+        'parallel_divisor': 1, 'parallel_max': 16, 'background_workers_per_cpu': 1, 'sorts_per_connection': 2,
+        'wal_size_per_memory': 0.25, 'wal_buffers_mb': None, 'wal_compression_min_cpus': 2,
+        'checkpoint_timeout': '5min', 'parallel_setup_cost': 500,
+        'autovacuum_workers_per_cpu': 0.25, 'autovacuum_cost_limit_per_cpu': 200,
+    },
+    'mixed': {
+        'parallel_divisor': 2, 'parallel_max': 8, 'background_workers_per_cpu': 1, 'sorts_per_connection': 3,
+        'wal_size_per_memory': 0.5, 'wal_buffers_mb': None, 'wal_compression_min_cpus': 2,
+        'checkpoint_timeout': '10min', 'parallel_setup_cost': None,
+        'autovacuum_workers_per_cpu': 0.5, 'autovacuum_cost_limit_per_cpu': 300,
+    },
+}
+
+# The minimum value PostgreSQL accepts for work_mem
+MIN_WORK_MEM_KB = 64
+
+
+def read_cgroup_file(filename):
+    """Returns the first line of a cgroup file split into fields, or None if it is not available"""
+    try:
+        with open(filename) as f:
+            return f.readline().split()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_memory_bytes():
+    """Returns the memory limit of our cgroup in bytes, or None if there is no limit"""
+    for filename in (CGROUP_V2_MEMORY_MAX, CGROUP_V1_MEMORY_LIMIT):
+        fields = read_cgroup_file(filename)
+        if fields:
+            # cgroup v2 uses 'max' for no limit, cgroup v1 a very large number which the host memory caps
+            return int(fields[0]) if fields[0].isdigit() else None
+    return None
+
+
+def cgroup_cpus():
+    """Returns the number of cpus our cgroup is allowed to use, or None if there is no quota"""
+    try:
+        fields = read_cgroup_file(CGROUP_V2_CPU_MAX)
+        if fields:
+            return int(fields[0]) / int(fields[1]) if fields[0] != 'max' else None
+
+        quota, period = read_cgroup_file(CGROUP_V1_CPU_QUOTA), read_cgroup_file(CGROUP_V1_CPU_PERIOD)
+        if quota and period and int(quota[0]) > 0 and int(period[0]) > 0:
+            return int(quota[0]) / int(period[0])
+    except (ValueError, IndexError, ZeroDivisionError):
+        pass
+    return None
+
+
+def host_memory_bytes():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def host_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def detect_resources():
+    """Returns the memory (in MB) and the number of cpus available to us, and where these limits come from"""
+    memory, cpus = cgroup_memory_bytes(), cgroup_cpus()
+    memory_mb = min(memory or host_memory_bytes(), host_memory_bytes()) / 1048576
+
+    return {
+        'memory_mb': memory_mb,
+        # A fractional cpu quota still allows a worker to run on every cpu it covers
+        'cpus': min(host_cpus(), int(math.ceil(cpus))) if cpus else host_cpus(),
+        'memory_source': 'cgroup' if memory and memory < host_memory_bytes() else 'host',
+        'cpus_source': 'cgroup' if cpus and cpus < host_cpus() else 'host',
+    }
+
+
+def size_parameters(memory_mb, cpus, kubernetes=False, profile=None):
+    """Computes the PostgreSQL parameters for the given memory (in MB), number of cpus and workload profile
+
+    Returns an OrderedDict of parameter names and values, in the units PostgreSQL expects"""
+    cpus = max(1, int(cpus))
+    preset = WORKLOAD_PROFILES[profile or 'mixed']
+    parameters = OrderedDict()
+
+    # Depending on environment we take 1/4 or 1/5 of the memory, expressed in full MB's
+    shared_buffers_mb = int(memory_mb / (5 if kubernetes else 4))
+    parameters['shared_buffers'] = '{}MB'.format(shared_buffers_mb)
+    # 1 connection per 30 MB, at least 100, at most 1000
+    parameters['max_connections'] = min(max(100, int(memory_mb / 30)), 1000)
+    parameters['effective_cache_size'] = '{}MB'.format(int(memory_mb * 3 / 4))
+    parameters['maintenance_work_mem'] = '{}MB'.format(min(max(int(memory_mb / 16), 16), 2048))
+
+    # Parallel queries only pay off if there is more than one cpu
+    parameters['max_parallel_workers_per_gather'] = min(cpus // preset['parallel_divisor'], preset['parallel_max'])
+    parameters['max_parallel_workers'] = cpus
+    parameters['max_parallel_maintenance_workers'] = min(cpus // 2, 4)
+    parameters['timescaledb.max_background_workers'] = max(16, cpus * preset['background_workers_per_cpu'])
+    # One worker for every background worker and parallel worker, and some for the launchers
+    parameters['max_worker_processes'] = max(8, parameters['timescaledb.max_background_workers'] + cpus + 3)
+
+    # The memory that is not used for shared buffers is shared by all connections, each of which might run
+    # a few sorts or hashes at the same time, in as many processes as a parallel query uses
+    work_mem_kb = (memory_mb - shared_buffers_mb) * 1024 \
+        / (parameters['max_connections'] * preset['sorts_per_connection']) \
+        / max(1, parameters['max_parallel_workers_per_gather'])
+    parameters['work_mem'] = '{}kB'.format(max(int(work_mem_kb), MIN_WORK_MEM_KB))
+
+    if profile:
+        # The memory is the best proxy we have for the size of the volume and the rate of writes
+        max_wal_size_mb = min(max(int(memory_mb * preset['wal_size_per_memory']), 1024), 65536)
+        parameters['max_wal_size'] = '{}MB'.format(max_wal_size_mb)
+        parameters['min_wal_size'] = '{}MB'.format(max_wal_size_mb // 4)
+        if preset['wal_buffers_mb']:
+            parameters['wal_buffers'] = '{}MB'.format(max(min(preset['wal_buffers_mb'], shared_buffers_mb // 32), 1))
+        parameters['wal_compression'] = 'on' if cpus >= preset['wal_compression_min_cpus'] else 'off'
+        parameters['checkpoint_timeout'] = preset['checkpoint_timeout']
+        if preset['parallel_setup_cost']:
+            parameters['parallel_setup_cost'] = preset['parallel_setup_cost']
+        parameters['autovacuum_max_workers'] = min(max(int(cpus * preset['autovacuum_workers_per_cpu']), 3), 10)
+        parameters['autovacuum_vacuum_cost_limit'] = \
+            min(max(cpus * preset['autovacuum_cost_limit_per_cpu'], 200), 10000)
+        parameters['autovacuum_vacuum_cost_delay'] = '2ms'
+
+    return parameters
+
+
+def describe_config(bin_dir):
+    """Returns the parameters the postgres binary knows, as a dict of name to (vartype, min, max)
+
+    Returns None if the binary can not be run"""
+    postgres = os.path.join(bin_dir or '', 'postgres')
+    try:
+        output = subprocess.check_output([postgres, '--describe-config'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    described = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        # name, context, group, vartype, reset value, min, max, short description, long description
+        fields = line.split('\t')
+        if len(fields) >= 7:
+            described[fields[0]] = (fields[3], fields[5], fields[6])
+    return described
+
+
+def invalid_parameters(parameters, described):
+    """Returns the parameters that the postgres binary does not know or whose values are out of range, as a
+    dict of name to reason"""
+    invalid = {}
+    for name, value in parameters.items():
+        # The parameters of extensions are only known once the extension is loaded
+        if '.' in name:
+            continue
+        if name not in described:
+            invalid[name] = 'unknown parameter'
+            continue
+        vartype, minimum, maximum = described[name]
+        if vartype == 'BOOLEAN' and str(value).lower() not in ('on', 'off', 'true', 'false', 'yes', 'no', '1', '0'):
+            invalid[name] = 'not a boolean'
+        elif vartype in ('INTEGER', 'REAL') and isinstance(value, (int, float)):
+            try:
+                if not float(minimum) <= value <= float(maximum):
+                    invalid[name] = 'out of range [{0}, {1}]'.format(minimum, maximum)
+            except ValueError:
+                pass
+    return invalid
+
+
+def parse_memory(value):
+    """Parses a memory size like 512MB or 4GB into MB, a plain number is taken to be MB"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(kB|MB|GB|TB)?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid memory size: {0}'.format(value))
+    factor = {'kb': 1 / 1024, 'mb': 1, 'gb': 1024, 'tb': 1048576}[(match.group(2) or 'MB').lower()]
+    return float(match.group(1)) * factor
+
+
+def report(resources, profile, parameters, invalid):
+    lines = ['# Sized for {0:.0f}MB of memory ({1}) and {2} cpus ({3}), workload profile {4}'.format(
+        resources['memory_mb'], resources['memory_source'], resources['cpus'], resources['cpus_source'],
+        profile or 'none')]
+    for name, value in parameters.items():
+        comments = ['dcs'] if name in DCS_PARAMETERS else []
+        if name in invalid:
+            comments.append('invalid: ' + invalid[name])
+        lines.append("{0}{1} = '{2}'{3}".format('#' if name in invalid else '', name, value,
+                                                 '  # ' + ', '.join(comments) if comments else ''))
+    return '\n'.join(lines)
+
+
+def main():
+    argp = argparse.ArgumentParser(description='Reports the PostgreSQL parameters sized after the resources '
+                                               'of this container, without changing anything')
+    argp.add_argument('--memory', type=parse_memory, help='Size for this amount of memory instead, e.g. 4GB')
+    argp.add_argument('--cpus', type=int, help='Size for this number of cpus instead')
+    argp.add_argument('--profile', choices=sorted(WORKLOAD_PROFILES),
+                      default=os.environ.get('WORKLOAD_PROFILE') or None,
+                      help='Size for this workload profile (default: $WORKLOAD_PROFILE)')
+    argp.add_argument('--bin-dir', help='Validate the parameters against the postgres binary in this directory')
+    argp.add_argument('--kubernetes', default=os.environ.get('KUBERNETES_SERVICE_HOST') is not None,
+                      action='store_true', help='Size as if running on Kubernetes')
+    args = argp.parse_args()
+
+    resources = detect_resources()
+    if args.memory:
+        resources.update(memory_mb=args.memory, memory_source='--memory')
+    if args.cpus:
+        resources.update(cpus=args.cpus, cpus_source='--cpus')
+
+    parameters = size_parameters(resources['memory_mb'], resources['cpus'], args.kubernetes, args.profile)
+    described = describe_config(args.bin_dir)
+    if described is None:
+        print('# Could not run {0} --describe-config, the parameters are not validated'.format(
+            os.path.join(args.bin_dir or '', 'postgres')))
+    invalid = invalid_parameters(parameters, described) if described else {}
+    print(report(resources, args.profile, parameters, invalid))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,15 +19,20 @@ time. Ensuring we have long running tasks and are still responsive and sending o
 timely diagnostic messages pretty much means we have multiple threads. That's why multithreading
 is thrown in the mix.
 
-Apart from the main thread we use 3 more threads:
+Apart from the main thread we use 3 more threads, and optionally a fourth:
 
 1. HTTPServer
 2. Backup
 3. History
-
-The HTTPServer is a regular HTTPServer with an extra Event thrown in to allow communication
-with the other thread(s).
-The backup thread its sole purpose is to run the backup once triggered using the api.
+4. Scheduler
+
+The HTTPServer is a ThreadingHTTPServer with an extra Event thrown in to allow communication
+with the other thread(s). Every request is served by its own thread, so a slow client or a POST
+that waits for its backup to start does not stall the other requests. The number of requests in
+flight is capped, requests beyond that cap are refused with a 503.
+The backup thread its sole purpose is to run the backups that are queued using the api, one at a time.
+A single program can serve multiple stanzas, every stanza has its own backup and history thread.
+The scheduler, if configured, queues backups according to cron-style schedules.
 The history will gather metadata about backups from pgBackRest using a scheduled interval, or when
 triggered by the backup thread.
 
@@ -37,28 +42,47 @@ done by pgBackRest.
 """
 
 import argparse
+import bisect
 import datetime
+import gzip
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import logging
 import os
+import re
 import signal
 import sys
 import time
 import urllib.parse
 
+from collections import OrderedDict, deque
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from subprocess import Popen, PIPE, check_output, STDOUT
-from threading import Thread, Event, Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from subprocess import Popen, PIPE, STDOUT, CalledProcessError
+from threading import Thread, Event, Lock, RLock, BoundedSemaphore, Condition, current_thread, local
 
-# We only ever want a single backup to be actively running. We have a global object that we share
-# between the HTTP and the backup threads. Concurrent write access is prevented by a Lock and an Event
-backup_history = dict()
-current_backup = None
-stanza = None
+# We only ever want a single backup per stanza to be actively running. We have global objects that we share
+# between the HTTP and the backup threads. Concurrent write access is prevented by Locks and Conditions
+stanzas = None
+backup_slots = None
 
 EPOCH = datetime.datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=datetime.timezone.utc)
+# Used in the ETags, to ensure ETags handed out before a restart of this program never match
+BOOT_ID = '{0:x}'.format(int(time.time()))
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+# The fields of the details of a backup that change with the time, not with the backup
+TIME_DEPENDENT_FIELDS = ('age', 'duration')
+FINAL_STATUSES = ('FINISHED', 'ERROR')
+# The backup types, every type contains everything of the types before it
+BACKUP_TYPES = ('incr', 'diff', 'full')
+COMPRESS_TYPES = ('none', 'bz2', 'gz', 'lz4', 'zst')
+# The maximum number of seconds a long-polling request is allowed to wait
+MAX_WAIT = 300
+# pgBackRest does not report the WAL segment size, we assume the PostgreSQL default
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
 LOGLEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'critical': 50}
 
 
@@ -68,18 +92,143 @@ def parse_arguments(args):
                                      formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=40, width=120))
     parser.add_argument('--loglevel', help='Explicitly provide loglevel', default='info', choices=list(LOGLEVELS.keys()))
     parser.add_argument('-p', '--port', help='http listen port', type=int, default=8081)
-    parser.add_argument('-s', '--stanza', help='stanza to be used by pgBackRest', default=os.environ.get('PGBACKREST_STANZA', None))
+    parser.add_argument('-s', '--stanza', help='stanza to be used by pgBackRest, can be specified multiple times', action='append',
+                        dest='stanzas', metavar='STANZA')
+    parser.add_argument('--max-requests', help='maximum number of http requests in flight', type=int, default=16)
+    parser.add_argument('--max-streams', help='maximum number of event streams and long-polls (?wait=) in flight, '
+                        'these do not count against --max-requests', type=int, default=16)
+    parser.add_argument('--log-lines', help='number of lines of output to keep for every backup', type=int, default=10000)
+    parser.add_argument('--max-queued', help='maximum number of backups waiting to be run, per stanza', type=int, default=10)
+    parser.add_argument('--max-backups', help='maximum number of backups running concurrently, across all stanzas', type=int, default=1)
+    parser.add_argument('--progress-interval', help='seconds between samples of the progress of a running backup, 0 to disable',
+                        type=float, default=300)
+    parser.add_argument('--adaptive', help='pick process-max and compression based on the available cpus and load, '
+                        'unless specified by the request', action='store_true')
+    parser.add_argument('--schedule', help='queue backups of the given type on a cron schedule (in UTC), e.g. "full=0 1 * * 0", '
+                        'for all stanzas, or only for the given stanza', type=parse_schedule, action='append', default=[],
+                        metavar='[STANZA:]TYPE=CRON')
+    parser.add_argument('--journal', help='file to persist the backup history in',
+                        default=os.path.join(os.path.dirname(os.environ['PGBACKREST_CONFIG']), 'pgbackrest-rest.journal')
+                        if os.environ.get('PGBACKREST_CONFIG') else None)
 
     parsed = parser.parse_args(args or [])
+    # PGBACKREST_STANZA may contain a comma separated list of stanzas
+    if not parsed.stanzas:
+        parsed.stanzas = [s for s in os.environ.get('PGBACKREST_STANZA', '').split(',') if s] or [None]
 
     return parsed
 
 
+def parse_schedule(value):
+    """Parse a schedule argument of the form [stanza:]type=cron expression"""
+    backup_type, _, expression = value.partition('=')
+    schedule_stanza, _, backup_type = backup_type.rpartition(':')
+    if backup_type not in BACKUP_TYPES:
+        raise argparse.ArgumentTypeError('Invalid backup type ({0}), supported types: {1}'.format(backup_type, ', '.join(BACKUP_TYPES)))
+    try:
+        return schedule_stanza or None, backup_type, CronSchedule(expression)
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError(str(ve))
+
+
+def cgroup_cpus():
+    """Returns the number of cpus our cgroup is allowed to use, or None if there is no quota
+
+    Both cgroup v2 (cpu.max) and cgroup v1 (cpu.cfs_quota_us) are supported."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        return int(quota) / int(period) if quota != 'max' else None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def adaptive_settings():
+    """Picks the pgBackRest process-max and compression for a backup that starts now
+
+    We consider the cpus that are not busy: the cpus we are allowed to use by our cgroup,
+    limited by the cpus of the host that are not accounted for by the load average. One of
+    those is left to PostgreSQL, pgBackRest may use the others. If less than 2 cpus are not busy,
+    we also switch to the cheapest compression, trading repository size for cpu."""
+    host_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    cpus = min(host_cpus, cgroup_cpus() or host_cpus)
+    idle = max(0.0, min(cpus, host_cpus - os.getloadavg()[0]))
+
+    settings = {'process-max': max(1, int(idle) - 1)}
+    if idle < 2:
+        settings.update({'compress-type': 'lz4', 'compress-level': 1})
+
+    logging.debug('Adaptive settings for {0:.1f} cpus, {1:.1f} not busy: {2}'.format(cpus, idle, settings))
+    return settings
+
+
 def utcnow():
     """Wraps around datetime utcnow to provide a consistent way of returning a truncated now in utc"""
     return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).replace(microsecond=0)
 
 
+def backup_label(started):
+    """Returns the label we use to identify a backup that started at the given time"""
+    return started.strftime('%Y%m%d%H%M%S')
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, or a duration relative to now, like 30m, 24h or 7d
+
+    Timestamps without a timezone are considered to be in UTC"""
+    match = re.match(r'^(\d+)([smhd])$', value)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return utcnow() - datetime.timedelta(**{unit: int(match.group(1))})
+
+    # Before Python 3.11, fromisoformat does not understand the Z suffix
+    timestamp = datetime.datetime.fromisoformat(re.sub('Z$', '+00:00', value))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+
+    return timestamp.astimezone(datetime.timezone.utc)
+
+
+def project(document, fields):
+    """Returns a copy of the document with only the given fields
+
+    Fields can be dotted paths to select keys of nested documents, e.g. pgbackrest.info.size"""
+    result = {}
+    for field in fields:
+        path = field.split('.')
+        value = document
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = result
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+    return result
+
+
+def wal_segment_number(segment):
+    """Returns the position of the WAL segment within its timeline, e.g. 000000010000000100000002 is 258"""
+    return int(segment[8:16], 16) * (0x100000000 // WAL_SEGMENT_SIZE) + int(segment[16:24], 16)
+
+
+def is_integer(value):
+    """Whether the value is an integer; in Python a bool is an int, but json true is not a number"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
     if isinstance(obj, (datetime.datetime,)):
@@ -92,51 +241,511 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
+class Metric ():
+    """A Prometheus metric, which can have multiple samples, identified by their labels
+
+    Metrics are updated as events happen, so rendering them never needs to do any work
+    apart from formatting the current values."""
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.samples = dict()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @staticmethod
+    def _format_labels(names, values):
+        if not names:
+            return ''
+        escaped = [v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values]
+        return '{' + ','.join('{0}="{1}"'.format(n, v) for n, v in zip(names, escaped)) + '}'
+
+    def remove(self, **labels):
+        with self.lock:
+            self.samples.pop(self._key(labels), None)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.samples.items()):
+                lines.append('{0}{1} {2}'.format(self.name, self._format_labels(self.labelnames, key), repr(float(value))))
+
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.samples[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        Metric.__init__(self, name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            # Per sample: the count per bucket (not cumulative), the sum and the count
+            counts, total, count = self.samples.get(key, ([0] * len(self.buckets), 0, 0))
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            self.samples[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        names = self.labelnames + ('le',)
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.samples.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{0}_bucket{1} {2}'.format(self.name, self._format_labels(names, key + (repr(float(bucket)),)), cumulative))
+                lines.append('{0}_bucket{1} {2}'.format(self.name, self._format_labels(names, key + ('+Inf',)), count))
+                lines.append('{0}_sum{1} {2}'.format(self.name, self._format_labels(self.labelnames, key), repr(float(total))))
+                lines.append('{0}_count{1} {2}'.format(self.name, self._format_labels(self.labelnames, key), count))
+
+        return lines
+
+
+class TimedLock ():
+    """Wraps around a Lock to measure the time the lock is held"""
+    def __init__(self, histogram, **labels):
+        self._lock = Lock()
+        self.histogram = histogram
+        self.labels = labels
+        self._acquired = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._acquired = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        held = time.monotonic() - self._acquired
+        self._lock.release()
+        self.histogram.observe(held, **self.labels)
+
+
+BACKUP_DURATION = Histogram('pgbackrest_backup_duration_seconds', 'Duration of the backups run by this program', ['stanza', 'type', 'status'],
+                            buckets=(60, 300, 900, 1800, 3600, 7200, 14400, 28800, 57600, 86400, 172800))
+BACKUP_LAST_SUCCESS = Gauge('pgbackrest_backup_last_success_timestamp_seconds', 'Finish time of the last successful backup', ['stanza', 'type'])
+BACKUP_SIZE = Gauge('pgbackrest_backup_size_bytes', 'Sizes of the most recent backup, as reported by pgBackRest', ['stanza', 'type', 'size'])
+BACKUP_PROGRESS = Gauge('pgbackrest_backup_progress_ratio', 'Fraction of the running backup that has been copied', ['stanza'])
+BACKUP_PROGRESS_RATE = Gauge('pgbackrest_backup_progress_bytes_per_second', 'Bytes copied per second by the running backup', ['stanza'])
+BACKUP_PROGRESS_ETA = Gauge('pgbackrest_backup_progress_eta_seconds', 'Estimated number of seconds until the running backup is copied', ['stanza'])
+BACKUP_THROUGHPUT = Gauge('pgbackrest_backup_throughput_bytes_per_second', 'Database bytes backed up per second by the most recent backup',
+                          ['stanza', 'type'])
+HISTORY_REFRESH_DURATION = Histogram('pgbackrest_rest_history_refresh_duration_seconds', 'Duration of the backup history refreshes', ['stanza'],
+                                     buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+HISTORY_REFRESH_CHANGED = Counter('pgbackrest_rest_history_refresh_changed_backups_total',
+                                  'Number of backups changed by the backup history refreshes', ['stanza'])
+HISTORY_BACKUPS = Gauge('pgbackrest_rest_history_backups', 'Number of backups in the backup history', ['stanza', 'status'])
+HTTP_REQUEST_DURATION = Histogram('pgbackrest_rest_http_request_duration_seconds', 'Duration of the http requests', ['method', 'route', 'code'])
+LOCK_HOLD_DURATION = Histogram('pgbackrest_rest_lock_hold_seconds', 'Time spent holding a lock', ['lock'])
+METRICS = [BACKUP_DURATION, BACKUP_LAST_SUCCESS, BACKUP_SIZE, BACKUP_PROGRESS, BACKUP_PROGRESS_RATE, BACKUP_PROGRESS_ETA, BACKUP_THROUGHPUT,
+           HISTORY_REFRESH_DURATION, HISTORY_REFRESH_CHANGED,
+           HISTORY_BACKUPS, HTTP_REQUEST_DURATION, LOCK_HOLD_DURATION]
+
+
+def update_backup_metrics(backups):
+    """Updates the backup metrics for the given (modified) backups, to be used as a BackupHistory listener"""
+    for backup in backups:
+        info = backup.pgbackrest_info
+        if info.get('timestamp') and not info.get('error'):
+            backup_type = info.get('type')
+            finished = info['timestamp']['stop']
+            with BACKUP_LAST_SUCCESS.lock:
+                is_latest = finished >= BACKUP_LAST_SUCCESS.samples.get((str(backup.stanza), backup_type), 0)
+            if is_latest:
+                BACKUP_LAST_SUCCESS.set(finished, stanza=backup.stanza, type=backup_type)
+                sizes = info.get('info', {})
+                for size, value in (('database', sizes.get('size')), ('delta', sizes.get('delta')),
+                                    ('repository', sizes.get('repository', {}).get('size')),
+                                    ('repository_delta', sizes.get('repository', {}).get('delta'))):
+                    if value is not None:
+                        BACKUP_SIZE.set(value, stanza=backup.stanza, type=backup_type, size=size)
+                throughput = backup.throughput()
+                if throughput:
+                    BACKUP_THROUGHPUT.set(throughput['database'], stanza=backup.stanza, type=backup_type)
+        elif backup.status == 'FINISHED' and backup.finished and backup.request.get('type'):
+            finished = (backup.finished - EPOCH).total_seconds()
+            with BACKUP_LAST_SUCCESS.lock:
+                is_latest = finished >= BACKUP_LAST_SUCCESS.samples.get((str(backup.stanza), backup.request['type']), 0)
+            if is_latest:
+                BACKUP_LAST_SUCCESS.set(finished, stanza=backup.stanza, type=backup.request['type'])
+
+    if backups:
+        history = backups[0].history
+        if history is not None:
+            for status, count in history.status_counts().items():
+                HISTORY_BACKUPS.set(count, stanza=backups[0].stanza, status=status)
+
+
+class JSONStreamParser ():
+    """Incrementally parses the output of pgbackrest info --output=json
+
+    The document pgBackRest returns is a list of stanzas, every stanza has a list of backups.
+    For large repositories this document can be many MB's, therefore we do not want to read it
+    in full. This parser reads the stream in chunks and only decodes a single value at a time,
+    so the memory used is bounded by the largest single value, not by the size of the document."""
+    CHUNK_SIZE = 65536
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Reads the next chunk from the stream, returns False if the stream is exhausted"""
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        # Discard whatever we have consumed already, to keep the buffer small
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+        return not self.eof
+
+    def _next_char(self, skip=' \t\r\n,'):
+        """Return (but do not consume) the next character that is not in skip"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of pgBackRest info document')
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError('Expected {0} at position {1} of pgBackRest info document'.format(char, self.pos))
+        self.pos += 1
+
+    def _decode(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may have been cut in half
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def __iter__(self):
+        """Yields (key, value) for every key of every stanza
+
+        The backups are yielded one element at a time, that is, for every backup
+        of the stanza ('backup', backup) is yielded"""
+        self._expect('[')
+        while self._next_char() != ']':
+            self._expect('{')
+            while self._next_char() != '}':
+                key = self._decode()
+                self._expect(':')
+                if key == 'backup':
+                    self._expect('[')
+                    while self._next_char() != ']':
+                        yield key, self._decode()
+                    self.pos += 1
+                else:
+                    yield key, self._decode()
+            self.pos += 1
+
+
+def pgbackrest_info(stanza):
+    """Runs pgbackrest info and yields the elements of its output as they are parsed
+
+    See JSONStreamParser for the elements that are yielded. If pgBackRest fails, a
+    CalledProcessError is raised after all output has been consumed."""
+    cmd = ['pgbackrest', '--stanza={0}'.format(stanza), 'info', '--output=json']
+    p = Popen(cmd, stdout=PIPE)
+    try:
+        yield from JSONStreamParser(io.TextIOWrapper(p.stdout, encoding='utf-8'))
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise CalledProcessError(returncode, cmd)
+
+
+class LogBuffer ():
+    """A ring buffer holding the last lines of output of a backup
+
+    Backups can run for days and output millions of lines, therefore we only keep the last
+    maxlen lines, every line truncated to MAX_LINE_LENGTH bytes. The lines are stored compactly,
+    as a tuple of (epoch, loglevel, utf-8 encoded message).
+
+    Every line is identified by its offset: the number of lines that were appended before it.
+    The offsets keep increasing when older lines are dropped, so clients can read the log
+    incrementally. This class does not do any locking, callers are expected to serialize access."""
+    MAX_LINE_LENGTH = 4096
+
+    def __init__(self, maxlen):
+        self.lines = deque(maxlen=maxlen)
+        self.total = 0
+
+    @property
+    def first(self):
+        """The offset of the oldest line still available"""
+        return self.total - len(self.lines)
+
+    def append(self, loglevel, message):
+        self.lines.append((int(time.time()), loglevel, message.encode('utf-8')[:self.MAX_LINE_LENGTH]))
+        self.total += 1
+
+    def read(self, offset=None, tail=None):
+        """Returns the lines starting at offset, or the last tail lines, as tuples of (offset, epoch, loglevel, message)"""
+        start = max(self.first, offset or 0)
+        if tail is not None:
+            start = max(start, self.total - tail)
+
+        return [(start + i, epoch, loglevel, message.decode('utf-8', errors='replace'))
+                for i, (epoch, loglevel, message) in enumerate(itertools.islice(self.lines, start - self.first, None))]
+
+
 class PostgreSQLBackup ():
     """This Class represents a single PostgreSQL backup
 
     Metadata of the backup is kept, as well as output from the actual backup command."""
+    # The number of lines of output we keep for every backup
+    LOG_LINES = 10000
+    # Whether or not backups use the adaptive settings, unless specified by the request
+    ADAPTIVE = False
+    # The number of seconds between samples of the progress of a running backup, 0 disables sampling.
+    # Every sample runs pgBackRest info, which reads the whole backup.info of the repository.
+    PROGRESS_INTERVAL = 300
+
     def __init__(self, stanza, request={}, status='REQUESTED', started=None, finished=None):
         self.started = started or utcnow()
         self.finished = finished
         self.pgbackrest_info = {}
-        self.label = self.started.strftime('%Y%m%d%H%M%S')
+        self.label = backup_label(self.started)
         self.request = request or {}
         self.stanza = stanza
         self.pid = None
+        self.history = None
+        self.version = 0
+        # The state transitions and the output of this backup, for those who want to follow along.
+        # Waiting for changes can be done using the changed Condition, which is notified on every update.
+        # As most backups in the history will never have any events or output, these are created on demand.
+        self.events = None
+        self.event_id = 0
+        self.log = None
+        self.changed = Condition()
         self.request.setdefault('command', 'backup')
         self.request.setdefault('type', 'full')
+        self.request.setdefault('priority', 0)
+        # The pgBackRest options this backup actually ran with
+        self.settings = {}
+        self.progress = None
 
         if self.request and self.request.get('command', 'backup') != 'backup':
             raise ValueError('Invalid command ({0}), supported commands: backup'.format(self.request['command']))
+        if self.request['type'] not in BACKUP_TYPES:
+            raise ValueError('Invalid type ({0}), supported types: {1}'.format(self.request['type'], ', '.join(BACKUP_TYPES)))
+        if not is_integer(self.request['priority']):
+            raise ValueError('Invalid priority ({0}), priority should be an integer'.format(self.request['priority']))
+        if 'process-max' in self.request and (not is_integer(self.request['process-max']) or not 1 <= self.request['process-max'] <= 999):
+            raise ValueError('Invalid process-max ({0}), process-max should be between 1 and 999'.format(self.request['process-max']))
+        if 'compress-type' in self.request and self.request['compress-type'] not in COMPRESS_TYPES:
+            raise ValueError('Invalid compress-type ({0}), supported types: {1}'.format(self.request['compress-type'], ', '.join(COMPRESS_TYPES)))
+        if 'compress-level' in self.request and not is_integer(self.request['compress-level']):
+            raise ValueError('Invalid compress-level ({0}), compress-level should be an integer'.format(self.request['compress-level']))
+        if not isinstance(self.request.get('adaptive', False), bool):
+            raise ValueError('Invalid adaptive ({0}), adaptive should be a boolean'.format(self.request['adaptive']))
 
         self.status = status
         self.returncode = None
 
+    @classmethod
+    def from_pgbackrest(cls, stanza, pgbackrest_info):
+        """Create a backup from a single backup element of the pgBackRest info output"""
+        backup = cls(
+            stanza=stanza,
+            request=None,
+            started=EPOCH + datetime.timedelta(seconds=pgbackrest_info['timestamp']['start']),
+            finished=EPOCH + datetime.timedelta(seconds=pgbackrest_info['timestamp']['stop']),
+            status='FINISHED'
+        )
+        backup.pgbackrest_info = pgbackrest_info
+
+        return backup
+
+    def update(self, **attributes):
+        """Update the given attributes of this backup
+
+        If the backup is part of a BackupHistory, the history is updated as well, so its indexes
+        never get out of sync with the backup itself."""
+        status = self.status
+        if self.history is not None:
+            self.history.update(self, **attributes)
+        else:
+            for name, value in attributes.items():
+                setattr(self, name, value)
+            self.version += 1
+
+        with self.changed:
+            if self.status != status:
+                self._add_event('status', {'status': self.status, 'previous': status})
+            self.changed.notify_all()
+
+    def set_progress(self, progress):
+        """Sets the progress of this running backup
+
+        Only the details of the backup show the progress, so unlike update, this does not modify
+        the generation of the history nor notify its listeners (the journal would write a line for
+        every sample); only those waiting for a change of this backup are woken up."""
+        with self.history.lock if self.history is not None else self.changed:
+            self.progress = progress
+            self.version += 1
+
+        with self.changed:
+            self.changed.notify_all()
+
+    def _add_event(self, event, data):
+        with self.changed:
+            if self.events is None:
+                self.events = deque(maxlen=100)
+            self.event_id += 1
+            # We register the log offset, so the event can be put in between the right lines of output
+            self.events.append((self.event_id, self.log.total if self.log else 0, event, dict(data, time=utcnow())))
+            self.changed.notify_all()
+
+    def _add_log(self, loglevel, message):
+        with self.changed:
+            if self.log is None:
+                self.log = LogBuffer(self.LOG_LINES)
+            self.log.append(loglevel, message)
+            self.changed.notify_all()
+
+    def read_log(self, offset=None, tail=None):
+        """Returns the first available offset, the next offset and the requested lines of output"""
+        with self.changed:
+            if self.log is None:
+                return 0, 0, []
+            return self.log.first, self.log.total, self.log.read(offset, tail)
+
+    def wait(self, predicate, timeout):
+        """Wait until the predicate, which is passed this backup, is True or the timeout expires"""
+        with self.changed:
+            return self.changed.wait_for(lambda: predicate(self), timeout=timeout)
+
+    @property
+    def pgbackrest_only(self):
+        """Whether this backup was never run by us, it is only known because pgBackRest reported it"""
+        return self.status == 'FINISHED' and self.returncode is None
+
     def info(self):
         info = {'label': self.label, 'status': self.status, 'started': self.started, 'finished': self.finished}
         info['pgbackrest'] = {'label': self.pgbackrest_info.get('label')}
 
         return info
 
+    def throughput(self):
+        """Returns the bytes per second achieved by this backup, as reported by pgBackRest
+
+        database is the size of the database divided by the duration of the backup, delta and
+        repository are the bytes that were actually copied and stored."""
+        timestamp = self.pgbackrest_info.get('timestamp') or {}
+        sizes = self.pgbackrest_info.get('info') or {}
+        if 'start' not in timestamp or 'stop' not in timestamp or sizes.get('size') is None:
+            return None
+
+        duration = max(timestamp['stop'] - timestamp['start'], 1)
+        throughput = {'database': sizes['size'] / duration}
+        if sizes.get('delta') is not None:
+            throughput['delta'] = sizes['delta'] / duration
+        if sizes.get('repository', {}).get('delta') is not None:
+            throughput['repository'] = sizes['repository']['delta'] / duration
+
+        return throughput
+
     def details(self):
         details = self.info()
         details['returncode'] = self.returncode
         details['pgbackrest'] = self.pgbackrest_info
         details['pid'] = self.pid
+        details['settings'] = self.settings
+        details['throughput'] = self.throughput()
+        details['progress'] = self.progress
         if self.started:
             details['duration'] = (self.finished or utcnow()) - self.started
         details['age'] = (utcnow() - self.started)
 
         return details
 
+    def _sample_progress(self, done, start):
+        """Samples the progress of this backup until done is set
+
+        While a backup is running, pgBackRest info reports the size of the backup and the bytes
+        copied so far in the status of the stanza. From these we derive the percentage done, the
+        rate (averaged over the backup so far, as the rate between two samples is very noisy)
+        and an estimate of the time remaining."""
+        while not done.wait(self.PROGRESS_INTERVAL):
+            try:
+                lock = {}
+                for key, value in pgbackrest_info(self.stanza):
+                    if key == 'status':
+                        lock = (value.get('lock') or {}).get('backup') or {}
+                if done.is_set() or not lock.get('held') or not lock.get('size') or lock.get('size-cp') is None:
+                    continue
+
+                elapsed = time.monotonic() - start
+                size, copied = lock['size'], lock['size-cp']
+                rate = copied / elapsed if elapsed > 0 else 0
+                progress = {'size': size, 'copied': copied, 'percent': round(100.0 * copied / size, 2),
+                            'bytes_per_second': rate, 'eta': (size - copied) / rate if rate > 0 else None, 'sampled': utcnow()}
+                self.set_progress(progress)
+
+                BACKUP_PROGRESS.set(copied / size, stanza=self.stanza)
+                BACKUP_PROGRESS_RATE.set(rate, stanza=self.stanza)
+                if progress['eta'] is not None:
+                    BACKUP_PROGRESS_ETA.set(progress['eta'], stanza=self.stanza)
+            # Not knowing the progress should never interfere with the backup itself
+            except Exception as e:
+                logging.debug('Could not sample backup progress: {0}'.format(e))
+
+        for metric in (BACKUP_PROGRESS, BACKUP_PROGRESS_RATE, BACKUP_PROGRESS_ETA):
+            metric.remove(stanza=self.stanza)
+
     def run(self):
         """Runs pgBackRest as a subprocess
 
         reads stdout/stderr and immediately logs these as well"""
         logging.info("Starting backup")
 
-        self.status = 'RUNNING'
+        start = time.monotonic()
+        # Explicitly requested options always take precedence over the adaptive ones
+        settings = adaptive_settings() if self.request.get('adaptive', self.ADAPTIVE) else {}
+        settings.update({k: v for k, v in self.request.items() if k in ('process-max', 'compress-type', 'compress-level')})
+        # The backup may have been waiting in the queue, started is when pgBackRest starts
+        started = utcnow()
 
         cmd = ['pgbackrest',
                '--stanza={0}'.format(self.stanza),
@@ -144,12 +753,17 @@ class PostgreSQLBackup ():
                '--log-level-stderr=warn',
                self.request['command'],
                '--type={0}'.format(self.request['type'])]
+        cmd += ['--{0}={1}'.format(k, v) for k, v in sorted(settings.items())]
 
         # We want to augment the output with our default logging format,
         # that is why we send both stdout/stderr to a PIPE over which we iterate
+        done = Event()
         try:
             p = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-            self.pid = p.pid
+            # Every update is written to the journal, so we only update when the state really changes
+            self.update(status='RUNNING', started=started, settings=settings, pid=p.pid)
+            if self.PROGRESS_INTERVAL > 0:
+                Thread(target=self._sample_progress, args=(done, start), name=current_thread().name + '-progress', daemon=True).start()
 
             for line in io.TextIOWrapper(p.stdout, encoding="utf-8"):
                 if line.startswith('WARN'):
@@ -159,49 +773,911 @@ class PostgreSQLBackup ():
                 else:
                     loglevel = logging.INFO
                 logging.log(loglevel, line.rstrip())
+                self._add_log(loglevel, line.rstrip())
 
-            self.returncode = p.wait()
-            self.finished = utcnow()
+            returncode = p.wait()
+            self.update(returncode=returncode, finished=utcnow(), status='FINISHED' if returncode == 0 else 'ERROR')
         # As many things can - and will - go wrong when calling a subprocess, we will catch and log that
         # error and mark this backup as having failed.
         except OSError as oe:
             logging.exception(oe)
-            self.returncode = -1
+            self.update(returncode=-1, started=started, settings=settings, status='ERROR')
+        finally:
+            done.set()
 
         logging.debug('Backup details\n{0}'.format(json.dumps(self.details(), default=json_serial, indent=4, sort_keys=True)))
+        BACKUP_DURATION.observe(time.monotonic() - start, stanza=self.stanza, type=self.request['type'], status=self.status)
         if self.returncode == 0:
-            self.status = 'FINISHED'
             logging.info('Backup successful: {0}'.format(self.label))
         else:
-            self.status = 'ERROR'
             logging.error('Backup {0} failed with returncode {1}'.format(self.label, self.returncode,))
 
 
-class EventHTTPServer(HTTPServer):
-    """Wraps around HTTPServer to provide a global Lock to serialize access to the backup"""
-    def __init__(self, backup_trigger, *args, **kwargs):
-        HTTPServer.__init__(self, *args, **kwargs)
-        self.backup_trigger = backup_trigger
+class BackupHistory ():
+    """This Class holds all the backups that are known to this program
+
+    The backups are kept in label order. Next to that, we maintain an index per status and an
+    index on the pgBackRest label, so none of the api calls need to sort or scan the full
+    history, which can contain many thousands of backups.
+
+    All access is serialized using a reentrant Lock; backups should be modified using their
+    update method, which ensures the indexes are updated together with the backup.
+
+    Every listener is called with a list of backups that were added, modified or removed; a
+    removed backup is no longer in the history. Listeners are called after the lock has
+    been released."""
+    def __init__(self):
+        self.lock = RLock()
+        # Incremented for every modification of the history, allows caching of derived data
+        self.generation = 0
+        self.listeners = []
+        self._batch = None
+        self._backups = dict()
+        self._labels = list()
+        self._status_labels = dict()
+        self._pgbackrest_labels = dict()
+        self.refreshed = {'finished': None, 'duration': None, 'changed': None}
+
+    def __len__(self):
+        return len(self._backups)
+
+    def __contains__(self, label):
+        return label in self._backups
+
+    def _index(self, backup):
+        bisect.insort(self._status_labels.setdefault(backup.status, []), backup.label)
+        pgbackrest_label = backup.pgbackrest_info.get('label')
+        if pgbackrest_label:
+            self._pgbackrest_labels[pgbackrest_label] = backup.label
+
+    def _unindex(self, backup, status, pgbackrest_label):
+        labels = self._status_labels.get(status, [])
+        idx = bisect.bisect_left(labels, backup.label)
+        if idx < len(labels) and labels[idx] == backup.label:
+            del labels[idx]
+        if pgbackrest_label and self._pgbackrest_labels.get(pgbackrest_label) == backup.label:
+            del self._pgbackrest_labels[pgbackrest_label]
+
+    def _notify(self, backups):
+        with self.lock:
+            if self._batch is not None:
+                self._batch.extend(backups)
+                return
+
+        for listener in self.listeners:
+            try:
+                listener(backups)
+            except Exception as e:
+                logging.exception(e)
+
+    def add(self, backup, unique=False):
+        """Add the backup to the history, unless a backup with the same label already exists
+
+        If unique is True, the backup is always added; if its label is already taken a suffix
+        is appended to the label, e.g. 20200101120000-1, which keeps the labels in order.
+
+        Returns the backup that is in the history for this label"""
+        with self.lock:
+            if unique:
+                label, suffix = backup.label, 0
+                while label in self._backups:
+                    suffix += 1
+                    label = '{0}-{1}'.format(backup.label, suffix)
+                backup.label = label
+
+            existing = self._backups.get(backup.label)
+            if existing is not None:
+                return existing
+
+            backup.history = self
+            self._backups[backup.label] = backup
+            bisect.insort(self._labels, backup.label)
+            self._index(backup)
+            self.generation += 1
+
+        self._notify([backup])
+
+        return backup
+
+    def update(self, backup, **attributes):
+        with self.lock:
+            status, pgbackrest_label = backup.status, backup.pgbackrest_info.get('label')
+            for name, value in attributes.items():
+                setattr(backup, name, value)
+            backup.version += 1
+            self.generation += 1
+            if backup.status != status or backup.pgbackrest_info.get('label') != pgbackrest_label:
+                self._unindex(backup, status, pgbackrest_label)
+                self._index(backup)
+
+        self._notify([backup])
+
+    def remove(self, backup):
+        with self.lock:
+            if self._backups.get(backup.label) is not backup:
+                return
+            del self._backups[backup.label]
+            del self._labels[bisect.bisect_left(self._labels, backup.label)]
+            self._unindex(backup, backup.status, backup.pgbackrest_info.get('label'))
+            self.generation += 1
+
+        self._notify([backup])
+
+    def reconcile(self, stanza, pgbackrest_backups):
+        """Reconcile the history with the backups as they are known by pgBackRest
+
+        pgbackrest_backups is an iterable of backup elements of the pgBackRest info output.
+        The elements are compared against the current history by pgBackRest label; only new
+        or changed backups are modified. Backups that pgBackRest no longer knows about (they
+        expired) are removed if we only knew about them through pgBackRest; the backups we ran
+        ourselves are kept, but lose their pgBackRest info. All modifications are applied while holding the lock,
+        so readers either see the history before or after the reconciliation, never halfway.
+
+        Returns the number of backups that were changed"""
+        added = []
+        changed = []
+        removed = []
+        seen = set()
+        unlinked = None
+
+        for info in pgbackrest_backups:
+            seen.add(info.get('label'))
+            with self.lock:
+                label = self._pgbackrest_labels.get(info.get('label'))
+                if label is None:
+                    started = EPOCH + datetime.timedelta(seconds=info['timestamp']['start'])
+                    backup = self._backups.get(backup_label(started))
+                    # A backup we ran ourselves is labeled with the time it was requested, it may
+                    # have been queued for a while, so we match on the time it actually ran
+                    if backup is None:
+                        if unlinked is None:
+                            unlinked = [b for b in self._backups.values() if b.returncode == 0 and not b.pgbackrest_info]
+                        backup = next((b for b in unlinked if b.finished and b.started <= started <= b.finished), None)
+                else:
+                    backup = self._backups.get(label)
+
+            if backup is None:
+                added.append(PostgreSQLBackup.from_pgbackrest(stanza, info))
+            elif backup.pgbackrest_info != info:
+                changed.append((backup, info))
+
+        with self.lock:
+            # The listeners are notified once, after all modifications have been applied
+            self._batch = []
+            try:
+                for pgbackrest_label, label in list(self._pgbackrest_labels.items()):
+                    if pgbackrest_label not in seen:
+                        backup = self._backups[label]
+                        if backup.pgbackrest_only:
+                            removed.append(backup)
+                        else:
+                            changed.append((backup, {}))
+
+                for backup in removed:
+                    self.remove(backup)
+
+                for backup in added:
+                    existing = self.add(backup)
+                    if existing is not backup:
+                        changed.append((existing, backup.pgbackrest_info))
+
+                for backup, info in changed:
+                    backup.update(pgbackrest_info=info)
+            finally:
+                batch, self._batch = self._batch, None
+
+        if batch:
+            self._notify(list({b.label: b for b in batch}.values()))
+
+        return len(added) + len(changed) + len(removed)
+
+    def status_counts(self):
+        with self.lock:
+            return {status: len(labels) for status, labels in self._status_labels.items()}
+
+    def get(self, label):
+        """Get the backup identified by either our label or the pgBackRest label"""
+        with self.lock:
+            backup = self._backups.get(label)
+            if backup is None and label in self._pgbackrest_labels:
+                backup = self._backups[self._pgbackrest_labels[label]]
+
+            return backup
+
+    def labels(self, statuses=None, since=None, before=None, after=None, limit=None):
+        """Returns the labels of the backups in order
+
+        The labels can be restricted to the given statuses, to the labels from since up to (not
+        including) before, to the labels after the given label, and to at most limit labels.
+        Only the requested range of the indexes is visited, so the cost of this call depends
+        on the number of labels returned, not on the size of the history."""
+        with self.lock:
+            if statuses is None:
+                indexes = [self._labels]
+            else:
+                indexes = [self._status_labels.get(s, []) for s in set(statuses)]
+
+            ranges = []
+            for labels in indexes:
+                lo = max(bisect.bisect_left(labels, since) if since else 0, bisect.bisect_right(labels, after) if after else 0)
+                hi = bisect.bisect_left(labels, before) if before else len(labels)
+                # map binds this index now, a generator expression would read the last one of the loop
+                ranges.append(map(labels.__getitem__, range(lo, hi)))
+
+            return list(itertools.islice(heapq.merge(*ranges), limit))
+
+    def latest(self, statuses=None):
+        """Returns the most recent backup, optionally only for the given statuses"""
+        with self.lock:
+            if statuses is None:
+                labels = [self._labels[-1:]]
+            else:
+                labels = [self._status_labels.get(s, [])[-1:] for s in set(statuses)]
+            latest = max([label for ll in labels for label in ll], default=None)
+
+            return self._backups[latest] if latest else None
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class BackupQueue ():
+    """This Class holds the backups that have been requested, but are not yet running
+
+    Backups are run one at a time, in order of priority (highest first) and then in the order
+    they were requested. Requests that would duplicate a backup that is still waiting are
+    coalesced: the request is answered with the waiting backup, which, if needed, is upgraded
+    to the most inclusive type (full > diff > incr) and the highest priority of the two.
+    This means an incr requested while a full is waiting will not result in an extra backup."""
+    def __init__(self, history, stanza, max_queued=10):
+        self.history = history
+        self.stanza = stanza
+        self.max_queued = max_queued
+        self.condition = Condition()
+        self.current = None
+        self.closed = False
+        self._heap = []
+        self._sequence = itertools.count()
+
+    @staticmethod
+    def _options(request):
+        return {k: v for k, v in request.items() if k not in ('type', 'priority')}
+
+    def pending(self):
+        """Returns the waiting backups, in the order they will run"""
+        with self.condition:
+            return [backup for _, _, backup in sorted(self._heap)]
+
+    def put(self, request):
+        """Queue a backup for the given request
+
+        Returns the backup that will fulfill the request, and whether or not it was newly queued"""
+        backup = PostgreSQLBackup(request=request, stanza=self.stanza)
+        with self.condition:
+            for idx, (_, sequence, pending) in enumerate(self._heap):
+                if self._options(pending.request) != self._options(backup.request):
+                    continue
+                upgraded = dict(pending.request,
+                                type=max(pending.request['type'], backup.request['type'], key=BACKUP_TYPES.index),
+                                priority=max(pending.request['priority'], backup.request['priority']))
+                if upgraded != pending.request:
+                    logging.info('Upgrading queued backup {0} to {1}'.format(pending.label, upgraded))
+                    pending.update(request=upgraded)
+                    self._heap[idx] = (-upgraded['priority'], sequence, pending)
+                    heapq.heapify(self._heap)
+                return pending, False
+
+            if len(self._heap) >= self.max_queued:
+                raise QueueFullError('{0} backups are already waiting'.format(len(self._heap)))
+
+            self.history.add(backup, unique=True)
+            heapq.heappush(self._heap, (-backup.request['priority'], next(self._sequence), backup))
+            self.condition.notify_all()
+
+            return backup, True
+
+    def get(self):
+        """Wait for the next backup to run, returns None if the queue is closed"""
+        with self.condition:
+            self.condition.wait_for(lambda: self._heap or self.closed)
+            if self.closed:
+                return None
+            _, _, self.current = heapq.heappop(self._heap)
+
+            return self.current
+
+    def done(self):
+        with self.condition:
+            self.current = None
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class BackupSlots ():
+    """Limits the number of backups running concurrently, across all stanzas
+
+    Every backup shares the cpu, disk and network of the node with the other backups, and
+    with PostgreSQL itself. A backup thread that got a backup from its queue waits for a free
+    slot before starting pgBackRest."""
+    def __init__(self, limit=1):
+        self.limit = limit
+        self.running = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def acquire(self):
+        """Waits for a free slot, returns False if we are shutting down instead"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.running < self.limit or self.closed)
+            if self.closed:
+                return False
+            self.running += 1
+
+            return True
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Stanza ():
+    """This Class holds everything this program keeps for a single stanza
+
+    Every stanza has its own backup history, its own backup queue, and its own trigger to
+    refresh the history, so a slow pgBackRest info for one stanza does not delay the others."""
+    def __init__(self, name, max_queued=10):
+        self.name = name
+        self.history = BackupHistory()
+        self.queue = BackupQueue(self.history, name, max_queued=max_queued)
+        self.history_trigger = Event()
+        # The archive section of pgBackRest info, which tells us the WAL that is available
+        self.archive = []
+
+    def status(self):
+        return {'stanza': self.name, 'backups': len(self.history), 'refresh': self.history.refreshed,
+                'current': self.queue.current.label if self.queue.current else None,
+                'queued': [b.label for b in self.queue.pending()]}
+
+    def restore_plan(self, target=None, samples=10):
+        """Returns what a restore to the target time (or the end of the WAL) would take
+
+        As pgBackRest does, we restore the most recent backup that was finished before the
+        target. Restoring it means fetching the full backup set from the repository: the files
+        of the backup itself and those it references in the backups before it (its chain).
+        After that, the WAL from the start of the backup up to the target has to be replayed.
+        As we do not know in which segment the target is, the WAL up to the start of the next
+        backup, or the last archived WAL, is reported as an upper bound.
+
+        The duration is estimated from the throughput of the most recent full backups, assuming
+        both restoring and replaying WAL run at that rate. Returns None if there is no backup to
+        restore."""
+        with self.history.lock:
+            before = backup_label(target + datetime.timedelta(seconds=1)) if target else None
+            labels = self.history.labels(['FINISHED'], before=before)
+            backup = None
+            for label in reversed(labels):
+                candidate = self.history.get(label)
+                timestamp = candidate.pgbackrest_info.get('timestamp') or {}
+                if candidate.pgbackrest_info.get('error') or 'stop' not in timestamp:
+                    continue
+                if target is None or EPOCH + datetime.timedelta(seconds=timestamp['stop']) <= target:
+                    backup = candidate
+                    break
+            if backup is None:
+                return None
+
+            following = [self.history.get(label) for label in self.history.labels(['FINISHED'], after=backup.label, limit=samples)]
+            references = [self.history.get(label) for label in backup.pgbackrest_info.get('reference') or []]
+            # The most recent throughput is the best predictor, also for restores to an older target
+            throughputs = []
+            for label in reversed(self.history.labels(['FINISHED'])):
+                candidate = self.history.get(label)
+                throughput = candidate.throughput() if candidate.pgbackrest_info.get('type') == 'full' else None
+                if throughput:
+                    throughputs.append(throughput['database'])
+                    if len(throughputs) == samples:
+                        break
+
+        info = backup.pgbackrest_info
+        sizes = info.get('info') or {}
+        chain = sorted(((b.pgbackrest_info.get('label'), b.pgbackrest_info.get('type'), (b.pgbackrest_info.get('info') or {}).get('repository', {}).get('delta'))
+                        for b in references if b is not None), key=lambda c: c[0] or '')
+        chain.append((info.get('label'), info.get('type'), sizes.get('repository', {}).get('delta')))
+
+        wal_start = (info.get('archive') or {}).get('start')
+        wal_stop = next((b.pgbackrest_info['archive']['start'] for b in following
+                         if b is not None and (b.pgbackrest_info.get('archive') or {}).get('start')), None)
+        if wal_stop is None:
+            wal_stop = max((a.get('max') for a in self.archive if a.get('max')), default=None)
+        segments = None
+        if wal_start and wal_stop and wal_start[:8] == wal_stop[:8]:
+            segments = max(wal_segment_number(wal_stop) - wal_segment_number(wal_start) + 1, 0)
+
+        plan = {'stanza': self.name, 'target_time': target, 'backup': backup.label, 'pgbackrest_label': info.get('label'), 'type': info.get('type'),
+                'backup_finished': EPOCH + datetime.timedelta(seconds=info['timestamp']['stop']),
+                'chain': [{'label': label, 'type': backup_type, 'repository_bytes': size} for label, backup_type, size in chain],
+                'bytes': {'repository': sizes.get('repository', {}).get('size'), 'database': sizes.get('size'),
+                          'wal': segments * WAL_SEGMENT_SIZE if segments is not None else None},
+                'wal': {'start': wal_start, 'stop': wal_stop, 'segments': segments},
+                'estimate': None}
+
+        if throughputs and sizes.get('size') is not None:
+            rate = sorted(throughputs)[len(throughputs) // 2]
+            plan['estimate'] = {'bytes_per_second': rate, 'backups': len(throughputs),
+                                'restore_seconds': sizes['size'] / rate,
+                                'seconds': (sizes['size'] + (plan['bytes']['wal'] or 0)) / rate}
+
+        return plan
+
+
+class CronSchedule ():
+    """A cron expression: minute hour day-of-month month day-of-week
+
+    Supports *, ranges (1-5), steps (*/15, 1-30/5) and lists (1,15). As with cron, if both
+    day-of-month and day-of-week are restricted, a day matches if either one matches."""
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError('Invalid cron expression ({0}), expected 5 fields'.format(expression))
+
+        self.expression = expression
+        self.values = [self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)]
+        # Sunday is both 0 and 7
+        if 7 in self.values[4]:
+            self.values[4].add(0)
+        self.restricted = [not field.startswith('*') for field in fields]
+
+    def _parse(self, field, low, high):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            try:
+                if value_range == '*':
+                    start, stop = low, high
+                elif '-' in value_range:
+                    start, stop = [int(v) for v in value_range.split('-', 1)]
+                else:
+                    start = stop = int(value_range)
+                    if step:
+                        stop = high
+                step = int(step) if step else 1
+            except ValueError:
+                raise ValueError('Invalid cron field ({0}) in expression {1}'.format(field, self.expression))
+            if start < low or stop > high or start > stop or step < 1:
+                raise ValueError('Cron field ({0}) out of range {1}-{2}'.format(field, low, high))
+            values.update(range(start, stop + 1, step))
+
+        return values
+
+    def matches(self, timestamp):
+        minutes, hours, days, months, weekdays = self.values
+        if timestamp.minute not in minutes or timestamp.hour not in hours or timestamp.month not in months:
+            return False
+
+        day, weekday = timestamp.day in days, timestamp.isoweekday() % 7 in weekdays
+        if self.restricted[2] and self.restricted[4]:
+            return day or weekday
+        return day and weekday
+
+
+class BackupJournal ():
+    """Persists the backup history in an append-only journal
+
+    Without a journal, the history is empty after a restart of this program, until pgBackRest
+    info has run, which may take minutes for large repositories. Also, the backups that were
+    triggered using the api, but never made it into the repository (ERROR), would be forgotten.
+
+    Every time a backup is added or modified, its state is appended to the journal as a single
+    line of json. The listener only serializes the state, the lines are written and flushed to
+    disk by a writer thread, so slow storage never stalls the callers, who may hold the locks of
+    the queue or the server. The writer writes all lines that piled up in one go, with a single
+    fsync. When restoring, later lines for the same backup
+    override earlier lines. A backup that is removed from the history is recorded as such, so
+    it is not restored. A line that is incomplete, because we crashed while writing it,
+    is ignored. After restoring, the journal is compacted: it is rewritten to a new file
+    containing a single line per backup, which then atomically replaces the journal."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.closed = False
+        self._file = None
+        self._lines = []
+        self._writer = None
+
+    @staticmethod
+    def _record(backup):
+        return {'label': backup.label, 'stanza': backup.stanza, 'status': backup.status, 'request': backup.request,
+                'started': backup.started, 'finished': backup.finished, 'returncode': backup.returncode,
+                'settings': backup.settings, 'pgbackrest': backup.pgbackrest_info}
+
+    @staticmethod
+    def _backup(record):
+        def timestamp(value):
+            return datetime.datetime.fromisoformat(value) if value else None
+
+        backup = PostgreSQLBackup(stanza=record['stanza'], request=record['request'], status=record['status'],
+                                  started=timestamp(record['started']), finished=timestamp(record['finished']))
+        backup.label = record['label']
+        backup.returncode = record['returncode']
+        backup.settings = record.get('settings', {})
+        backup.pgbackrest_info = record['pgbackrest']
+
+        # Whatever was running when we stopped, is not running anymore
+        if backup.status not in FINAL_STATUSES:
+            backup.status = 'ERROR'
+
+        return backup
+
+    def restore(self, histories):
+        """Adds the backups in the journal to the history of their stanza and compacts the journal
+
+        histories is a dictionary of stanza: BackupHistory, backups of other stanzas are kept as is"""
+        records = OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning('Ignoring corrupt line {0} of journal {1}'.format(lineno, self.path))
+                        continue
+                    key = (record['stanza'], record['label'])
+                    # Older journals kept the expired backups pgBackRest reported, without their info
+                    if record.get('removed') or (record['status'] == 'FINISHED' and record['returncode'] is None
+                                                 and not record['pgbackrest']):
+                        records.pop(key, None)
+                    else:
+                        records[key] = record
+
+        for record in records.values():
+            if record['stanza'] in histories:
+                histories[record['stanza']].add(self._backup(record))
+
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in records.values():
+                    if record['stanza'] in histories:
+                        record = self._record(histories[record['stanza']].get(record['label']))
+                    f.write(json.dumps(record, sort_keys=True, default=json_serial) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._writer = Thread(target=self._write, name='journal', daemon=True)
+            self._writer.start()
+
+        logging.info('Restored {0} backups from journal {1}'.format(sum(len(h) for h in histories.values()), self.path))
+
+    def append(self, backups):
+        """Appends the current state of the backups to the journal, to be used as a BackupHistory listener"""
+        lines = []
+        for backup in backups:
+            if backup.history is not None and backup.label not in backup.history:
+                record = {'label': backup.label, 'stanza': backup.stanza, 'removed': True}
+            else:
+                record = self._record(backup)
+            lines.append(json.dumps(record, sort_keys=True, default=json_serial) + '\n')
+
+        with self.condition:
+            if self._file is None or self.closed:
+                return
+            self._lines.extend(lines)
+            self.condition.notify()
+
+    def _write(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self._lines or self.closed)
+                if not self._lines:
+                    return
+                lines, self._lines = self._lines, []
+            try:
+                self._file.write(''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                logging.error('Could not write to journal {0}: {1}'.format(self.path, e))
+
+    def close(self):
+        """Writes the lines that are still pending and stops the writer"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self._writer is not None:
+            self._writer.join()
+            self._file.close()
+
+
+class ResponseCache ():
+    """Holds encoded response bodies, to prevent serializing the same data for every request
+
+    Every entry is stored together with the version of the data it was built from; an entry
+    is only returned if the version asked for is the same. The least recently used entries
+    are evicted when the cache grows beyond maxsize."""
+    def __init__(self, maxsize=256):
         self.lock = Lock()
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+
+            return entry[1]
+
+    def put(self, key, version, contents):
+        with self.lock:
+            self._entries[key] = (version, contents)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class EventHTTPServer(ThreadingHTTPServer):
+    """Wraps around ThreadingHTTPServer to provide a global Lock to serialize access to the backup
+
+    Requests are handled in their own thread. To ensure a flood of requests cannot exhaust
+    the sidecar, at most max_requests are handled concurrently; any request beyond that
+    is answered with a 503 straight away, without parsing it.
+
+    Event streams and long-polls can take minutes, they move to one of max_streams places of
+    their own (see start_streaming), so they never take the place of a short request."""
+    daemon_threads = True
+
+    def __init__(self, *args, max_requests=16, max_streams=16, **kwargs):
+        ThreadingHTTPServer.__init__(self, *args, **kwargs)
+        self.lock = TimedLock(LOCK_HOLD_DURATION, lock='server')
+        self.requests_in_flight = BoundedSemaphore(max_requests)
+        self.streams_in_flight = BoundedSemaphore(max_streams)
+        self.response_cache = ResponseCache()
+        # The semaphore the request handled by the current thread holds a place of
+        self.slot = local()
+
+    def process_request(self, request, client_address):
+        if not self.requests_in_flight.acquire(blocking=False):
+            logging.warning('Too many requests in flight, refusing request from {0}'.format(client_address[0]))
+            try:
+                request.sendall(b'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+
+        try:
+            ThreadingHTTPServer.process_request(self, request, client_address)
+        except Exception:
+            self.requests_in_flight.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        self.slot.semaphore = self.requests_in_flight
+        try:
+            ThreadingHTTPServer.process_request_thread(self, request, client_address)
+        finally:
+            self.slot.semaphore.release()
+
+    def start_streaming(self):
+        """Moves the request handled by the current thread from the requests in flight to the streams
+
+        Returns False if max_streams streams are in flight already"""
+        if self.slot.semaphore is self.streams_in_flight:
+            return True
+        if not self.streams_in_flight.acquire(blocking=False):
+            return False
+        self.requests_in_flight.release()
+        self.slot.semaphore = self.streams_in_flight
+        return True
 
 
 class RequestHandler(BaseHTTPRequestHandler):
-    """Serves the API for the pgBackRest backups"""
+    """Serves the API for the pgBackRest backups
+
+    All the /backups and /restore-plan routes are available for every stanza under
+    /stanzas/{stanza}, the routes without this prefix are served for the first stanza."""
+    STANZA_PREFIX = re.compile(r'^/stanzas/([^/]+)(?=/backups|/restore-plan)')
+    ROUTES = [(re.compile(r'^/stanzas/?$'), '/stanzas'),
+              (re.compile(r'^/stanzas/[^/]+/?$'), '/stanzas/{stanza}'),
+              (re.compile(r'^/backups/?$'), '/backups'),
+              (re.compile(r'^/backups/backup/[^/]+/?$'), '/backups/backup/{label}'),
+              (re.compile(r'^/backups/backup/[^/]+/events/?$'), '/backups/backup/{label}/events'),
+              (re.compile(r'^/backups/backup/[^/]+/log/?$'), '/backups/backup/{label}/log'),
+              (re.compile(r'^/restore-plan/?$'), '/restore-plan'),
+              (re.compile(r'^/status$'), '/status'),
+              (re.compile(r'^/metrics$'), '/metrics')]
+
+    def handle_one_request(self):
+        start = time.monotonic()
+        # A request line that can not be parsed is answered with an error before the command
+        # and path are set; they should not be mistaken for those of the previous request
+        self.response_code = self.command = self.path = None
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if self.response_code is not None:
+            route = 'other'
+            if self.path is not None:
+                path = urllib.parse.urlsplit(self.path).path
+                prefix = '/stanzas/{stanza}' if self.STANZA_PREFIX.match(path) else ''
+                path = self.STANZA_PREFIX.sub('', path)
+                route = next((prefix + r for regex, r in self.ROUTES if regex.match(path)), route)
+            HTTP_REQUEST_DURATION.observe(time.monotonic() - start, method=self.command or 'other', route=route,
+                                          code=self.response_code)
+
+    def send_response(self, code, message=None):
+        self.response_code = int(code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
 
     def _write_response(self, status_code, body, content_type='text/html', headers=None):
         self.send_response(status_code)
         headers = headers or {}
         if content_type:
             headers['Content-Type'] = content_type
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        headers['Content-Length'] = str(len(body))
         for name, value in headers.items():
             self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(body.encode('utf-8'))
+        self.wfile.write(body)
+
+    def _stanza(self, url):
+        """Returns the stanza, the path within the stanza, and the prefix of the path
+
+        Returns None for the stanza if the stanza does not exist"""
+        match = self.STANZA_PREFIX.match(url.path)
+        if match is None:
+            return next(iter(stanzas.values())), url.path, ''
+
+        name = urllib.parse.unquote(match.group(1))
+        return stanzas.get(name), url.path[match.end():], match.group(0)
+
+    def _start_streaming(self):
+        """Called before streaming events or waiting for a change, returns False (after responding
+        with a 503) if there are too many of those in flight already"""
+        if self.server.start_streaming():
+            return True
+        self._write_json_response(status_code=HTTPStatus.SERVICE_UNAVAILABLE, body={'error': 'too many streams in flight'},
+                                  headers={'Retry-After': '1'})
+        return False
 
     def _write_json_response(self, status_code, body, headers=None):
         contents = json.dumps(body, sort_keys=True, indent=4, default=json_serial)
         self._write_response(status_code, contents, content_type='application/json', headers=headers)
 
+    def _write_cached_json_response(self, etag, version, body_function, query, headers=None):
+        """Write a json response, using the cached encoded body if it is still valid
+
+        etag is the ETag for the current representation of the resource; if the client
+        already has this representation we respond with 304 Not Modified without building
+        the body. version identifies the data the body is built from, if an encoded body
+        for this version is cached we use that, otherwise body_function is used to build it.
+
+        Clients can ask for compact json using the compact query parameter and for
+        a gzipped response using the Accept-Encoding header."""
+        headers = dict(headers or {}, **{'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'})
+
+        # If-None-Match uses the weak comparison, so we ignore the weak indicator W/
+        def opaque_tag(tag):
+            tag = tag.strip()
+            return tag[2:] if tag.startswith('W/') else tag
+
+        if_none_match = [opaque_tag(t) for t in self.headers.get('If-None-Match', '').split(',')]
+        if '*' in if_none_match or opaque_tag(etag) in if_none_match:
+            self._write_response(status_code=HTTPStatus.NOT_MODIFIED, body='', content_type=None, headers=headers)
+            return
+
+        compact = query.get('compact', ['false'])[-1].lower() in TRUE_VALUES
+        encodings = [e.split(';')[0].strip() for e in self.headers.get('Accept-Encoding', '').split(',')]
+        gzipped = 'gzip' in encodings
+
+        cache = self.server.response_cache
+        key = (self.path, compact, gzipped)
+        contents = cache.get(key, version)
+        if contents is None:
+            if compact:
+                contents = json.dumps(body_function(), sort_keys=True, separators=(',', ':'), default=json_serial).encode('utf-8')
+            else:
+                contents = json.dumps(body_function(), sort_keys=True, indent=4, default=json_serial).encode('utf-8')
+            if gzipped:
+                contents = gzip.compress(contents)
+            cache.put(key, version, contents)
+
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+        self._write_response(status_code=HTTPStatus.OK, body=contents, content_type='application/json', headers=headers)
+
+    @staticmethod
+    def _etag(backup):
+        # The details contain the age of the backup, which changes every second. That
+        # does not make it a different backup, so the ETag is a weak one
+        return 'W/"{0}-{1}-{2}"'.format(BOOT_ID, backup.label, backup.version)
+
+    def _write_event_stream(self, backup):
+        """Stream the events of the backup as Server-Sent Events
+
+        The first event (backup) contains the backup info as it is now, after that every
+        state transition (status) and every line of output (log) of the backup is sent. If
+        lines of output were dropped from the log buffer before they could be sent, a dropped
+        event is sent. A client that reconnects can pass the Last-Event-ID header to resume
+        the stream. Once the backup is finished, an end event is sent and the stream is closed.
+
+        The id of the events is the combination of the last event id and the next log offset."""
+        try:
+            last_id, next_line = [int(i) for i in self.headers.get('Last-Event-ID', '0:0').split(':')]
+        except ValueError:
+            last_id, next_line = 0, 0
+
+        def write_event(event, data, event_id=None):
+            message = 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data, sort_keys=True, default=json_serial))
+            if event_id is not None:
+                message = 'id: {0}\n'.format(event_id) + message
+            self.wfile.write(message.encode('utf-8'))
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        try:
+            write_event('backup', backup.info())
+            while True:
+                # We wake up regularly to send a comment, which ensures dead connections are detected
+                def pending(b):
+                    return b.event_id > last_id or (b.log is not None and b.log.total > next_line) or b.status in FINAL_STATUSES
+
+                backup.wait(pending, timeout=15)
+                with backup.changed:
+                    events = [(offset, 0, event_id, event, data) for event_id, offset, event, data in backup.events or [] if event_id > last_id]
+                    first, total, lines = backup.read_log(offset=next_line)
+                    finished = backup.status in FINAL_STATUSES
+
+                if first > next_line:
+                    write_event('dropped', {'lines': first - next_line})
+                    next_line = first
+
+                events += [(offset, 1, None, 'log', {'time': EPOCH + datetime.timedelta(seconds=epoch),
+                                                     'level': logging.getLevelName(loglevel),
+                                                     'message': message}) for offset, epoch, loglevel, message in lines]
+                events.sort(key=lambda e: e[:2])
+                for offset, _, event_id, event, data in events:
+                    if event_id is None:
+                        next_line = offset + 1
+                    else:
+                        last_id = event_id
+                    write_event(event, data, '{0}:{1}'.format(last_id, next_line))
+                if finished:
+                    write_event('end', backup.info())
+                    break
+                if not events:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug('Client {0} disconnected from event stream'.format(self.address_string()))
+
     # We override the default BaseHTTPRequestHandler.log_message to have uniform logging output to stdout
     def log_message(self, format, *args):
         logging.info(("%s - - %s\n" % (self.address_string(), format % args)).rstrip())
@@ -214,49 +1690,196 @@ class RequestHandler(BaseHTTPRequestHandler):
         /backups/{label}  get specific backup info for given label
                           accepts timestamp label as well as pgBackRest label
         /backups/{latest} shorthand for getting the backup info for the latest backup
+        /backups/{label}/events
+                          stream the events (state transitions and output) of the backup
+                          as Server-Sent Events, until the backup is finished
+        /backups/{label}/log
+                          the last lines of output of the backup, accepts the offset and tail
+                          query parameters
+        /restore-plan     the backup chain, bytes and WAL needed to restore to target_time, and
+                          an estimate of how long that takes
+        /status           information about this program, like the last history refresh
+        /stanzas          the stanzas served by this program
+        /metrics          metrics in the Prometheus text exposition format
 
         Query parameters:
         status            filter all backups for given status
+        since, until      only list backups in this time range, accepts ISO 8601 timestamps or a
+                          duration relative to now, like 24h. The range applies to the label, which
+                          is the time the backup was requested (or started, for the backups we only
+                          know of through pgBackRest); a queued backup starts later than that
+        limit, cursor     paginate the list of backups; if there are more backups, the response
+                          contains a Link header to the next page
+        fields            only return the given (comma separated) fields, dotted paths like
+                          pgbackrest.info.size select fields of nested documents
+        compact           return compact json instead of indented json
+        wait              for a single backup: wait at most this many seconds for the backup to
+                          change, compared to the ETag passed in If-None-Match, or compared to
+                          the moment of the request
+        offset, tail      for the log of a backup: only return the lines from this offset onwards,
+                          or only return the last tail lines
+        target_time       for the restore plan: the point in time to restore to, defaults to the
+                          end of the WAL
+
+        Responses carry an ETag, by sending it back in the If-None-Match header a client gets a
+        304 Not Modified if nothing changed. Responses are gzipped if the client accepts gzip.
 
         Example:   /backups/latest?status=ERROR
         Would list the last backup that failed
-        """
-        global backup_history
 
+        Example:   /backups?since=24h&fields=label,status,pgbackrest.info.size
+        Would list the label, status and size of the backups of the last 24 hours
+
+        Example:   /stanzas/poddb/backups/backup/latest
+        Would show the details of the latest backup of stanza poddb
+        """
         url = urllib.parse.urlsplit(self.path)
         query = urllib.parse.parse_qs(url.query)
+        stanza, path, prefix = self._stanza(url)
+        if stanza is None:
+            self._write_json_response(status_code=HTTPStatus.NOT_FOUND, body={'error': 'unknown stanza'})
+            return
+        backup_history = stanza.history
 
-        # /backups/         list all backups
-        backup_labels = sorted(backup_history, key=lambda b: backup_history[b].label)
-        if query.get('status', None):
-            for b in backup_labels[:]:
-                if backup_history[b].status not in [s.upper() for s in query['status']]:
-                    backup_labels.remove(b)
+        statuses = [s.upper() for s in query['status']] if query.get('status', None) else None
+        fields = [f for value in query.get('fields', []) for f in value.split(',') if f]
+
+        def backup_body(backup, summary):
+            if fields:
+                return project(backup.details(), fields)
+            return backup.info() if summary else backup.details()
 
-        if url.path == '/backups' or url.path == '/backups/':
-            body = [backup_history[b].info() for b in backup_labels]
-            self._write_json_response(status_code=200, body=body)
+        # /backups/         list all backups
+        if path == '/backups' or path == '/backups/':
+            try:
+                since = query.get('since', [None])[-1]
+                since = backup_label(parse_timestamp(since) + datetime.timedelta(microseconds=999999)) if since else None
+                until = query.get('until', [None])[-1]
+                before = backup_label(parse_timestamp(until) + datetime.timedelta(seconds=1)) if until else None
+                limit = int(query['limit'][-1]) if query.get('limit') else None
+                if limit is not None and limit < 1:
+                    raise ValueError('limit should be a positive integer')
+            # A duration like 99999999d, or a timestamp at the end of time, does not fit in a datetime
+            except (ValueError, OverflowError) as ve:
+                self._write_json_response(status_code=HTTPStatus.BAD_REQUEST, body={'error': str(ve)})
+                return
+            cursor = query.get('cursor', [None])[-1]
+
+            # We fetch one more label than we need, to know whether or not there is a next page
+            with backup_history.lock:
+                generation = backup_history.generation
+                labels = backup_history.labels(statuses, since=since, before=before, after=cursor, limit=limit + 1 if limit else None)
+                # The progress of a backup changes its version, but not the generation of the history
+                versions = [backup_history.get(label).version for label in labels]
+
+            headers = {}
+            if limit and len(labels) > limit:
+                labels, versions = labels[:limit], versions[:limit]
+                next_query = dict(query, cursor=[labels[-1]])
+                headers['Link'] = '<{0}?{1}>; rel="next"'.format(url.path, urllib.parse.urlencode(next_query, doseq=True))
+
+            # As a relative since/until moves over time, the ETag depends on the backups that are selected.
+            # The gzipped and the compact bodies are not byte for byte the same, so the ETag is a weak one
+            digest = hashlib.sha1(','.join('{0}:{1}'.format(label, version) for label, version in zip(labels, versions))
+                                  .encode('utf-8')).hexdigest()[:16]
+            etag = 'W/"{0}-{1}-{2}"'.format(BOOT_ID, generation, digest)
+            # Fields like age change every second, so such a projection is only valid for the second it was made in
+            if any(f.split('.')[0] in TIME_DEPENDENT_FIELDS for f in fields):
+                etag = 'W/"{0}-{1}-{2}-{3}"'.format(BOOT_ID, generation, digest, backup_label(utcnow()))
+
+            def body_function():
+                return [backup_body(backup, summary=True) for backup in map(backup_history.get, labels) if backup]
+
+            self._write_cached_json_response(etag, etag, body_function, query, headers=headers)
 
         # /backups/{label} get specific backup info
         # /backups/latest  shorthand for getting the backup info for the latest backup
-        elif url.path.startswith('/backups/backup'):
-            backup_label = url.path.split('/')[3]
-            backup = None
-            if backup_label == 'latest' and backup_labels:
-                backup_label = backup_labels[-1]
-
-            backup = backup_history.get(backup_label, None)
-
-            # We also allow the backup label to be the one specified by pgBackRest
-            if backup is None:
-                for b in backup_history.values():
-                    if b.pgbackrest_info.get('info', None):
-                        backup = b
+        elif path.startswith('/backups/backup'):
+            parts = path.rstrip('/').split('/')
+            label = parts[3]
+            if label == 'latest':
+                backup = backup_history.latest(statuses)
+            else:
+                # We also allow the backup label to be the one specified by pgBackRest
+                backup = backup_history.get(label)
 
-            if backup is None:
+            if backup is None or len(parts) > 5 or (len(parts) == 5 and parts[4] not in ('events', 'log')):
                 self._write_response(status_code=HTTPStatus.NOT_FOUND, body='')
+            elif len(parts) == 5 and parts[4] == 'events':
+                if self._start_streaming():
+                    self._write_event_stream(backup)
+            elif len(parts) == 5 and parts[4] == 'log':
+                try:
+                    offset = int(query['offset'][-1]) if query.get('offset') else None
+                    tail = int(query['tail'][-1]) if query.get('tail') else None
+                except ValueError:
+                    self._write_json_response(status_code=HTTPStatus.BAD_REQUEST, body={'error': 'offset and tail should be integers'})
+                    return
+                first, total, lines = backup.read_log(offset, tail)
+                body = {'label': backup.label, 'first': first, 'next': total,
+                        'lines': [{'offset': o, 'time': EPOCH + datetime.timedelta(seconds=e), 'level': logging.getLevelName(lvl), 'message': m}
+                                  for o, e, lvl, m in lines]}
+                self._write_json_response(status_code=HTTPStatus.OK, body=body)
             else:
-                self._write_json_response(status_code=HTTPStatus.OK, body=backup.details())
+                if query.get('wait'):
+                    try:
+                        timeout = min(float(query['wait'][-1]), MAX_WAIT)
+                    except ValueError:
+                        self._write_json_response(status_code=HTTPStatus.BAD_REQUEST, body={'error': 'wait should be a number'})
+                        return
+                    if not self._start_streaming():
+                        return
+                    known = self.headers.get('If-None-Match')
+                    version = backup.version
+
+                    def changed(b):
+                        if b.status in FINAL_STATUSES:
+                            return known is None or b.version != version
+                        if known is not None:
+                            return self._etag(b) not in known
+                        return b.version != version
+
+                    backup.wait(changed, timeout)
+
+                version = (backup.label, backup.version, utcnow())
+                self._write_cached_json_response(self._etag(backup), version, lambda: backup_body(backup, summary=False), query)
+
+        # /restore-plan     what it takes to restore to the target_time, or to the end of the WAL
+        elif path == '/restore-plan' or path == '/restore-plan/':
+            try:
+                target = query.get('target_time', [None])[-1]
+                target = parse_timestamp(target) if target else None
+            except (ValueError, OverflowError) as ve:
+                self._write_json_response(status_code=HTTPStatus.BAD_REQUEST, body={'error': str(ve)})
+                return
+
+            plan = stanza.restore_plan(target)
+            if plan is None:
+                self._write_json_response(status_code=HTTPStatus.NOT_FOUND, body={'error': 'no backup to restore for this target'})
+            else:
+                self._write_json_response(status_code=HTTPStatus.OK, body=plan)
+
+        # /metrics          metrics in the Prometheus text exposition format
+        elif url.path == '/metrics':
+            body = '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+            self._write_response(status_code=HTTPStatus.OK, body=body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+        # /status           information about this program
+        elif url.path == '/status':
+            body = dict(stanza.status(), stanzas=[s.status() for s in stanzas.values()],
+                        running=backup_slots.running, max_backups=backup_slots.limit)
+            self._write_json_response(status_code=HTTPStatus.OK, body=body)
+
+        # /stanzas          the stanzas served by this program
+        # /stanzas/{stanza} the status of a single stanza
+        elif url.path.startswith('/stanzas'):
+            parts = url.path.rstrip('/').split('/')
+            if len(parts) == 2:
+                self._write_json_response(status_code=HTTPStatus.OK, body=[s.status() for s in stanzas.values()])
+            elif len(parts) == 3 and urllib.parse.unquote(parts[2]) in stanzas:
+                self._write_json_response(status_code=HTTPStatus.OK, body=stanzas[urllib.parse.unquote(parts[2])].status())
+            else:
+                self._write_response(status_code=HTTPStatus.NOT_FOUND, body='')
         else:
             self._write_response(status_code=HTTPStatus.NOT_FOUND, body='')
 
@@ -265,38 +1888,44 @@ class RequestHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         """POST a request to backup the database
 
-        If no backup is currently running, will trigger the backup thread to
-        start a backup that conforms to the request
+        The request is queued, the backup thread will start a backup that conforms to the
+        request once the backups before it are done. If an equivalent backup is already
+        waiting, no new backup is queued, but that backup is returned instead.
+
+        The request body is optional, and can specify:
+        type              the type of backup: full, diff or incr, defaults to full
+        priority          backups with a higher priority run first, defaults to 0
+        process-max       override the pgBackRest process-max
+        compress-type     override the pgBackRest compress-type
+        compress-level    override the pgBackRest compress-level
+        adaptive          pick process-max and compression based on the available cpus and load
         """
-        global backup_history, current_backup, stanza
-
         url = urllib.parse.urlsplit(self.path)
-        if url.path == '/backups' or url.path == '/backups/':
+        stanza, path, prefix = self._stanza(url)
+        if stanza is None:
+            self._write_json_response(status_code=HTTPStatus.NOT_FOUND, body={'error': 'unknown stanza'})
+        elif path == '/backups' or path == '/backups/':
             try:
                 content_len = int(self.headers.get('Content-Length', 0))
                 post_body = json.loads(self.rfile.read(content_len).decode("utf-8")) if content_len else None
+
                 with self.server.lock:
-                    if self.server.backup_trigger.is_set():
-                        headers = {'Location': '/backups/backup/{0}'.format(current_backup.label)}
-                        self._write_json_response(status_code=HTTPStatus.CONFLICT, body={'error': 'backup in progress'}, headers=headers)
+                    backup, _ = stanza.queue.put(post_body)
+
+                # We wait a second, just in case we quickly run into an error which we can report
+                if stanza.queue.current in (None, backup):
+                    backup.wait(lambda b: b.finished is not None, timeout=1)
+
+                if backup.finished:
+                    if backup.returncode == 0:
+                        self._write_json_response(status_code=HTTPStatus.OK, body=backup.details())
                     else:
-                        self.server.backup_trigger.set()
-                        current_backup = PostgreSQLBackup(request=post_body, stanza=stanza)
-                        backup_history[current_backup.label] = current_backup
-
-                        # We wait a few seconds just in case we quickly run into an error which we can report
-                        max_time = time.time() + 1
-                        while not current_backup.finished and time.time() < max_time:
-                            time.sleep(0.1)
-
-                        if current_backup.finished:
-                            if current_backup.returncode == 0:
-                                self._write_json_response(status_code=HTTPStatus.OK, body=current_backup.details())
-                            else:
-                                self._write_json_response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, body=current_backup.details())
-                        else:
-                            headers = {'Location': '/backups/backup/{0}'.format(current_backup.label)}
-                            self._write_json_response(status_code=HTTPStatus.ACCEPTED, body=current_backup.details(), headers=headers)
+                        self._write_json_response(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, body=backup.details())
+                else:
+                    headers = {'Location': '{0}/backups/backup/{1}'.format(prefix, backup.label)}
+                    self._write_json_response(status_code=HTTPStatus.ACCEPTED, body=backup.details(), headers=headers)
+            except QueueFullError as qfe:
+                self._write_json_response(status_code=HTTPStatus.TOO_MANY_REQUESTS, body={'error': str(qfe)}, headers={'Retry-After': '60'})
             except json.JSONDecodeError:
                 self._write_json_response(status_code=HTTPStatus.BAD_REQUEST, body={'error': 'invalid json document'})
             except ValueError as ve:
@@ -305,38 +1934,74 @@ class RequestHandler(BaseHTTPRequestHandler):
             self._write_response(status_code=HTTPStatus.NOT_FOUND, body='')
 
 
-def backup_poller(backup_trigger, history_trigger, shutdown_trigger):
-    """Run backups every time the backup_trigger is fired
+def backup_poller(stanza, backup_slots, shutdown_trigger):
+    """Run the backups in the queue of the stanza, one at a time
 
     Will stall for long amounts of time as backups can take hours/days.
     """
-    global backup_history, current_backup
-
     logging.info('Starting loop waiting for backup events')
     while not shutdown_trigger.is_set():
-        # This can probably be done more perfectly, but by sleeping 1 second we ensure 2 things:
-        # - backups can be identified by their timestamp with a resolution of 1 second
-        # - if there are any errors in the backup logic, we will not burn a single CPU in the while loop
-        time.sleep(1)
         try:
-            logging.debug('Waiting until backup triggered')
-            backup_trigger.wait()
-            if shutdown_trigger.is_set():
+            logging.debug('Waiting until backup queued')
+            # Blocks until a backup is queued or the queue is closed; a backup is taken off the
+            # queue before it runs, so even a failing backup will not make us loop without waiting
+            backup = stanza.queue.get()
+            if backup is None or shutdown_trigger.is_set():
                 break
 
-            current_backup.run()
-            history_trigger.set()
-            backup_trigger.clear()
+            logging.debug('Waiting for a backup slot')
+            if not backup_slots.acquire():
+                break
+
+            try:
+                backup.run()
+            finally:
+                # Whatever happened to this backup, the next backup should be able to start
+                backup_slots.release()
+                stanza.queue.done()
+            stanza.history_trigger.set()
         except Exception as e:
             logging.error(e)
-            # The currently running backup failed, we should clear the backup trigger
-            # so a next backup can be started
-            backup_trigger.clear()
 
     logging.warning('Shutting down thread')
 
 
-def history_refresher(history_trigger, shutdown_trigger, interval):
+def backup_scheduler(stanzas, schedules, shutdown_trigger):
+    """Queue backups according to the schedules, which are evaluated every minute in UTC
+
+    A schedule without a stanza applies to all stanzas. We wait on the monotonic clock, but
+    the schedules are in wall time; a wakeup that is early, or a clock that is set back,
+    should never evaluate the same minute twice, so every minute is evaluated at most once."""
+    logging.info('Scheduling backups: {0}'.format(', '.join('{0}{1}={2}'.format(s + ':' if s else '', t, c.expression)
+                                                            for s, t, c in schedules)))
+    last_minute = None
+    while not shutdown_trigger.is_set():
+        now = datetime.datetime.now(datetime.timezone.utc)
+        next_minute = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        if shutdown_trigger.wait(timeout=(next_minute - now).total_seconds()):
+            break
+
+        if last_minute is not None and next_minute <= last_minute:
+            continue
+        last_minute = next_minute
+
+        for schedule_stanza, backup_type, schedule in schedules:
+            if not schedule.matches(next_minute):
+                continue
+            for stanza in stanzas.values():
+                if schedule_stanza not in (None, stanza.name):
+                    continue
+                try:
+                    backup, queued = stanza.queue.put({'type': backup_type})
+                    logging.info('Scheduled {0} backup {1} for stanza {2} ({3})'.format(backup_type, backup.label, stanza.name,
+                                                                                      'queued' if queued else 'coalesced'))
+                except QueueFullError as qfe:
+                    logging.error('Could not schedule {0} backup for stanza {1}: {2}'.format(backup_type, stanza.name, qfe))
+
+    logging.warning('Shutting down thread')
+
+
+def history_refresher(stanza, shutdown_trigger, interval):
     """Refresh backup history regularly from pgBackRest
 
      Will refresh the history when triggered, on when a timeout occurs.
@@ -349,40 +2014,40 @@ def history_refresher(history_trigger, shutdown_trigger, interval):
     For details on what pgBackRest returns:
     https://pgbackrest.org/command.html#command-info/category-command/option-output
     """
-    global backup_history, stanza
+    backup_history = stanza.history
+    history_trigger = stanza.history_trigger
 
     while not shutdown_trigger.is_set():
-        time.sleep(1)
         try:
             history_trigger.wait(timeout=interval)
             if shutdown_trigger.is_set():
                 break
+            # We clear the trigger before refreshing, so a trigger that fires while we are
+            # refreshing results in another refresh, instead of being lost
+            history_trigger.clear()
 
             logging.info('Refreshing backup history using pgbackrest')
-            pgbackrest_out = check_output(['pgbackrest', '--stanza={0}'.format(stanza), 'info', '--output=json']).decode("utf-8")
-
-            for b in backup_history.values():
-                b.pgbackrest_info.clear()
-
-            backup_info = json.loads(pgbackrest_out)
-
-            if backup_info:
-                for b in backup_info[0].get('backup', []):
-                    pgb = PostgreSQLBackup(
-                        stanza=stanza,
-                        request=None,
-                        started=EPOCH + datetime.timedelta(seconds=b['timestamp']['start']),
-                        finished=EPOCH + datetime.timedelta(seconds=b['timestamp']['stop']),
-                        status='FINISHED'
-                    )
-                    backup_history.setdefault(pgb.label, pgb)
-                    backup_history[pgb.label].pgbackrest_info.update(b)
+            start = time.monotonic()
+            # We parse the output while pgBackRest is producing it, building the backups one
+            # at a time. As we only reconcile after pgBackRest succeeds, a failure halfway the
+            # output will never modify the history
+            def backups():
+                for key, value in pgbackrest_info(stanza.name):
+                    if key == 'backup':
+                        yield value
+                    elif key == 'archive':
+                        stanza.archive = value
+
+            changed = backup_history.reconcile(stanza.name, backups())
+
+            backup_history.refreshed = {'finished': utcnow(), 'duration': time.monotonic() - start, 'changed': changed}
+            HISTORY_REFRESH_DURATION.observe(backup_history.refreshed['duration'], stanza=stanza.name)
+            HISTORY_REFRESH_CHANGED.inc(changed, stanza=stanza.name)
+            logging.info('Refreshed backup history in {0:.3f}s, {1} backups changed'.format(backup_history.refreshed['duration'], changed))
         # This thread should keep running, as it only triggers backups. Therefore we catch
         # all errors and log them, but The Thread Must Go On
         except Exception as e:
             logging.exception(e)
-        finally:
-            history_trigger.clear()
 
     logging.warning('Shutting down thread')
 
@@ -391,41 +2056,66 @@ def main(args):
     """This is the core program
 
     To aid in testing this, we expect args to be a dictionary with already parsed options"""
-    global stanza
+    global stanzas, backup_slots
 
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s', level=LOGLEVELS[args['loglevel'].lower()])
-    stanza = args['stanza']
+    PostgreSQLBackup.LOG_LINES = args['log_lines']
+    PostgreSQLBackup.ADAPTIVE = args['adaptive']
+    PostgreSQLBackup.PROGRESS_INTERVAL = args['progress_interval']
+    stanzas = OrderedDict((name, Stanza(name, max_queued=args['max_queued'])) for name in args['stanzas'])
+    backup_slots = BackupSlots(args['max_backups'])
+    for stanza in stanzas.values():
+        stanza.history.listeners.append(update_backup_metrics)
+
+    # We answer from the journal while the history is refreshed using pgBackRest in the background
+    journal = None
+    if args['journal']:
+        journal = BackupJournal(args['journal'])
+        journal.restore({name: stanza.history for name, stanza in stanzas.items()})
+        for stanza in stanzas.values():
+            stanza.history.listeners.append(journal.append)
 
     shutdown_trigger = Event()
-    backup_trigger = Event()
-    history_trigger = Event()
 
-    backup_thread = Thread(target=backup_poller, args=(backup_trigger, history_trigger, shutdown_trigger), name='backup')
-    history_thread = Thread(target=history_refresher, name='history', args=(history_trigger, shutdown_trigger, 3600))
+    threads = []
+    for stanza in stanzas.values():
+        suffix = '-{0}'.format(stanza.name) if len(stanzas) > 1 else ''
+        threads.append(Thread(target=backup_poller, name='backup' + suffix, args=(stanza, backup_slots, shutdown_trigger)))
+        threads.append(Thread(target=history_refresher, name='history' + suffix, args=(stanza, shutdown_trigger, 3600)))
+    if args['schedule']:
+        threads.append(Thread(target=backup_scheduler, name='scheduler', args=(stanzas, args['schedule'], shutdown_trigger)))
 
     server_address = ('', args['port'])
-    httpd = EventHTTPServer(backup_trigger, server_address, RequestHandler)
-    httpd_thread = Thread(target=httpd.serve_forever, name='http')
+    httpd = EventHTTPServer(server_address, RequestHandler, max_requests=args['max_requests'],
+                            max_streams=args['max_streams'])
+    # serve_forever only notices a shutdown every poll_interval, the default of 0.5s would dominate the time
+    # it takes us to exit; a select that wakes up 10 times a second is cheap
+    httpd_thread = Thread(target=httpd.serve_forever, name='http', kwargs={'poll_interval': 0.1})
 
     # For cleanup, we will trigger all events when signaled, all the threads
     # will investigate the shutdown trigger before acting on their individual
-    # triggers
+    # triggers. A running backup is allowed to finish.
     def sigterm_handler(_signo, _stack_frame):
         logging.warning('Received kill {0}, shutting down'.format(_signo))
         shutdown_trigger.set()
-        backup_trigger.set()
-        history_trigger.set()
+        backup_slots.close()
+        for stanza in stanzas.values():
+            stanza.queue.close()
+            stanza.history_trigger.set()
         httpd.shutdown()
 
-        while backup_thread.is_alive() or history_thread.is_alive() or httpd_thread.is_alive():
-            time.sleep(1)
+        for t in threads + [httpd_thread]:
+            t.join()
+        if journal is not None:
+            journal.close()
 
     signal.signal(signal.SIGINT, sigterm_handler)
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-    backup_thread.start()
-    history_trigger.set()
-    history_thread.start()
+    for stanza in stanzas.values():
+        stanza.history_trigger.set()
+    for t in threads:
+        t.start()
     httpd_thread.start()
 
 
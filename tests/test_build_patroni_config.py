@@ -0,0 +1,44 @@
+import copy
+import glob
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import configure_spilo  # noqa: E402
+
+# Every file holds the placeholders of a scenario, and the Patroni configuration the pystache TEMPLATE, which
+# build_patroni_config replaced, rendered for them. None of the values contain a character mustache escaped.
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden', 'patroni')
+
+
+def load_golden(name):
+    with open(os.path.join(GOLDEN_DIR, name + '.json')) as f:
+        return json.load(f)
+
+
+class TestBuildPatroniConfig(unittest.TestCase):
+
+    def test_golden(self):
+        filenames = sorted(glob.glob(os.path.join(GOLDEN_DIR, '*.json')))
+        self.assertTrue(filenames)
+        for filename in filenames:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            with self.subTest(name):
+                golden = load_golden(name)
+                self.assertEqual(configure_spilo.build_patroni_config(golden['placeholders']), golden['expected'])
+
+    def test_values_are_not_escaped(self):
+        # The template HTML-escaped every value, the password ended up as it&#x27;s&amp;&lt;x&gt;
+        golden = load_golden('pam_admin_callback')
+        placeholders = dict(golden['placeholders'], PGPASSWORD_SUPERUSER="it's&<x>", PGPASSWORD_ADMIN='123')
+        expected = copy.deepcopy(golden['expected'])
+        expected['postgresql']['authentication']['superuser']['password'] = "it's&<x>"
+        expected['bootstrap']['users']['admin']['password'] = '123'
+        self.assertEqual(configure_spilo.build_patroni_config(placeholders), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
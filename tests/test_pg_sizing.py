@@ -0,0 +1,119 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import pg_sizing  # noqa: E402
+
+GB = 1024 ** 3
+HOST_MEMORY = 64 * GB
+HOST_CPUS = 16
+V1_UNLIMITED = '9223372036854771712'
+
+# The contents of the cgroup files, the expected memory (in MB) and cpus, and where these come from
+RESOURCES = [
+    ('v2', {'memory.max': str(4 * GB), 'cpu.max': '200000 100000'}, (4096, 2, 'cgroup', 'cgroup')),
+    ('v2 max', {'memory.max': 'max', 'cpu.max': 'max 100000'}, (65536, 16, 'host', 'host')),
+    ('v2 fractional quota', {'memory.max': str(GB), 'cpu.max': '150000 100000'}, (1024, 2, 'cgroup', 'cgroup')),
+    ('v2 quota below one cpu', {'memory.max': str(GB), 'cpu.max': '25000 100000'}, (1024, 1, 'cgroup', 'cgroup')),
+    ('v2 above host', {'memory.max': str(128 * GB), 'cpu.max': '3200000 100000'}, (65536, 16, 'host', 'host')),
+    ('v1', {'memory/memory.limit_in_bytes': str(2 * GB), 'cpu/cpu.cfs_quota_us': '50000',
+            'cpu/cpu.cfs_period_us': '100000'}, (2048, 1, 'cgroup', 'cgroup')),
+    ('v1 unlimited', {'memory/memory.limit_in_bytes': V1_UNLIMITED, 'cpu/cpu.cfs_quota_us': '-1',
+                      'cpu/cpu.cfs_period_us': '100000'}, (65536, 16, 'host', 'host')),
+    ('v1 fractional quota', {'memory/memory.limit_in_bytes': str(GB // 2), 'cpu/cpu.cfs_quota_us': '250000',
+                             'cpu/cpu.cfs_period_us': '100000'}, (512, 3, 'cgroup', 'cgroup')),
+    ('no cgroup', {}, (65536, 16, 'host', 'host')),
+    ('corrupt cpu.max', {'cpu.max': 'garbage'}, (65536, 16, 'host', 'host')),
+]
+
+# The arguments of size_parameters and the parameters we expect (a subset of the ones it returns)
+PARAMETERS = [
+    ((16, 1, False, None), {'shared_buffers': '4MB', 'max_connections': 100, 'work_mem': '64kB'}),
+    ((512, 1, False, None), {
+        'shared_buffers': '128MB', 'max_connections': 100, 'effective_cache_size': '384MB',
+        'maintenance_work_mem': '32MB', 'max_parallel_workers_per_gather': 0, 'max_parallel_workers': 1,
+        'max_parallel_maintenance_workers': 0, 'timescaledb.max_background_workers': 16,
+        'max_worker_processes': 20, 'work_mem': '1310kB'}),
+    ((512, 2.5, False, None), {'max_parallel_workers': 2, 'max_parallel_workers_per_gather': 1}),
+    ((512, 0, False, None), {'max_parallel_workers': 1}),
+    ((65536, 16, True, None), {
+        'shared_buffers': '13107MB', 'max_connections': 1000, 'effective_cache_size': '49152MB',
+        'maintenance_work_mem': '2048MB', 'max_parallel_workers_per_gather': 8, 'max_parallel_workers': 16,
+        'max_parallel_maintenance_workers': 4, 'timescaledb.max_background_workers': 16,
+        'max_worker_processes': 35, 'work_mem': '2236kB'}),
+    ((256, 4, False, 'analytics'), {
+        'shared_buffers': '64MB', 'maintenance_work_mem': '16MB', 'max_parallel_workers_per_gather': 4,
+        'max_worker_processes': 23, 'work_mem': '245kB', 'max_wal_size': '1024MB', 'min_wal_size': '256MB',
+        'wal_compression': 'on', 'checkpoint_timeout': '5min', 'parallel_setup_cost': 500,
+        'autovacuum_max_workers': 3, 'autovacuum_vacuum_cost_limit': 800}),
+    ((8192, 2, False, 'ingest-heavy'), {
+        'shared_buffers': '2048MB', 'max_connections': 273, 'max_parallel_workers_per_gather': 0,
+        'max_worker_processes': 21, 'work_mem': '5761kB', 'max_wal_size': '8192MB', 'min_wal_size': '2048MB',
+        'wal_buffers': '64MB', 'wal_compression': 'off', 'checkpoint_timeout': '15min',
+        'autovacuum_max_workers': 3, 'autovacuum_vacuum_cost_limit': 1000}),
+    ((262144, 64, False, 'mixed'), {
+        'max_connections': 1000, 'maintenance_work_mem': '2048MB', 'max_parallel_workers_per_gather': 8,
+        'timescaledb.max_background_workers': 64, 'max_wal_size': '65536MB', 'wal_compression': 'on',
+        'autovacuum_max_workers': 10, 'autovacuum_vacuum_cost_limit': 10000}),
+]
+
+
+class TestDetectResources(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.saved = {}
+        for name in ('CGROUP_V2_MEMORY_MAX', 'CGROUP_V2_CPU_MAX', 'CGROUP_V1_MEMORY_LIMIT',
+                     'CGROUP_V1_CPU_QUOTA', 'CGROUP_V1_CPU_PERIOD', 'host_memory_bytes', 'host_cpus'):
+            self.saved[name] = getattr(pg_sizing, name)
+            value = self.saved[name]
+            if name.startswith('CGROUP'):
+                setattr(pg_sizing, name, os.path.join(self.root, os.path.relpath(value, '/sys/fs/cgroup')))
+        pg_sizing.host_memory_bytes = lambda: HOST_MEMORY
+        pg_sizing.host_cpus = lambda: HOST_CPUS
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(pg_sizing, name, value)
+
+    def write_cgroup(self, files):
+        for name, contents in files.items():
+            filename = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w') as f:
+                f.write(contents + '\n')
+
+    def test_detect_resources(self):
+        for description, files, expected in RESOURCES:
+            with self.subTest(description):
+                shutil.rmtree(self.root)
+                os.makedirs(self.root)
+                self.write_cgroup(files)
+                resources = pg_sizing.detect_resources()
+                self.assertEqual((round(resources['memory_mb']), resources['cpus'], resources['memory_source'],
+                                  resources['cpus_source']), expected)
+
+
+class TestSizeParameters(unittest.TestCase):
+
+    def test_size_parameters(self):
+        for args, expected in PARAMETERS:
+            with self.subTest(args):
+                parameters = pg_sizing.size_parameters(*args)
+                self.assertEqual({name: parameters.get(name) for name in expected}, expected)
+                self.assertTrue(set(parameters) <= set(pg_sizing.PARAMETERS))
+
+    def test_profile_parameters(self):
+        self.assertNotIn('max_wal_size', pg_sizing.size_parameters(4096, 4))
+        for profile in pg_sizing.WORKLOAD_PROFILES:
+            with self.subTest(profile):
+                self.assertIn('max_wal_size', pg_sizing.size_parameters(4096, 4, profile=profile))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,485 @@
+import datetime
+import importlib.util
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import types
+import unittest
+import unittest.mock
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.insert(0, SCRIPTS)
+
+# The sidecar is a script with a dash in its name, so it can not be imported the usual way
+spec = importlib.util.spec_from_file_location('pgbackrest_rest', os.path.join(SCRIPTS, 'pgbackrest-rest.py'))
+rest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rest)
+
+# Request lines the http server can not parse, and the status it should answer them with
+BAD_REQUESTS = [
+    (b'GARBAGE\r\n\r\n', 400),
+    (b'GET /x HTTP/1.1 extra\r\n\r\n', 400),
+    (b'GET /x HTTP/9.9\r\n\r\n', 505),
+    (b'GET /' + b'x' * 70000 + b' HTTP/1.1\r\n\r\n', 414),
+]
+
+# The backups in the history, as hour of 2020-01-01 they started and their status
+HISTORY = [(0, 'FINISHED'), (1, 'ERROR'), (2, 'FINISHED'), (3, 'RUNNING'), (4, 'REQUESTED')]
+
+# The arguments of BackupHistory.labels and the hours of the labels we expect
+LABELS = [
+    ({}, [0, 1, 2, 3, 4]),
+    ({'statuses': ['FINISHED']}, [0, 2]),
+    ({'statuses': ['FINISHED', 'ERROR']}, [0, 1, 2]),
+    ({'statuses': ['UNKNOWN']}, []),
+    ({'since': '20200101010000'}, [1, 2, 3, 4]),
+    ({'before': '20200101030000'}, [0, 1, 2]),
+    ({'since': '20200101005959', 'before': '20200101020001'}, [1, 2]),
+    ({'after': '20200101010000'}, [2, 3, 4]),
+    ({'after': '20200101010000', 'limit': 2}, [2, 3]),
+    ({'statuses': ['FINISHED', 'RUNNING'], 'after': '20200101000000', 'limit': 2}, [2, 3]),
+    ({'limit': 0}, []),
+]
+
+# The statuses passed to BackupHistory.latest and the hour of the backup we expect
+LATEST = [
+    (None, 4),
+    (['FINISHED'], 2),
+    (['FINISHED', 'ERROR'], 2),
+    (['ERROR'], 1),
+    (['UNKNOWN'], None),
+]
+
+# pgBackRest info documents and the elements JSONStreamParser should yield for them
+DOCUMENTS = [
+    ('[]', []),
+    ('[{"name": "a", "backup": []}]', [('name', 'a')]),
+    ('[{"name": "a", "backup": [{"label": "1F"}, {"label": "1F_2I", "size": 1234567}], "status": {"code": 0}}]',
+     [('name', 'a'), ('backup', {'label': '1F'}), ('backup', {'label': '1F_2I', 'size': 1234567}), ('status', {'code': 0})]),
+    ('\n[\n  {\n    "backup" : [ {"label": "1F"} ] ,\n    "db": [1, 2]\n  },\n  {"name": "b", "size": 42}\n]\n',
+     [('backup', {'label': '1F'}), ('db', [1, 2]), ('name', 'b'), ('size', 42)]),
+]
+
+# Documents JSONStreamParser should raise a ValueError for
+INVALID_DOCUMENTS = ['', '{"name": "a"}', '[{"name": "a"', '[{"name": "a}]', '[{"name" "a"}]', '[{"backup": [{"label": 1}']
+
+# The arguments of LogBuffer.read, for a buffer of 5 lines that had 8 lines appended, and the offsets we expect
+LOG_READS = [
+    ((None, None), [3, 4, 5, 6, 7]),
+    ((0, None), [3, 4, 5, 6, 7]),
+    ((5, None), [5, 6, 7]),
+    ((7, None), [7]),
+    ((8, None), []),
+    ((100, None), []),
+    ((None, 2), [6, 7]),
+    ((None, 0), []),
+    ((None, 100), [3, 4, 5, 6, 7]),
+    ((4, 2), [6, 7]),
+    ((7, 2), [7]),
+]
+
+# The requests put in a queue, and the requests of the pending backups (without their command) in the order they will run
+QUEUES = [
+    ([{}], [{'type': 'full', 'priority': 0}]),
+    ([{'type': 'incr'}, {'type': 'diff', 'process-max': 2}],
+     [{'type': 'incr', 'priority': 0}, {'type': 'diff', 'priority': 0, 'process-max': 2}]),
+    ([{'type': 'incr'}, {'type': 'diff', 'process-max': 2, 'priority': 5}],
+     [{'type': 'diff', 'priority': 5, 'process-max': 2}, {'type': 'incr', 'priority': 0}]),
+    ([{'type': 'incr'}, {'type': 'full'}, {'type': 'diff'}], [{'type': 'full', 'priority': 0}]),
+    ([{'type': 'full'}, {'type': 'incr', 'priority': 3}], [{'type': 'full', 'priority': 3}]),
+    ([{'type': 'incr', 'process-max': 2}, {'type': 'incr', 'process-max': 4}, {'type': 'full', 'process-max': 2, 'priority': 1}],
+     [{'type': 'full', 'priority': 1, 'process-max': 2}, {'type': 'incr', 'priority': 0, 'process-max': 4}]),
+]
+
+# Cron expressions, a timestamp (in 2020-01, the 1st was a Wednesday) and whether it should match
+SCHEDULES = [
+    ('* * * * *', (1, 12, 34), True),
+    ('*/15 * * * *', (1, 12, 30), True),
+    ('*/15 * * * *', (1, 12, 31), False),
+    ('30/10 * * * *', (1, 12, 50), True),
+    ('30/10 * * * *', (1, 12, 20), False),
+    ('5,10-20/5 * * * *', (1, 12, 15), True),
+    ('5,10-20/5 * * * *', (1, 12, 12), False),
+    ('5,10-20/5 * * * *', (1, 12, 25), False),
+    ('0 1 * * 0', (5, 1, 0), True),
+    ('0 1 * * 7', (5, 1, 0), True),
+    ('0 1 * * 0', (6, 1, 0), False),
+    ('0 0 * * 1-5', (3, 0, 0), True),
+    ('0 0 * * 1-5', (4, 0, 0), False),
+    ('0 0 1 * *', (6, 0, 0), False),
+    ('0 0 1 * 1', (1, 0, 0), True),
+    ('0 0 1 * 1', (6, 0, 0), True),
+    ('0 0 1 * 1', (7, 0, 0), False),
+    ('0 0 * 2 *', (1, 0, 0), False),
+]
+
+INVALID_SCHEDULES = ['* * * *', '* * * * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *', '* * * * 8',
+                     '5-1 * * * *', '*/0 * * * *', 'a * * * *', '1-a * * * *', '*/x * * * *']
+
+# The times the scheduler wakes up at (as hour, minute, second, microsecond), and the number of times
+# it should evaluate the schedules; it waits for the next minute, but may wake up early, or the clock may be set back
+WAKEUPS = [
+    ([(0, 59, 0, 0), (1, 0, 0, 0), (1, 1, 0, 0)], 3),
+    ([(0, 59, 59, 999000), (0, 59, 59, 999900), (1, 0, 0, 1000)], 2),
+    ([(1, 0, 30, 0), (0, 59, 30, 0), (1, 0, 59, 0), (1, 1, 0, 0)], 2),
+]
+
+
+def started(hour, minute=0):
+    return datetime.datetime(2020, 1, 1, hour, minute, tzinfo=datetime.timezone.utc)
+
+
+def label(hour):
+    return rest.backup_label(started(hour)) if hour is not None else None
+
+
+def pgbackrest_backup(pgbackrest_label, hour, minute=0, size=1000):
+    """An element of the backup list of pgBackRest info, for a backup that ran for a minute"""
+    start = int(started(hour, minute).timestamp())
+    return {'label': pgbackrest_label, 'type': 'full', 'timestamp': {'start': start, 'stop': start + 60},
+            'info': {'size': size}}
+
+
+def record(hour, status='FINISHED', returncode=0, pgbackrest=None, stanza='test'):
+    """A line of the journal, for a backup that started at the given hour"""
+    return json.dumps({'label': label(hour), 'stanza': stanza, 'status': status, 'request': {'type': 'full'},
+                       'started': started(hour).isoformat(), 'finished': started(hour, 30).isoformat(),
+                       'returncode': returncode, 'settings': {}, 'pgbackrest': pgbackrest or {}})
+
+
+def removed(hour):
+    return json.dumps({'label': label(hour), 'stanza': 'test', 'removed': True})
+
+
+# The lines of a journal, and the status of the backups (by hour) we expect to restore from it
+JOURNALS = [
+    ([], {}),
+    ([record(0), record(1, 'ERROR', 1)], {0: 'FINISHED', 1: 'ERROR'}),
+    ([record(0, 'REQUESTED', None), record(0, 'RUNNING', None), record(0)], {0: 'FINISHED'}),
+    ([record(0, 'RUNNING', None)], {0: 'ERROR'}),
+    ([record(0), 'garbage', record(1)[:20]], {0: 'FINISHED'}),
+    ([record(0), record(1), removed(0)], {1: 'FINISHED'}),
+    ([record(0), removed(0), record(0, 'ERROR', 1)], {0: 'ERROR'}),
+    ([record(0, returncode=None, pgbackrest={'label': '20200101-000000F'}), record(1, returncode=None)],
+     {0: 'FINISHED'}),
+    ([record(0, stanza='other'), record(1)], {1: 'FINISHED'}),
+]
+
+
+class TestBackupHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.history = rest.BackupHistory()
+        self.notified = []
+        self.history.listeners.append(lambda backups: self.notified.append(sorted(b.label for b in backups)))
+        for hour, status in HISTORY:
+            self.history.add(rest.PostgreSQLBackup(stanza='test', status=status, started=started(hour)))
+
+    def test_labels(self):
+        for kwargs, expected in LABELS:
+            with self.subTest(kwargs):
+                self.assertEqual(self.history.labels(**kwargs), [label(hour) for hour in expected])
+
+    def test_latest(self):
+        for statuses, expected in LATEST:
+            with self.subTest(statuses):
+                latest = self.history.latest(statuses)
+                self.assertEqual(latest.label if latest else None, label(expected))
+
+    def test_add(self):
+        existing = self.history.get(label(0))
+        self.assertIs(self.history.add(rest.PostgreSQLBackup(stanza='test', started=started(0))), existing)
+        self.assertEqual(len(self.history), len(HISTORY))
+
+        duplicate = self.history.add(rest.PostgreSQLBackup(stanza='test', started=started(0)), unique=True)
+        self.assertEqual(duplicate.label, label(0) + '-1')
+        self.assertEqual(self.history.labels(before=label(1)), [label(0), label(0) + '-1'])
+        self.assertEqual(self.history.labels(statuses=['REQUESTED']), [label(0) + '-1', label(4)])
+
+    def test_update(self):
+        generation = self.history.generation
+        backup = self.history.get(label(3))
+        backup.update(status='FINISHED', returncode=0, pgbackrest_info=pgbackrest_backup('20200101-030000F', 3))
+
+        self.assertEqual(self.history.labels(statuses=['RUNNING']), [])
+        self.assertEqual(self.history.labels(statuses=['FINISHED']), [label(0), label(2), label(3)])
+        self.assertIs(self.history.get('20200101-030000F'), backup)
+        self.assertEqual(self.history.generation, generation + 1)
+        self.assertEqual(self.notified[-1], [label(3)])
+
+        backup.update(pgbackrest_info={})
+        self.assertIsNone(self.history.get('20200101-030000F'))
+
+    def test_remove(self):
+        backup = self.history.get(label(2))
+        self.history.remove(backup)
+        self.assertNotIn(label(2), self.history)
+        self.assertEqual(self.history.labels(statuses=['FINISHED']), [label(0)])
+        self.assertEqual(self.history.status_counts(), {'FINISHED': 1, 'ERROR': 1, 'RUNNING': 1, 'REQUESTED': 1})
+
+        # Removing a backup that is not in the history does not notify anyone
+        notified = len(self.notified)
+        self.history.remove(backup)
+        self.assertEqual(len(self.notified), notified)
+
+    def test_reconcile(self):
+        own = self.history.get(label(0))
+        own.update(returncode=0, finished=started(0, 30))
+        self.notified.clear()
+
+        # Our own backup is matched on the time pgBackRest actually started it
+        backups = [pgbackrest_backup('20200101-000500F', 0, 5), pgbackrest_backup('20200101-050000F', 5)]
+        self.assertEqual(self.history.reconcile('test', backups), 2)
+        self.assertEqual(own.pgbackrest_info, backups[0])
+        self.assertEqual(self.history.get('20200101-050000F').label, label(5))
+        self.assertEqual(self.notified, [[label(0), label(5)]])
+
+        self.assertEqual(self.history.reconcile('test', backups), 0)
+        self.assertEqual(self.notified, [[label(0), label(5)]])
+
+        backups[1] = pgbackrest_backup('20200101-050000F', 5, size=2000)
+        self.assertEqual(self.history.reconcile('test', backups), 1)
+        self.assertEqual(self.history.get(label(5)).pgbackrest_info['info']['size'], 2000)
+
+        # Once expired, the backups only pgBackRest knew about are removed, ours are kept
+        self.assertEqual(self.history.reconcile('test', []), 2)
+        self.assertNotIn(label(5), self.history)
+        self.assertIs(self.history.get(label(0)), own)
+        self.assertEqual(own.pgbackrest_info, {})
+        self.assertIsNone(self.history.get('20200101-000500F'))
+
+
+class TestJSONStreamParser(unittest.TestCase):
+
+    def parse(self, document, chunk_size):
+        parser = rest.JSONStreamParser(io.StringIO(document))
+        parser.CHUNK_SIZE = chunk_size
+        return list(parser)
+
+    def test_parse(self):
+        # Small chunks ensure values, numbers in particular, are cut in half by the end of the buffer
+        for chunk_size in (1, 2, 7, rest.JSONStreamParser.CHUNK_SIZE):
+            for document, expected in DOCUMENTS:
+                with self.subTest(document, chunk_size=chunk_size):
+                    self.assertEqual(self.parse(document, chunk_size), expected)
+
+    def test_invalid(self):
+        for chunk_size in (1, rest.JSONStreamParser.CHUNK_SIZE):
+            for document in INVALID_DOCUMENTS:
+                with self.subTest(document, chunk_size=chunk_size):
+                    self.assertRaises(ValueError, self.parse, document, chunk_size)
+
+    def test_bounded_buffer(self):
+        backups = ', '.join('{{"label": "{0}F", "padding": "{1}"}}'.format(i, 'x' * 1000) for i in range(1000))
+        parser = rest.JSONStreamParser(io.StringIO('[{"backup": [' + backups + ']}]'))
+        parser.CHUNK_SIZE = 4096
+        longest = 0
+        for key, value in parser:
+            longest = max(longest, len(parser.buf))
+        self.assertEqual(value['label'], '999F')
+        self.assertLess(longest, 2 * parser.CHUNK_SIZE)
+
+
+class TestLogBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.log = rest.LogBuffer(5)
+        for i in range(8):
+            self.log.append('INFO', 'line {0}'.format(i))
+
+    def test_read(self):
+        self.assertEqual((self.log.first, self.log.total), (3, 8))
+        for args, expected in LOG_READS:
+            with self.subTest(args):
+                lines = self.log.read(*args)
+                self.assertEqual([offset for offset, _, _, _ in lines], expected)
+                self.assertEqual([message for _, _, _, message in lines], ['line {0}'.format(o) for o in expected])
+
+    def test_truncate(self):
+        log = rest.LogBuffer(5)
+        log.append('WARN', 'x' * (rest.LogBuffer.MAX_LINE_LENGTH + 100))
+        # A multibyte character cut in half is replaced
+        log.append('INFO', 'x' * (rest.LogBuffer.MAX_LINE_LENGTH - 1) + '\u00e9')
+        (_, _, loglevel, first), (_, _, _, second) = log.read()
+        self.assertEqual((loglevel, first), ('WARN', 'x' * rest.LogBuffer.MAX_LINE_LENGTH))
+        self.assertEqual(second, 'x' * (rest.LogBuffer.MAX_LINE_LENGTH - 1) + '\ufffd')
+
+    def test_read_log(self):
+        backup = rest.PostgreSQLBackup(stanza='test')
+        self.assertEqual(backup.read_log(), (0, 0, []))
+        backup._add_log('INFO', 'line 0')
+        self.assertEqual(backup.read_log()[:2], (0, 1))
+
+
+class TestBackupJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'journal')
+
+    def restore(self):
+        history = rest.BackupHistory()
+        journal = rest.BackupJournal(self.path)
+        # Restoring always logs, this keeps the warnings about the corrupt lines out of the output
+        with self.assertLogs(level='INFO'):
+            journal.restore({'test': history})
+        self.addCleanup(journal.close)
+        return history, journal
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_restore(self):
+        for lines, expected in JOURNALS:
+            with self.subTest(lines):
+                with open(self.path, 'w') as f:
+                    f.write(''.join(line + '\n' for line in lines))
+                history, journal = self.restore()
+                self.assertEqual({hour: history.get(label(hour)).status for hour in expected}, expected)
+                self.assertEqual(len(history), len(expected))
+
+                # The compacted journal has a single line per backup, the backups of other stanzas are kept
+                journal.close()
+                self.assertEqual(sorted((line['stanza'], line['label'], line['status']) for line in self.lines()),
+                                 sorted([('test', label(hour), status) for hour, status in expected.items()] +
+                                        [('other', label(0), 'FINISHED') for line in lines if '"other"' in line]))
+
+    def test_append(self):
+        history, journal = self.restore()
+        history.listeners.append(journal.append)
+        for hour in range(3):
+            history.add(rest.PostgreSQLBackup(stanza='test', started=started(hour)))
+        history.get(label(0)).update(status='FINISHED', returncode=0)
+        history.get(label(1)).update(status='ERROR', returncode=1)
+        history.remove(history.get(label(2)))
+        journal.close()
+
+        self.assertEqual(len(self.lines()), 6)
+        restored, _ = self.restore()
+        self.assertEqual(restored.labels(), [label(0), label(1)])
+        self.assertEqual([restored.get(label(hour)).status for hour in range(2)], ['FINISHED', 'ERROR'])
+
+        # Nothing is written after the journal is closed
+        history.get(label(0)).update(status='ERROR')
+        self.assertEqual(len(self.lines()), 2)
+
+
+class TestBackupQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.history = rest.BackupHistory()
+        self.queue = rest.BackupQueue(self.history, 'test', max_queued=3)
+
+    def test_put(self):
+        for requests, expected in QUEUES:
+            with self.subTest(requests):
+                queue = rest.BackupQueue(rest.BackupHistory(), 'test')
+                backups = [queue.put(dict(request)) for request in requests]
+                pending = queue.pending()
+                self.assertEqual([{k: v for k, v in b.request.items() if k != 'command'} for b in pending], expected)
+                # Every request is answered with the backup that fulfills it
+                self.assertTrue(all(backup in pending for backup, _ in backups))
+                self.assertEqual(sum(queued for _, queued in backups), len(expected))
+                self.assertEqual(len(queue.history), len(expected))
+
+    def test_full(self):
+        for process_max in range(1, 4):
+            self.queue.put({'process-max': process_max})
+        self.assertRaises(rest.QueueFullError, self.queue.put, {'process-max': 4})
+        # A request that is coalesced does not need a place of its own
+        self.assertEqual(self.queue.put({'type': 'incr', 'process-max': 1})[1], False)
+
+    def test_get(self):
+        incr, _ = self.queue.put({'type': 'incr'})
+        diff, _ = self.queue.put({'type': 'diff', 'process-max': 2, 'priority': 1})
+        self.assertIs(self.queue.get(), diff)
+        self.assertIs(self.queue.current, diff)
+        self.queue.done()
+        self.assertIsNone(self.queue.current)
+
+        # Once closed, get no longer hands out backups
+        self.queue.close()
+        self.assertIsNone(self.queue.get())
+        self.assertEqual(self.queue.pending(), [incr])
+
+
+class TestCronSchedule(unittest.TestCase):
+
+    def test_matches(self):
+        for expression, (day, hour, minute), expected in SCHEDULES:
+            with self.subTest(expression, day=day, hour=hour, minute=minute):
+                timestamp = datetime.datetime(2020, 1, day, hour, minute, tzinfo=datetime.timezone.utc)
+                self.assertEqual(rest.CronSchedule(expression).matches(timestamp), expected)
+
+    def test_invalid(self):
+        for expression in INVALID_SCHEDULES:
+            with self.subTest(expression):
+                self.assertRaises(ValueError, rest.CronSchedule, expression)
+
+
+class TestBackupScheduler(unittest.TestCase):
+
+    def test_wakeups(self):
+        for wakeups, expected in WAKEUPS:
+            with self.subTest(wakeups):
+                times = [datetime.datetime(2020, 1, 1, *t, tzinfo=datetime.timezone.utc) for t in wakeups]
+
+                # Every iteration asks the time once, the scheduler stops once we run out of times
+                class Clock(datetime.datetime):
+                    @classmethod
+                    def now(cls, tz=None):
+                        return times.pop(0)
+
+                shutdown_trigger = types.SimpleNamespace(is_set=lambda: not times, wait=lambda timeout: False)
+                requests = []
+                queue = types.SimpleNamespace(put=lambda request: (requests.append(request) or
+                                                                   (types.SimpleNamespace(label='x'), True)))
+                stanzas = {'test': types.SimpleNamespace(name='test', queue=queue)}
+
+                clock = types.SimpleNamespace(datetime=Clock, timedelta=datetime.timedelta, timezone=datetime.timezone)
+                with unittest.mock.patch.object(rest, 'datetime', clock), self.assertLogs(level='INFO'):
+                    rest.backup_scheduler(stanzas, [(None, 'full', rest.CronSchedule('* * * * *'))], shutdown_trigger)
+                self.assertEqual(len(requests), expected)
+
+
+class TestRequestHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.server = rest.EventHTTPServer(('127.0.0.1', 0), rest.RequestHandler)
+        self.errors = []
+        self.server.handle_error = lambda request, client_address: self.errors.append(sys.exc_info()[1])
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, data):
+        with socket.create_connection(self.server.server_address, timeout=5) as s:
+            s.sendall(data)
+            s.shutdown(socket.SHUT_WR)
+            response = b''
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    return response
+                response += chunk
+
+    def test_bad_request_line(self):
+        for data, code in BAD_REQUESTS:
+            with self.subTest(data[:30]):
+                before = rest.HTTP_REQUEST_DURATION.samples.get(('other', 'other', str(code)), (None, 0, 0))[2]
+                # The request version is unknown, so the error may be sent the HTTP/0.9 way, without a status line
+                self.assertIn(str(code).encode(), self.request(data))
+                self.assertEqual(self.errors, [])
+                self.assertEqual(rest.HTTP_REQUEST_DURATION.samples[('other', 'other', str(code))][2], before + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
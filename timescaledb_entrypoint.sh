@@ -16,12 +16,11 @@ install -m 0700 -d "${PGDATA}"
 # For now, if the environment variable is set, we consider that a feature flag to use
 # the original Spilo configuration script
 [ -n "${SPILO_CONFIGURATION}" ] && {
-	python3 /scripts/configure_spilo.py patroni patronictl certificate
-
 	# The current postgres-operator does not pass on all the variables set by the Custom Resource.
-	# We need a bit of extra work to be done
+	# We need a bit of extra work to be done, which configure_spilo.py does in the same pass by
+	# applying augment_patroni_configuration.py to the generated configuration.
 	# Issue: https://github.com/zalando/postgres-operator/issues/574
-	python3 /scripts/augment_patroni_configuration.py /home/postgres/postgres.yml
+	python3 /scripts/configure_spilo.py patroni patronictl certificate
 }
 
 if [ -f "${PGDATA}/postmaster.pid" ]; then